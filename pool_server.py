@@ -1,19 +1,23 @@
+import csv
 import json
 import logging
 import time
-import urlparse
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
 from logging.handlers import TimedRotatingFileHandler
-from threading import Timer
+from threading import BoundedSemaphore, Timer
+from wsgiref.simple_server import WSGIServer
 
 import bottle
-import bottle_pgsql
 import os
-from bottle import run, request, response, static_file
+from bottle import abort, run, request, response, static_file, http_date, parse_date
 from requestlogger import WSGILogger, ApacheFormatter
-from src import credit, database, payout, config
+from src import balances, credit, database, payout, config, retention
 import src.exchanges
-from src.price_fetcher import PriceFetcher
-from src.utils import AddressCheck
+from src.price_fetcher import PriceFetcher, feed_stats, price_cache, response_cache
+from src.stats import price_section, round_stats, status_document
+from src.utils import AddressCheck, etag_matches
+from src.validation import ValidationQueue, save_orders
 
 __author__ = 'sammoth'
 
@@ -45,45 +49,44 @@ log.addHandler(stream)
 # Load the config
 config.load(app, log, os.getenv("CONFIG_DIR", 'config'), log_output=True)
 
-# Install the Postgres plugin
-if os.getenv("DATABASE_URL", None) is not None:
-    urlparse.uses_netloc.append("postgres")
-    url = urlparse.urlparse(os.environ["DATABASE_URL"])
-    app.install(bottle_pgsql.Plugin('dbname={} user={} password={} '
-                                    'host={} port={}'.format(url.path[1:],
-                                                             url.username,
-                                                             url.password,
-                                                             url.hostname,
-                                                             url.port)))
-else:
-    app.install(bottle_pgsql.Plugin('dbname={} user={} password={} '
-                                    'host={} port={}'.format(app.config['db.name'],
-                                                             app.config['db.user'],
-                                                             app.config['db.pass'],
-                                                             app.config['db.host'],
-                                                             app.config['db.port'])))
+# Install the Postgres plugin which lends pooled connections to the request handlers
+app.install(database.PoolPlugin(app))
 
 # Create the database if one doesn't exist
 database.build(app, log)
 
+# Make the partitions for the coming days and expire old ones. This runs every hour
+log.info('running retention timer')
+retention.maintain(app, log)
+
 # Create the Exchange wrapper objects
 wrappers = {}
-if 'bittrex' in app.config['exchanges']:
-    wrappers['bittrex'] = src.exchanges.Bittrex()
-if 'bter' in app.config['exchanges']:
-    wrappers['bter'] = src.exchanges.BTER()
-if 'ccedk' in app.config['exchanges']:
-    wrappers['ccedk'] = src.exchanges.CCEDK()
-if 'poloniex' in app.config['exchanges']:
-    wrappers['poloniex'] = src.exchanges.Poloniex()
-if 'test_exchange' in app.config['exchanges']:
-    wrappers['test_exchange'] = src.exchanges.TestExchange()
+exchange_classes = {'bittrex': src.exchanges.Bittrex,
+                    'bter': src.exchanges.BTER,
+                    'ccedk': src.exchanges.CCEDK,
+                    'poloniex': src.exchanges.Poloniex,
+                    'test_exchange': src.exchanges.TestExchange}
+for exchange_name in exchange_classes:
+    if exchange_name in app.config['pool'].exchanges:
+        wrappers[exchange_name] = exchange_classes[exchange_name](
+            pool_size=app.config['pool'].exchanges[exchange_name].pool_size)
+
+# Set up the validation queue if submissions are to be validated asynchronously
+validation_queue = None
+if config.get_bool(app, 'validation.async'):
+    log.info('validating submissions asynchronously')
+    validation_queue = ValidationQueue(app, log, wrappers,
+                                       workers=config.get_int(app, 'validation.workers',
+                                                              4),
+                                       size=config.get_int(app, 'validation.queue_size',
+                                                           1000))
 
 # save the start time of the server for reporting up-time
 app.config['start_time'] = time.time()
 
-# set up a price fetcher object
-pf = PriceFetcher(app, log)
+# set up a price fetcher object. this runs while the module is imported so the first
+# prices arrive in the background. until then the last stored prices are used
+pf = PriceFetcher(app, log, wait=False)
 
 # Set the timer for credits
 log.info('running credit timer')
@@ -93,20 +96,28 @@ credit_timer.name = 'credit_timer'
 credit_timer.daemon = True
 credit_timer.start()
 
+# Make sure the balances ledger agrees with the credits
+if config.get_bool(app, 'balances.check_on_start'):
+    with database.connection(app) as conn:
+        wrong_balances = balances.check(conn.cursor())
+    for key, ledger_balance, derived_balance in wrong_balances:
+        log.error('balance of %s is %s but the credits add up to %s', key,
+                  ledger_balance, derived_balance)
+
 # Set the timer for payouts
 log.info('running payout timer')
-conn = database.get_db(app)
-db = conn.cursor()
-db.execute("SELECT value FROM info WHERE key = %s", ('next_payout_time',))
-next_payout_time = int(db.fetchone()[0])
-if next_payout_time == 0:
-    payout_time = 86400
-    db.execute('UPDATE info SET value=%s WHERE key=%s', (int(time.time() + payout_time),
-                                                         'next_payout_time'))
-else:
-    payout_time = int(next_payout_time - int(time.time()))
-conn.commit()
-conn.close()
+with database.connection(app) as conn:
+    db = conn.cursor()
+    db.execute("SELECT value FROM info WHERE key = %s", ('next_payout_time',))
+    next_payout_time = int(db.fetchone()[0])
+    if next_payout_time == 0:
+        payout_time = 86400
+        db.execute('UPDATE info SET value=%s WHERE key=%s', (int(time.time() +
+                                                                 payout_time),
+                                                             'next_payout_time'))
+    else:
+        payout_time = int(next_payout_time - int(time.time()))
+    conn.commit()
 payout_timer = Timer(payout_time, payout.pay,
                      kwargs={'app': app, 'log': log})
 payout_timer.name = 'payout_timer'
@@ -190,11 +201,11 @@ def register(db):
         return {'success': False, 'message': '{} is not a valid NBT address. The '
                                              'checksum doesn\'t match'.format(address)}
     # Check that the requests exchange is supported by the server
-    if exchange not in app.config['exchanges']:
+    if exchange not in app.config['pool'].exchanges:
         log.warn('%s is not supported', exchange)
         return {'success': False, 'message': '{} is not supported'.format(exchange)}
     # Check that the unit is supported on the server
-    if unit not in app.config['{}.units'.format(exchange)]:
+    if app.config['pool'].unit(exchange, unit) is None:
         log.warn('%s is not supported on %s', unit, exchange)
         return {'success': False, 'message': '{} is not supported on {}'.format(unit,
                                                                                 exchange)}
@@ -256,10 +267,10 @@ def liquidity(db):
     if not req:
         log.warn('no req provided')
         return {'success': False, 'message': 'no req provided'}
-    if exchange not in app.config['exchanges']:
+    if exchange not in app.config['pool'].exchanges:
         log.warn('invalid exchange')
         return {'success': False, 'message': '{} is not supported'.format(exchange)}
-    if unit not in app.config['{}.units'.format(exchange)]:
+    if app.config['pool'].unit(exchange, unit) is None:
         log.warn('invalid unit')
         return {'success': False, 'message': '{} is not supported on {}'.format(unit,
                                                                                 exchange)}
@@ -269,57 +280,43 @@ def liquidity(db):
     if user_check is None:
         log.error('user %s is not registered', user)
         return {'success': False, 'message': 'user {} is not registered'.format(user)}
+    # hand the request to the validation workers if running asynchronously
+    if validation_queue is not None:
+        submission_id = validation_queue.submit(user, exchange, unit, req, sign)
+        if submission_id is None:
+            log.error('validation queue is full -> %s', user)
+            return {'success': False, 'message': 'validation queue is full. please try '
+                                                 'again later'}
+        log.info('user %s orders queued for validation', user)
+        return {'success': True, 'message': 'orders queued for validation',
+                'submission': submission_id}
     # use the submitted data to request the users orders
     valid = wrappers[exchange].validate_request(user=user, unit=unit, req=req, sign=sign)
     if valid['message'] != 'success':
         log.error('%s: %s -> %s', exchange, valid['message'], user)
         return {'success': valid['success'], 'message': valid['message']}
-    orders = valid['orders']
-    # get the price from the price feed
-    db.execute("SELECT price FROM prices WHERE unit=%s ORDER BY id DESC LIMIT 1", (unit,))
-    db_price = db.fetchone()
-    if db_price is None:
-        log.error('unable to fetch current price for %s -> %s', unit, user)
-        return {'success': False, 'message': 'unable to fetch current price for {}'.
-                format(unit)}
-    price = db_price['price']
-
-    # make sure the price is based in the correct units
-    # price from price feed is in nbt/btc we potentially need btc/nbt
-    # base this on the 'revers' parameter set in the exchange config
-    if app.config['{}.{}.reverse'.format(exchange, unit)]:
-        price = 1/float(price)
-
-    # Loop through the orders
-    for order in orders:
-        # Calculate how far the order price is from the known good price
-        order_deviation = 1.00 - (min(float(order['price']), float(price)) /
-                                  max(float(order['price']), float(price)))
-        # Use the rank tolerances to determine the rank of the order
-        order_rank = ''
-        # first build a sorted list of tolerances
-        tolerances = []
-        tolerance = 1.00
-        for rank in app.config['{}.{}.{}.ranks'.format(exchange, unit, order['side'])]:
-            try:
-                tolerance = app.config['{}.{}.{}.{}.tolerance'.format(
-                        exchange, unit, order['side'], rank)]
-            except KeyError:
-                tolerance = 1.00
-            tolerances.append((rank, tolerance))
-        for tolerance in sorted(tolerances, key=lambda tup: tup[1]):
-            if float(order_deviation) <= float(tolerance[1]):
-                order_rank = tolerance[0]
-                break
-        # save the order details
-        db.execute("INSERT INTO orders (key,rank,order_id,order_amount,side,order_price,"
-                   "server_price,exchange,unit,deviation,tolerance,credited) VALUES "
-                   "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-                   (user, order_rank, str(order['id']), float(order['amount']),
-                    str(order['side']), float(order['price']), float(price), exchange,
-                    unit, float(order_deviation), float(tolerance[1]), 0))
-    log.info('user %s orders saved for validation', user)
-    return {'success': True, 'message': 'orders saved for validation'}
+    return save_orders(app, log, db, user, exchange, unit, valid['orders'])
+
+
+@app.get('/liquidity/<submission_id>')
+def liquidity_submission(submission_id):
+    """
+    Get the result of a liquidity submission which was queued for validation
+    :param submission_id:
+    :return:
+    """
+    if validation_queue is None:
+        return {'success': False, 'message': 'submissions are validated immediately'}
+    result = validation_queue.result(submission_id)
+    if result is None:
+        log.warn('submission %s not found', submission_id)
+        return {'success': False,
+                'message': 'submission {} not found'.format(submission_id)}
+    if result['status'] == 'pending':
+        return {'success': True, 'status': 'pending',
+                'message': 'submission is waiting for validation'}
+    return {'success': result['success'], 'status': result['status'],
+            'message': result['message']}
 
 
 @app.get('/exchanges')
@@ -329,85 +326,203 @@ def exchanges():
     :return:
     """
     log.info('/exchanges')
-    data = {}
-    for ex in app.config['exchanges']:
-        if ex not in data:
-            data[ex] = {}
-        for u in app.config['{}.units'.format(ex)]:
-            data[ex][u] = {
-                'reward': app.config['{}.{}.reward'.format(ex, u)],
-                'target': app.config['{}.{}.target'.format(ex, u)]
-            }
-            for side in ['ask', 'bid']:
-                data[ex][u][side] = {'ratio': app.config['{}.{}.ask.ratio'.format(ex, u)]}
-                for rank in app.config['{}.{}.{}.ranks'.format(ex, u, side)]:
-                    try:
-                        tolerance = app.config['{}.{}.{}.{}.tolerance'.format(ex,
-                                                                              u,
-                                                                              side,
-                                                                              rank)]
-                    except KeyError:
-                        tolerance = 1.00
-                    data[ex][u][side][rank] = {
-                        'ratio': app.config['{}.{}.{}.{}.ratio'.format(ex, u,
-                                                                       side, rank)],
-                        'tolerance': tolerance
-                    }
-    return data
+    # the body is built when the config is loaded
+    pool = app.config['pool']
+    response.set_header('ETag', pool.exchanges_etag)
+    response.set_header('Cache-Control', 'public, max-age=60')
+    if etag_matches(request.get_header('If-None-Match'), pool.exchanges_etag):
+        response.status = 304
+        return ''
+    response.set_header('Content-Type', 'application/json')
+    return pool.exchanges_body
+
+
+@app.get('/health')
+def health():
+    """
+    Show counters which help to judge how well the server is performing
+    :return:
+    """
+    log.info('/health')
+    data = {'exchanges': {}, 'database': database.get_pool(app).stats()}
+    for ex in wrappers:
+        data['exchanges'][ex] = wrappers[ex].connection_stats()
+    if validation_queue is not None:
+        data['validation_queue'] = validation_queue.depth()
+    data['price_age'] = {}
+    for unit in app.config['pool'].units:
+        data['price_age'][unit] = price_cache.age(unit)
+    data['price_feeds'] = feed_stats.stats()
+    data['price_feed_cache'] = response_cache.stats()
+    data['price_updates'] = pf.stats()
+    if pf.subscriber is not None:
+        data['price_streamer'] = pf.subscriber.stats()
+    return {'success': True, 'message': data, 'server_time': int(time.time())}
+
+
+@app.get('/feeds')
+def feeds():
+    """
+    Show the health of each price feed and how the feeds of each unit are ranked
+    :return:
+    """
+    log.info('/feeds')
+    data = {'feeds': feed_stats.stats(), 'units': {}}
+    for unit in app.config['pool'].units:
+        data['units'][unit] = pf.standard.ranking(unit)
+    return {'success': True, 'message': data, 'server_time': int(time.time())}
 
 
 @app.get('/status')
-def status(db):
+def status():
     """
     Display the overall pool status.
     This will be the number of users and the amount of liquidity for each rank, side,
-    unit, exchange for the last full round and the current round
-    :param db:
+    unit, exchange for the last full round and the current round.
+    The document is built by the credit round and the price updater
     :return:
     """
     log.info('/status')
-    # get the prices
-    prices = {}
-    for unit in app.config['units']:
-        db.execute(
-            "SELECT price FROM prices WHERE unit=%s ORDER BY id DESC LIMIT 1", (
-                unit,
-            )
-        )
-        price = db.fetchone()
-        if price is None:
-            log.error('no price found for {}'.format(unit))
-            continue
-        prices[unit] = [
-            round(float(price['price']), 8),
-            round(1/float(price['price']), 8)
-        ]
-    # get the latest stats from the database using jsonb
-    db.execute("SELECT * FROM stats ORDER BY id DESC LIMIT 1")
-    stats_data = db.fetchone()
-    if not stats_data:
-        return {'status': False, 'message': 'no statistics exist yet.'}
+    document = status_document.get(config.get_int(app, 'status.max_age', 60))
+    if document is None:
+        # nothing has been credited by this process recently so use the last round
+        with database.connection(app) as conn:
+            db = conn.cursor()
+            db.execute("SELECT meta, totals, rewards FROM stats ORDER BY id DESC LIMIT 1")
+            stats_data = db.fetchone()
+            if not stats_data:
+                return {'status': False, 'message': 'no statistics exist yet.'}
+            sections = {'meta': stats_data[0], 'totals': stats_data[1],
+                        'rewards': stats_data[2]}
+            # the current round totals are only known if they are kept as orders are
+            # saved
+            if config.get_bool(app, 'credit.running_totals'):
+                sections['current'] = {'totals': credit.get_running_totals(app, db)}
+        units = app.config['pool'].units
+        sections['prices'] = price_section(units, dict(
+            (unit, price_cache.get(app, unit)) for unit in units))
+        document = status_document.update(**sections)
+    response.set_header('ETag', document.etag)
+    response.set_header('Last-Modified', http_date(document.last_modified))
+    response.set_header('Vary', 'Accept-Encoding')
+    if_none_match = request.get_header('If-None-Match')
+    if_modified_since = parse_date(request.get_header('If-Modified-Since', ''))
+    if etag_matches(if_none_match, document.etag) or (
+            if_none_match is None and if_modified_since and
+            if_modified_since >= document.last_modified):
+        response.status = 304
+        return ''
     response.set_header('Content-Type', 'application/json')
-    return json.dumps(
-        {
-            'status': True,
-            'message': {
-                'meta': stats_data['meta'],
-                'totals': stats_data['totals'],
-                'rewards': stats_data['rewards'],
-                'prices': prices
-            },
-            'server_time': int(time.time()),
-            'server_up_time': int((time.time() - app.config['start_time']))
-        },
-        sort_keys=True
-    )
+    gzip = (config.get_bool(app, 'status.gzip') and
+            'gzip' in request.get_header('Accept-Encoding', ''))
+    if gzip:
+        response.set_header('Content-Encoding', 'gzip')
+    return document.render(int(time.time()),
+                           int((time.time() - app.config['start_time'])),
+                           gzip=gzip)
+
+
+# the columns of each order in the order history
+ORDER_COLUMNS = ['id', 'order_id', 'exchange', 'unit', 'side', 'rank', 'order_amount',
+                 'order_price', 'server_price', 'deviation', 'tolerance', 'credited',
+                 'credit_time', 'credit_percentage', 'credit_reward']
+
+
+def orders_query(user, before_id=None, after_id=None, limit=None):
+    """
+    Build the query for a page of a users orders along with the credit for each.
+    Pages are found by order id so they don't get slower further back in the history
+    :param user:
+    :param before_id: only orders older than this one
+    :param after_id: only orders newer than this one
+    :param limit: the number of orders to return
+    :return: tuple of the sql and its parameters
+    """
+    sql = ("SELECT o.id,o.order_id,o.exchange,o.unit,o.side,o.rank,o.order_amount,"
+           "o.order_price,o.server_price,o.deviation,o.tolerance,o.credited,"
+           "c.time AS credit_time,c.percentage AS credit_percentage,"
+           "c.reward AS credit_reward FROM orders AS o LEFT JOIN LATERAL (SELECT "
+           "time,percentage,reward FROM credits WHERE order_id=o.id AND "
+           "o.credited=1 LIMIT 1) AS c ON TRUE WHERE o.key=%s")
+    params = [user]
+    if before_id is not None:
+        sql += " AND o.id<%s"
+        params.append(before_id)
+    if after_id is not None:
+        sql += " AND o.id>%s"
+        params.append(after_id)
+    # walk forwards from after_id, otherwise back from the newest order
+    sql += " ORDER BY o.id {}".format('ASC' if ascending(before_id, after_id) else 'DESC')
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, tuple(params)
+
+
+def ascending(before_id, after_id):
+    """
+    Pages after an order are listed oldest first, all others newest first
+    :param before_id:
+    :param after_id:
+    :return: bool
+    """
+    return after_id is not None and before_id is None
+
+
+# each export holds a pooled connection for as long as the client takes to read it so
+# only a few can run at once, leaving the rest of the pool for everything else
+export_slots = BoundedSemaphore(max(1, min(config.get_int(app, 'orders.max_exports', 2),
+                                           config.get_int(app, 'db.max_connections',
+                                                          10) - 1)))
+
+
+def stream_orders(user, before_id, after_id, limit, output_format):
+    """
+    Write a users orders as JSON lines or CSV as they are read from a server side
+    cursor. The export uses its own connection so that it can run for as long as the
+    client takes to read it. If too many exports are running the response is a 503
+    :param user:
+    :param before_id:
+    :param after_id:
+    :param limit:
+    :param output_format: jsonl or csv
+    :return: generator of response chunks
+    """
+    # bottle reads the first chunk before sending the headers so the error can still
+    # be returned from here
+    if not export_slots.acquire(False):
+        log.warn('/%s/orders export refused as too many are running', user)
+        abort(503, 'too many exports are running. try again later')
+    try:
+        chunk_size = config.get_int(app, 'orders.chunk_size', 1000)
+        with database.connection(app) as conn:
+            cursor = conn.cursor(name='user_orders')
+            cursor.itersize = chunk_size
+            cursor.execute(*orders_query(user, before_id, after_id, limit))
+            if output_format == 'csv':
+                yield ','.join(ORDER_COLUMNS) + '\r\n'
+            while True:
+                orders = cursor.fetchmany(chunk_size)
+                if not orders:
+                    break
+                chunk = StringIO()
+                if output_format == 'csv':
+                    csv.writer(chunk).writerows(orders)
+                else:
+                    for order in orders:
+                        chunk.write(json.dumps(dict(zip(ORDER_COLUMNS, order))) + '\n')
+                yield chunk.getvalue()
+            cursor.close()
+    finally:
+        export_slots.release()
 
 
 @app.get('/<user>/orders')
 def user_orders(db, user):
     """
-    Get the users order history
+    Get the users order history.
+    Pages are chosen with before_id or after_id and limit. The format can be json or,
+    to export up to max_export orders at once, jsonl or csv which are streamed
     :param db:
     :return:
     """
@@ -417,53 +532,87 @@ def user_orders(db, user):
     if exists is None:
         log.error('user %s does not exist', user)
         return {'success': False, 'message': 'user {} is not registered'.format(user)}
-    # fetch the users orders
-    db.execute("SELECT id,order_id,exchange,unit,side,rank,order_amount,order_price,"
-               "server_price,deviation,tolerance,credited FROM orders WHERE key=%s ORDER "
-               "BY id DESC LIMIT 100", (user,))
+    # read the paging parameters
+    output_format = request.query.get('format', 'json')
+    if output_format not in ['json', 'jsonl', 'csv']:
+        return {'success': False, 'message': 'format must be json, jsonl or csv'}
+    paging = {}
+    for param in ['before_id', 'after_id', 'limit']:
+        if request.query.get(param) is None:
+            paging[param] = None
+            continue
+        try:
+            paging[param] = int(request.query.get(param))
+        except ValueError:
+            return {'success': False, 'message': '{} must be a number'.format(param)}
+    if paging['limit'] is not None and paging['limit'] < 1:
+        return {'success': False, 'message': 'limit must be at least 1'}
+    # stream exports rather than building them in memory. exports are capped too
+    # but much higher than pages. longer histories are exported in parts
+    if output_format != 'json':
+        max_export = config.get_int(app, 'orders.max_export', 100000)
+        log.info('/%s/orders exported as %s', user, output_format)
+        if output_format == 'csv':
+            response.set_header('Content-Type', 'text/csv')
+            response.set_header('Content-Disposition',
+                                'attachment; filename="{}-orders.csv"'.format(user))
+        else:
+            response.set_header('Content-Type', 'application/x-ndjson')
+        return stream_orders(user, paging['before_id'], paging['after_id'],
+                             min(paging['limit'] or max_export, max_export),
+                             output_format)
+    # pages are capped in size
+    limit = min(paging['limit'] or 100, config.get_int(app, 'orders.max_limit', 1000))
+    # fetch the users orders along with the credit for each
+    db.execute(*orders_query(user, paging['before_id'], paging['after_id'], limit))
     orders = db.fetchall()
+    # get the stats of the rounds the orders were credited in
+    rounds = round_stats.get(db, [order['credit_time'] for order in orders
+                                  if order['credit_time'] is not None])
     # build a list for the order output
     output_orders = []
     # parse the orders
     for order in orders:
-        # get credit detail if the order has been credited
-        if order['credited'] == 1:
-            db.execute("SELECT time,percentage,reward FROM credits WHERE "
-                       "order_id=%s", (order['id'],))
-            cred = db.fetchone()
-            order['credit_info'] = {'credited_time': int(cred['time']),
-                                    'percentage_of_rank': round(cred['percentage'], 8),
-                                    'credit_amount': round(cred['reward'], 8)}
-            # get other details from the stats table
-            db.execute("SELECT totals->'{ex}'->'{unit}'->'total' as unit_total, "
-                       "config->'{ex}'->'{unit}'->'target' as unit_target, "
-                       "config->'{ex}'->'{unit}'->'reward' as unit_reward, "
-                       "config->'{ex}'->'{unit}'->'{side}'->'ratio' as side_ratio, "
-                       "totals->'{ex}'->'{unit}'->'{side}'->'{rank}' as rank_total, "
-                       "config->'{ex}'->'{unit}'->'{side}'->'{rank}'->'ratio' as "
-                       "rank_ratio, "
-                       "rewards->'{ex}'->'{unit}'->'{side}'->'{rank}' as rank_reward "
-                       "FROM stats WHERE time=%s".format(ex=order['exchange'],
-                                                         unit=order['unit'],
-                                                         side=order['side'],
-                                                         rank=order['rank']),
-                       (order['credit_info']['credited_time'], ))
-            stats = db.fetchone()
-            order['credit_info']['unit_total_liquidity'] = stats['unit_total']
-            order['credit_info']['unit_target'] = stats['unit_target']
-            order['credit_info']['unit_reward'] = stats['unit_reward']
-            unit_ratio = stats['unit_total'] / stats['unit_target']
+        credit_time = order.pop('credit_time')
+        percentage = order.pop('credit_percentage')
+        reward = order.pop('credit_reward')
+        # add the credit detail if the order has been credited
+        if credit_time is not None:
+            order['credit_info'] = {'credited_time': int(credit_time),
+                                    'percentage_of_rank': round(percentage, 8),
+                                    'credit_amount': round(reward, 8)}
+            # get other details from the round stats
+            stats = rounds.get(credit_time)
+            if stats is None:
+                output_orders.append(order)
+                continue
+            unit_totals = stats['totals'][order['exchange']][order['unit']]
+            unit_config = stats['config'][order['exchange']][order['unit']]
+            side_config = unit_config[order['side']]
+            order['credit_info']['unit_total_liquidity'] = unit_totals['total']
+            order['credit_info']['unit_target'] = unit_config['target']
+            order['credit_info']['unit_reward'] = unit_config['reward']
+            unit_ratio = unit_totals['total'] / unit_config['target']
             unit_ratio = 1.0 if unit_ratio >= 1.0 else unit_ratio
-            order['credit_info']['calculated_unit_reward'] = stats['unit_'
-                                                                   'reward'] * unit_ratio
-            order['credit_info']['side_ratio'] = stats['side_ratio']
+            order['credit_info']['calculated_unit_reward'] = unit_config['reward'] * \
+                unit_ratio
+            order['credit_info']['side_ratio'] = side_config['ratio']
             order['credit_info']['side_reward'] = order['credit_info'][
-                'calculated_unit_reward'] * stats['side_ratio']
-            order['credit_info']['rank_total_liquidity'] = stats['rank_total']
-            order['credit_info']['rank_reward'] = stats['rank_reward']
-            order['credit_info']['rank_ratio'] = stats['rank_ratio']
+                'calculated_unit_reward'] * side_config['ratio']
+            order['credit_info']['rank_total_liquidity'] = unit_totals[order['side']][
+                order['rank']]
+            order['credit_info']['rank_reward'] = stats['rewards'][order['exchange']][
+                order['unit']][order['side']][order['rank']]
+            order['credit_info']['rank_ratio'] = side_config[order['rank']]['ratio']
         output_orders.append(order)
-    return {'success': True, 'message': output_orders, 'server_time': int(time.time())}
+    output = {'success': True, 'message': output_orders, 'server_time': int(time.time())}
+    # tell the client where the next page starts
+    if len(orders) == limit:
+        if ascending(paging['before_id'], paging['after_id']):
+            output['next'] = {'after_id': orders[-1]['id']}
+        else:
+            output['next'] = {'before_id': orders[-1]['id']}
+    return output
 
 
 @app.get('/<user>/stats')
@@ -491,30 +640,22 @@ def user_credits(db, user):
     user_stats = {'total_reward': 0.0,
                   'current_reward': 0.0,
                   'history': []}
-    # get the total reward
-    db.execute("SELECT SUM(reward) FROM credits WHERE key=%s", (user,))
-    total = db.fetchone()
-    if total['sum'] is not None:
-        user_stats['total_reward'] = round(float(total['sum']), 8)
-    # get the current reward
-    db.execute("SELECT SUM(reward) FROM credits WHERE key=%s AND paid=0", (user,))
-    current = db.fetchone()
-    if current['sum'] is not None:
-        user_stats['current_reward'] = round(float(current['sum']), 8)
-    # calculate the last 10 round net worth for this user
-    db.execute("SELECT DISTINCT time FROM credits ORDER BY time DESC LIMIT 50")
-    last_rounds = db.fetchall()
-    for round_time in last_rounds:
-        db.execute("SELECT SUM(provided) AS provided, SUM(reward) AS reward FROM credits "
-                   "WHERE key=%s AND "
-                   "time=%s", (user, round_time['time']))
-        worth = db.fetchone()
-        if worth is not None:
-            round_worth = {'round_time': int(round_time['time']),
-                           'provided': 0.0 if worth['provided'] is None
-                           else worth['provided'],
-                           'reward': 0.0 if worth['reward'] is None else worth['reward']}
-            user_stats['history'].append(round_worth)
+    # get the total and unpaid reward from the users balance
+    db.execute("SELECT earned, unpaid FROM balances WHERE key=%s", (user,))
+    balance = db.fetchone()
+    if balance is not None:
+        user_stats['total_reward'] = round(float(balance['earned']), 8)
+        user_stats['current_reward'] = round(float(balance['unpaid']), 8)
+    # calculate the last 50 round net worth for this user
+    db.execute("SELECT r.time, u.provided, u.reward FROM (SELECT DISTINCT time FROM "
+               "user_rounds ORDER BY time DESC LIMIT 50) AS r LEFT JOIN user_rounds AS u "
+               "ON u.time=r.time AND u.key=%s ORDER BY r.time DESC", (user,))
+    for worth in db.fetchall():
+        round_worth = {'round_time': int(worth['time']),
+                       'provided': 0.0 if worth['provided'] is None
+                       else worth['provided'],
+                       'reward': 0.0 if worth['reward'] is None else worth['reward']}
+        user_stats['history'].append(round_worth)
     return {'success': True, 'message': user_stats, 'server_time': int(time.time())}
 
 
@@ -546,6 +687,14 @@ def error405(error):
                                                     '{}'.format(error)})
 
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    Handle each request in its own thread so long exports don't hold up other requests
+    """
+    daemon_threads = True
+
+
 if __name__ == '__main__':
     # Run the server
-    run(server, host='localhost', port=int(os.environ.get("PORT", 3333)), debug=True)
+    run(server, host='localhost', port=int(os.environ.get("PORT", 3333)), debug=True,
+        server_class=ThreadingWSGIServer)
@@ -0,0 +1,121 @@
+__author__ = 'sammoth'
+
+"""
+The balances table is a ledger of the reward each user has earned and not yet been
+paid. The credit round adds to it in the same transaction as it writes the credits and
+the payout settles it in the same transaction as it marks the credits as paid, so it can
+be read instead of summing the credits.
+check() derives the balances from the credits again to make sure the two agree.
+Credits dropped by the retention job are added to the archived column of the ledger
+first so that they are still counted.
+A key can be registered with more than one address, for different exchanges or units.
+Its balance is paid to the address it was registered with first. The credits used to be
+joined to every registration of the key, which paid the whole reward to each address.
+"""
+
+# the sum of the credits of each user, as the ledger should show it
+DERIVE_BALANCES = (
+    "SELECT c.key, (SELECT address FROM users WHERE key=c.key ORDER BY id LIMIT 1), "
+    "SUM(c.reward), SUM(CASE WHEN c.paid=0 THEN c.reward ELSE 0 END) FROM credits AS c "
+    "WHERE EXISTS (SELECT 1 FROM users WHERE key=c.key) GROUP BY c.key"
+)
+
+
+def update(db, last_credit_id):
+    """
+    Add the credits of a round to the balances
+    :param db:
+    :param last_credit_id: the id of the last credit written before the round
+    :return:
+    """
+    db.execute("INSERT INTO balances (key,address,earned,unpaid,paid) SELECT c.key, "
+               "(SELECT address FROM users WHERE key=c.key ORDER BY id LIMIT 1), "
+               "SUM(c.reward), SUM(c.reward), 0 FROM credits AS c WHERE c.id>%s AND "
+               "EXISTS (SELECT 1 FROM users WHERE key=c.key) GROUP BY c.key ON CONFLICT "
+               "(key) DO UPDATE SET earned=balances.earned+EXCLUDED.earned, "
+               "unpaid=balances.unpaid+EXCLUDED.unpaid", (last_credit_id,))
+
+
+def unpaid(db):
+    """
+    Get the balances waiting to be paid.
+    The rows are locked until the transaction ends so a credit round can't add to them
+    while they are being paid
+    :param db:
+    :return: list of (key, address, unpaid)
+    """
+    db.execute("SELECT key, address, unpaid FROM balances WHERE unpaid>0 ORDER BY key "
+               "FOR UPDATE")
+    return db.fetchall()
+
+
+def settle(db, keys, paid_time):
+    """
+    Mark the credits and balances of the given users as paid
+    :param db:
+    :param keys: the keys of the users who have been paid
+    :param paid_time:
+    :return:
+    """
+    db.execute("UPDATE credits SET paid=1 WHERE paid=0 AND key=ANY(%s)", (keys,))
+    db.execute("UPDATE balances SET paid=paid+unpaid, unpaid=0, last_paid=%s WHERE "
+               "key=ANY(%s)", (paid_time, keys))
+
+
+def archive(db, table):
+    """
+    Add the rewards of a table of paid credits to the archived balances before the table
+    is dropped
+    :param db:
+    :param table: the name of a partition of the credits table
+    :return:
+    """
+    db.execute("UPDATE balances AS b SET archived=b.archived+c.reward FROM (SELECT key, "
+               "SUM(reward) AS reward FROM {} GROUP BY key) AS c WHERE "
+               "b.key=c.key".format(table))
+
+
+def check(db, tolerance=0.00000001):
+    """
+    Derive the balances from the credits and compare them with the ledger
+    :param db:
+    :param tolerance: the largest difference which is put down to rounding
+    :return: list of (key, ledger (earned, unpaid), derived (earned, unpaid)) for each
+    user whose balance is wrong
+    """
+    db.execute("SELECT key, earned, unpaid, archived FROM balances")
+    ledger = {}
+    archived = {}
+    for row in db.fetchall():
+        ledger[row[0]] = (row[1], row[2])
+        archived[row[0]] = row[3]
+    db.execute(DERIVE_BALANCES)
+    derived = dict((row[0], (row[2], row[3])) for row in db.fetchall())
+    for key in archived:
+        if archived[key] > 0:
+            earned, unpaid = derived.get(key, (0.0, 0.0))
+            derived[key] = (earned + archived[key], unpaid)
+    wrong = []
+    for key in sorted(set(ledger) | set(derived)):
+        ledger_balance = ledger.get(key, (0.0, 0.0))
+        derived_balance = derived.get(key, (0.0, 0.0))
+        if abs(ledger_balance[0] - derived_balance[0]) > tolerance or \
+                abs(ledger_balance[1] - derived_balance[1]) > tolerance:
+            wrong.append((key, ledger_balance, derived_balance))
+    return wrong
+
+
+def rebuild(db):
+    """
+    Replace the ledger with the balances derived from the credits.
+    The archived rewards are kept
+    :param db:
+    :return:
+    """
+    db.execute("DELETE FROM balances WHERE archived=0")
+    db.execute("UPDATE balances SET earned=archived, unpaid=0, paid=archived")
+    db.execute("INSERT INTO balances (key,address,earned,unpaid,paid) SELECT key, "
+               "address, earned, unpaid, earned-unpaid FROM ({}) AS derived (key,address,"
+               "earned,unpaid) ON CONFLICT (key) DO UPDATE SET address=EXCLUDED.address, "
+               "earned=balances.earned+EXCLUDED.earned, unpaid=EXCLUDED.unpaid, "
+               "paid=balances.paid+EXCLUDED.paid".format(DERIVE_BALANCES))
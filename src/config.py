@@ -1,34 +1,126 @@
 import ConfigParser
 import json
-from os import listdir
-from os.path import isfile, join, splitext
+from bisect import bisect_left
+from collections import OrderedDict
+from hashlib import sha1
+from os import listdir, stat
+from os.path import isdir, isfile, join, splitext
+from threading import Lock
+
+from bottle import ConfigDict
 import utils
 
 __author__ = 'sammoth'
 
+# config installs are made one at a time
+install_lock = Lock()
+
 
 def load(app, log, config_dir, log_output):
     """
-    Helper method to load pool config
+    Helper method to load pool config.
+    The config is built and checked in full before it replaces the current one, so
+    request threads only ever see a complete config
     :param config_dir:
     :param log_output:
     :param app:
     :param log:
+    :return: True if the config was loaded
+    """
+    # take the fingerprint first so that changes made while loading are picked up
+    # next time
+    config_fingerprint = fingerprint(config_dir)
+    snapshot = build(log, config_dir, log_output)
+    if snapshot is None:
+        return False
+    snapshot['config_fingerprint'] = config_fingerprint
+    install(app, snapshot)
+    return True
+
+
+def reload(app, log, log_output=False):
+    """
+    Load the config again if any of the files have changed since it was last loaded
+    :param app:
+    :param log:
+    :param log_output:
+    :return: True if the config was reloaded
+    """
+    config_dir = app.config['config_dir']
+    if fingerprint(config_dir) == app.config.get('config_fingerprint'):
+        return False
+    log.info('config has changed. reloading')
+    return load(app, log, config_dir, log_output)
+
+
+def fingerprint(config_dir):
+    """
+    Get the modification time and size of each config file
+    :param config_dir:
+    :return: tuple of (file, mtime, size)
+    """
+    files = [join(config_dir, 'pool_config')]
+    exchange_dir = join(config_dir, 'exchanges')
+    if isdir(exchange_dir):
+        for exchange_file in sorted(listdir(exchange_dir)):
+            if splitext(exchange_file)[1] == '.json':
+                files.append(join(exchange_dir, exchange_file))
+    details = []
+    for config_file in files:
+        try:
+            file_stat = stat(config_file)
+        except OSError:
+            continue
+        details.append((config_file, file_stat.st_mtime, file_stat.st_size))
+    return tuple(details)
+
+
+def install(app, snapshot):
+    """
+    Bring the app's config up to date with a newly built one.
+    The app's ConfigDict is updated in place so that its change hooks, and the route
+    configs which overlay it, carry on working. Each value is replaced whole and the
+    pool is built in full beforehand, so readers never see a half-built pool.
+    Values which didn't come from the config files, such as the server start time,
+    are kept
+    :param app:
+    :param snapshot: the new ConfigDict
     :return:
     """
-    app.config['config_dir'] = config_dir
+    with install_lock:
+        current = app.config
+        stale = [key for key in current.get('config_keys', ()) if key not in snapshot]
+        # only the values which have changed are set, so hooks hear of real changes
+        current.update(dict((key, value) for key, value in snapshot.iteritems()
+                            if key not in current or current[key] != value))
+        # keys are only removed once their replacements are in place
+        for key in stale:
+            if key in current:
+                del current[key]
+
+
+def build(log, config_dir, log_output):
+    """
+    Read and check the pool config and exchange configs
+    :param log:
+    :param config_dir:
+    :param log_output:
+    :return: the new ConfigDict or None if the config isn't valid
+    """
     pool_check = check_pool_config(join(config_dir, 'pool_config'))
     if not pool_check[0]:
         log.error('Pool config check failed: {}'.format(pool_check[1]))
-        return
+        return None
+    conf = ConfigDict()
+    conf['config_dir'] = config_dir
     if log_output:
         log.info('load pool config')
-    app.config.load_config(join(config_dir, 'pool_config'))
+    conf.load_config(join(config_dir, 'pool_config'))
     if log_output:
         log.info('load exchanges config(s)')
-    app.config['exchanges'] = []
-    app.config['units'] = []
-    for exchange_file in listdir(join(config_dir, 'exchanges')):
+    conf['exchanges'] = []
+    conf['units'] = []
+    for exchange_file in sorted(listdir(join(config_dir, 'exchanges'))):
         if not isfile(join(config_dir, 'exchanges', exchange_file)):
             continue
         filename, file_extension = splitext(join(config_dir, 'exchanges', exchange_file))
@@ -39,36 +131,216 @@ def load(app, log, config_dir, log_output):
         ))
         if not exchange_config_check[0]:
             log.error('Exchange config check failed: {}'.format(exchange_config_check[1]))
+            return None
         with open(join(config_dir, 'exchanges', exchange_file)) as exchange:
             exchange_dict = json.load(exchange)
-            app.config.load_dict(exchange_dict)
-
-            # we've loaded the raw configs using the bottle helpers
-            # now we need to parse out some lists from the exchange data
-            for ex in exchange_dict:
-                # build a list of supported exchanges
-                if ex not in app.config['exchanges']:
-                    app.config['exchanges'].append(ex)
-                    app.config['{}.units'.format(ex)] = []
-                for unit in exchange_dict[ex]:
-                    # build a list of supported units
-                    if unit not in app.config['units']:
-                        app.config['units'].append(unit)
-                    # and a list of units supported on each exchange
-                    app.config['{}.units'.format(ex)].append(unit)
-                    # lastly, add a list of ranks by side on each exchange.unit
-                    for side in ['ask', 'bid']:
-                        app.config['{}.{}.{}.ranks'.format(ex, unit, side)] = []
-                        for rank in exchange_dict[ex][unit][side]:
-                            if rank == 'ratio':
-                                continue
-                            if rank not in app.config['{}.{}.{}.ranks'.format(ex,
-                                                                              unit,
-                                                                              side)]:
-                                app.config['{}.{}.{}.ranks'.format(ex,
-                                                                   unit,
-                                                                   side)].append(rank)
-        exchange.close()
+        conf.load_dict(exchange_dict)
+
+        # we've loaded the raw configs using the bottle helpers
+        # now we need to parse out some lists from the exchange data
+        for ex in exchange_dict:
+            # build a list of supported exchanges
+            if ex not in conf['exchanges']:
+                conf['exchanges'].append(ex)
+                conf['{}.units'.format(ex)] = []
+            for unit in exchange_dict[ex]:
+                # skip the options which apply to the whole exchange
+                if unit in utils.exchange_options():
+                    continue
+                # build a list of supported units
+                if unit not in conf['units']:
+                    conf['units'].append(unit)
+                # and a list of units supported on each exchange
+                conf['{}.units'.format(ex)].append(unit)
+                # lastly, add a list of ranks by side on each exchange.unit
+                for side in ['ask', 'bid']:
+                    conf['{}.{}.{}.ranks'.format(ex, unit, side)] = []
+                    for rank in exchange_dict[ex][unit][side]:
+                        if rank == 'ratio':
+                            continue
+                        if rank not in conf['{}.{}.{}.ranks'.format(ex, unit, side)]:
+                            conf['{}.{}.{}.ranks'.format(ex, unit, side)].append(rank)
+    # build the typed config used by the server and credit round
+    conf['pool'] = compile_pool(conf)
+    # remember which values came from the files
+    conf['config_keys'] = frozenset(conf.keys() + ['config_keys', 'config_fingerprint'])
+    return conf
+
+
+class Pool(object):
+    """
+    The exchanges, units, sides and ranks of the loaded config as typed objects.
+    Built once when the config is loaded and not changed afterwards
+    """
+    __slots__ = ('exchanges', 'units', 'exchanges_body', 'exchanges_etag')
+
+    def __init__(self, exchanges):
+        """
+        :param exchanges: list of Exchange
+        """
+        self.exchanges = OrderedDict((ex.name, ex) for ex in exchanges)
+        units = []
+        for ex in exchanges:
+            for unit in ex.units:
+                if unit not in units:
+                    units.append(unit)
+        self.units = tuple(units)
+        # the /exchanges response only changes with the config so serialise it now
+        self.exchanges_body = json.dumps(self.describe(), sort_keys=True)
+        self.exchanges_etag = '"{}"'.format(sha1(self.exchanges_body).hexdigest())
+
+    def describe(self):
+        """
+        Show the config as it pertains to the supported exchanges
+        :return: dict
+        """
+        data = {}
+        for ex in self.exchanges.itervalues():
+            data[ex.name] = {}
+            for u in ex.units.itervalues():
+                data[ex.name][u.name] = {
+                    'reward': u.reward,
+                    'target': u.target
+                }
+                for side in [u.ask, u.bid]:
+                    data[ex.name][u.name][side.name] = {'ratio': u.ask.ratio}
+                    for rank in side.ranks:
+                        data[ex.name][u.name][side.name][rank.name] = {
+                            'ratio': rank.ratio,
+                            'tolerance': rank.tolerance
+                        }
+        return data
+
+    def unit(self, exchange, unit):
+        """
+        Get the details of a unit on an exchange
+        :param exchange:
+        :param unit:
+        :return: Unit or None if the unit isn't supported on the exchange
+        """
+        if exchange not in self.exchanges:
+            return None
+        return self.exchanges[exchange].units.get(unit)
+
+
+class Exchange(object):
+    """
+    An exchange supported by the pool and its units
+    """
+    __slots__ = ('name', 'pool_size', 'units')
+
+    def __init__(self, name, pool_size, units):
+        """
+        :param name:
+        :param pool_size: the number of connections kept to the exchange API
+        :param units: list of Unit
+        """
+        self.name = name
+        self.pool_size = pool_size
+        self.units = OrderedDict((unit.name, unit) for unit in units)
+
+
+class Unit(object):
+    """
+    A unit on an exchange with its reward and target and the details of each side
+    """
+    __slots__ = ('name', 'reward', 'target', 'reverse', 'ask', 'bid', 'sides')
+
+    def __init__(self, name, reward, target, reverse, ask, bid):
+        self.name = name
+        self.reward = reward
+        self.target = target
+        self.reverse = reverse
+        self.ask = ask
+        self.bid = bid
+        self.sides = {'ask': ask, 'bid': bid}
+
+
+class Side(object):
+    """
+    One side of a unit on an exchange.
+    The ranks are sorted by ascending tolerance and their tolerances and ratios are kept
+    in aligned tuples for ranking orders
+    """
+    __slots__ = ('name', 'ratio', 'ranks', 'rank_names', 'tolerances', 'rank_ratios')
+
+    def __init__(self, name, ratio, ranks):
+        """
+        :param name: ask or bid
+        :param ratio: the share of the unit reward given to this side
+        :param ranks: list of Rank
+        """
+        self.name = name
+        self.ratio = ratio
+        self.ranks = tuple(sorted(ranks, key=lambda rank: rank.tolerance))
+        self.rank_names = tuple(rank.name for rank in self.ranks)
+        self.tolerances = tuple(rank.tolerance for rank in self.ranks)
+        self.rank_ratios = tuple(rank.ratio for rank in self.ranks)
+
+    def rank(self, deviation):
+        """
+        Find the rank of an order using its deviation from the known good price
+        :param deviation:
+        :return: tuple of rank and tolerance. The rank is '' if no tolerance is wide
+        enough
+        """
+        index = bisect_left(self.tolerances, deviation)
+        if index < len(self.ranks):
+            return self.rank_names[index], self.tolerances[index]
+        return '', self.tolerances[-1] if self.tolerances else 1.00
+
+
+class Rank(object):
+    """
+    A rank on one side of a unit.
+    share is the reward given to the rank when the unit target is met
+    """
+    __slots__ = ('name', 'tolerance', 'ratio', 'share')
+
+    def __init__(self, name, tolerance, ratio, share):
+        self.name = name
+        self.tolerance = tolerance
+        self.ratio = ratio
+        self.share = share
+
+
+def compile_pool(conf):
+    """
+    Build the Pool object from the loaded config
+    :param conf: the ConfigDict being built
+    :return: Pool
+    """
+    exchanges = []
+    for ex in conf['exchanges']:
+        units = []
+        for unit in conf['{}.units'.format(ex)]:
+            reward = float(conf['{}.{}.reward'.format(ex, unit)])
+            sides = {}
+            for side in ['ask', 'bid']:
+                side_ratio = float(conf['{}.{}.{}.ratio'.format(ex, unit, side)])
+                ranks = []
+                for rank in conf['{}.{}.{}.ranks'.format(ex, unit, side)]:
+                    rank_ratio = float(conf['{}.{}.{}.{}.ratio'.format(ex, unit, side,
+                                                                       rank)])
+                    ranks.append(Rank(
+                        name=rank,
+                        tolerance=float(conf.get('{}.{}.{}.{}.tolerance'.format(
+                            ex, unit, side, rank), 1.00)),
+                        ratio=rank_ratio,
+                        share=(reward * side_ratio) * rank_ratio
+                    ))
+                sides[side] = Side(side, side_ratio, ranks)
+            units.append(Unit(
+                name=unit,
+                reward=reward,
+                target=float(conf['{}.{}.target'.format(ex, unit)]),
+                reverse=bool(conf['{}.{}.reverse'.format(ex, unit)]),
+                ask=sides['ask'],
+                bid=sides['bid']
+            ))
+        exchanges.append(Exchange(ex, int(conf.get('{}.pool_size'.format(ex), 10)),
+                                  units))
+    return Pool(exchanges)
 
 
 def check_pool_config(config_file):
@@ -112,7 +384,16 @@ def check_exchange_config(config_file):
         # check that the exchange is supported
         if ex not in utils.supported_exchanges():
             return False, '{} is not a supported exchange'.format(ex)
+        # ensure the connection pool size is a positive number if it is set. json true
+        # and false are ints to python so they are ruled out first
+        if 'pool_size' in config[ex]:
+            if isinstance(config[ex]['pool_size'], bool) or \
+                    not isinstance(config[ex]['pool_size'], int) or \
+                    config[ex]['pool_size'] <= 0:
+                return False, 'The pool_size set for {} is incorrect'.format(ex)
         for unit in config[ex]:
+            if unit in utils.exchange_options():
+                continue
             # make sure the unit section has a reward
             if 'reward' not in config[ex][unit]:
                 return False, 'There is no reward set for {}.{}'.format(ex, unit)
@@ -152,3 +433,32 @@ def check_exchange_config(config_file):
 
     return True, 'All complete'
 
+
+def get_bool(app, key, default=False):
+    """
+    Read an optional true/false value from the pool config
+    :param app:
+    :param key:
+    :param default:
+    :return:
+    """
+    value = app.config.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ['true', 'yes', 'on', '1']
+
+
+def get_int(app, key, default):
+    """
+    Read an optional integer value from the pool config
+    :param app:
+    :param key:
+    :param default:
+    :return:
+    """
+    value = app.config.get(key)
+    if value is None:
+        return default
+    return int(value)
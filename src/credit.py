@@ -3,8 +3,9 @@ import time
 from threading import Timer, Thread
 
 import database
+import psycopg2.extras
 from bitcoinrpc.authproxy import JSONRPCException
-from src import config
+from src import balances, config, stats
 from src.utils import get_rpc
 
 __author__ = 'sammoth'
@@ -42,40 +43,138 @@ def credit(app, log):
 
     log_output = False
 
-    # reload the config
-    config.load(app, log, app.config['config_dir'], log_output)
+    # reload the config if it has changed
+    config.reload(app, log)
 
     # calculate the credit time
     credit_time = int(time.time())
 
-    conn = database.get_db(app)
-    db = conn.cursor()
+    running_totals = config.get_bool(app, 'credit.running_totals')
+
+    with database.connection(app) as conn:
+        db = conn.cursor()
+        # every statement of the round works from the same snapshot so that orders
+        # committed while it runs are left for the next round
+        db.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        if running_totals:
+            # hold back newly validated orders until this round's totals are taken
+            db.execute("LOCK TABLE liquidity_totals IN EXCLUSIVE MODE")
+        # only the orders which have arrived by now are part of this round
+        db.execute("SELECT COALESCE(MAX(id), 0) FROM orders")
+        watermark = db.fetchone()[0]
+        # store the credit time in the info table
+        db.execute("UPDATE info SET value=%s WHERE key=%s", (
+            credit_time,
+            'last_credit_time'
+        ))
+
+        # set up for some stats
+        # build the blank meta stats object
+        meta = {'last-credit-time': credit_time,
+                'number-of-users-active': 0,
+                'number-of-orders': 0,
+                'number-of-duplicates': 0}
+        db.execute("SELECT value FROM info WHERE key=%s", ('next_payout_time',))
+        meta['next-payout-time'] = int(db.fetchone()[0])
+        db.execute("SELECT COUNT(id) FROM users")
+        meta['number-of-users'] = int(db.fetchone()[0])
+        # the credits written after this one are this round's
+        db.execute("SELECT COALESCE(MAX(id), 0) FROM credits")
+        last_credit_id = db.fetchone()[0]
+
+        # orders of ranks the pool no longer rewards can't be credited. mark them so
+        # that they are left out of this and every later round
+        unknown = skip_unknown_ranks(app, db, watermark)
+        if unknown > 0:
+            log.warn('%s orders will not be credited as their rank is unknown', unknown)
+
+        # calculate the totals and rewards and credit the orders
+        if running_totals:
+            totals, rewards = credit_orders_sql(app, log, db, credit_time, watermark,
+                                                meta, take_running_totals(app, db))
+        elif app.config.get('credit.aggregation', 'python') == 'sql':
+            totals, rewards = credit_orders_sql(app, log, db, credit_time, watermark,
+                                                meta)
+        elif config.get_bool(app, 'credit.stream'):
+            totals, rewards = credit_orders_stream(app, log, db, credit_time, watermark,
+                                                   meta)
+        else:
+            totals, rewards = credit_orders(app, log, db, credit_time, watermark, meta)
+        if meta['number-of-orders'] > 0:
+            log_output = True
+        if meta['number-of-duplicates'] > 0:
+            log.info('%s duplicate orders found', meta['number-of-duplicates'])
+
+        # summarise the round for each user and add it to their balance
+        summarise_round(db, credit_time)
+        try:
+            balances.update(db, last_credit_id)
+        except psycopg2.extensions.TransactionRollbackError as e:
+            # a payout has changed the balances since the round began. the orders are
+            # left as they were to be credited by the next round
+            conn.rollback()
+            log.warn('credit round abandoned: %s', e)
+            return
+
+        # write the stats to the database
+        stats_config = {}
+        for ex in app.config['pool'].exchanges.itervalues():
+            stats_config[ex.name] = {}
+            for unit in ex.units.itervalues():
+                stats_config[ex.name][unit.name] = {
+                    'target': unit.target,
+                    'reward': unit.reward
+                }
+                for side in [unit.ask, unit.bid]:
+                    stats_config[ex.name][unit.name][side.name] = {'ratio': side.ratio}
+                    for rank in side.ranks:
+                        stats_config[ex.name][unit.name][side.name][rank.name] = {
+                            'ratio': rank.ratio
+                        }
+
+        db.execute("INSERT INTO stats (time,meta,totals,rewards,config) VALUES (%s,%s,%s,"
+                   "%s,%s)",
+                   (credit_time, json.dumps(meta), json.dumps(totals),
+                    json.dumps(rewards), json.dumps(stats_config)))
+        conn.commit()
+    # rebuild the status document with this round
+    sections = {'meta': meta, 'totals': totals, 'rewards': rewards}
+    if running_totals:
+        sections['current'] = {'totals': blank_liquidity(app)}
+    stats.status_document.update(**sections)
+    if log_output:
+        log.info('End credit')
+    return
+
+
+def credit_orders(app, log, db, credit_time, watermark, meta):
+    """
+    Fetch the orders for the round and calculate the totals, rewards and credits in
+    memory
+    :param app:
+    :param log:
+    :param db:
+    :param credit_time:
+    :param watermark: the id of the last order in this round
+    :param meta: the meta stats object to update
+    :return: tuple of totals and rewards
+    """
+    # duplicates can be marked in the database before the orders are fetched
+    dedup_in_sql = app.config.get('credit.dedup', 'python') == 'sql'
+    if dedup_in_sql:
+        meta['number-of-duplicates'] = deduplicate_orders_sql(db, watermark)
     # Get all the orders from the database.
-    db.execute("SELECT * FROM orders WHERE credited=0")
+    db.execute("SELECT * FROM orders WHERE credited=0 AND id<=%s", (watermark,))
     all_orders = db.fetchall()
     if len(all_orders) > 0:
-        log_output = True
         log.info('Start credit')
-    # store the credit time in the info table
-    db.execute("UPDATE info SET value=%s WHERE key=%s", (
-        credit_time,
-        'last_credit_time'
-    ))
-
-    # set up for some stats
-    # build the blank meta stats object
-    meta = {'last-credit-time': credit_time,
-            'number-of-users-active': 0,
-            'number-of-orders': 0}
-    db.execute("SELECT value FROM info WHERE key=%s", ('next_payout_time',))
-    meta['next-payout-time'] = int(db.fetchone()[0])
-    db.execute("SELECT COUNT(id) FROM users")
-    meta['number-of-users'] = int(db.fetchone()[0])
-    # create a list of active users
-    active_users = []
 
     # de-duplicate the orders
-    deduped_orders = deduplicate_orders(all_orders, db)
+    if dedup_in_sql:
+        deduped_orders = all_orders
+    else:
+        deduped_orders = deduplicate_orders(all_orders, db)
+        meta['number-of-duplicates'] = len(all_orders) - len(deduped_orders)
 
     # calculate the liquidity totals
     totals = get_total_liquidity(app, deduped_orders)
@@ -86,65 +185,220 @@ def credit(app, log):
         kwargs={'app': app, 'totals': totals, 'log': log}
     ).start()
 
-    # calculate the round rewards based on percentages of target and ratios of side and
-    # rank
+    # calculate the round rewards based on percentages of target and ratios of side
+    # and rank
     rewards = calculate_reward(app, totals)
 
+    # create a set of active users
+    active_users = set()
+
     # parse the orders
+    credits = []
     for order in deduped_orders:
         # save some stats
         meta['number-of-orders'] += 1
         if order[1] not in active_users:
             meta['number-of-users-active'] += 1
-            active_users.append(order[1])
+            active_users.add(order[1])
         # calculate the details
         reward, percentage = calculate_order_reward(order, totals, rewards)
-        # and save to the database
-        db.execute(
+        credits.append((credit_time, order[1], order[8], order[9], order[2], order[5],
+                        order[0], order[4], (percentage * 100), reward, 0))
+    # save the credits to the database in bulk
+    psycopg2.extras.execute_values(
+        db,
+        "INSERT INTO credits (time,key,exchange,unit,rank,side,order_id,provided,"
+        "percentage,reward,paid) VALUES %s",
+        credits,
+        page_size=1000
+    )
+    # update the original orders too to indicate that they have been credited
+    db.execute("UPDATE orders SET credited=%s WHERE id = ANY(%s)",
+               (1, [order[0] for order in deduped_orders]))
+    return totals, rewards
+
+
+def credit_orders_stream(app, log, db, credit_time, watermark, meta):
+    """
+    Stream the orders for the round from a server side cursor in chunks so that memory
+    use doesn't depend on how many orders are waiting. The totals are calculated in a
+    first pass and the credits in a second. Both passes read the round's snapshot so
+    they see the same orders. Duplicates are marked in the database in this mode
+    :param app:
+    :param log:
+    :param db:
+    :param credit_time:
+    :param watermark: the id of the last order in this round
+    :param meta: the meta stats object to update
+    :return: tuple of totals and rewards
+    """
+    chunk_size = config.get_int(app, 'credit.chunk_size', 10000)
+    meta['number-of-duplicates'] = deduplicate_orders_sql(db, watermark)
+
+    # calculate the liquidity totals
+    totals = blank_liquidity(app)
+    active_users = set()
+    for orders in stream_orders(db, watermark, chunk_size):
+        if meta['number-of-orders'] == 0:
+            log.info('Start credit')
+        add_liquidity(totals, orders)
+        meta['number-of-orders'] += len(orders)
+        active_users.update(order[1] for order in orders)
+    meta['number-of-users-active'] = len(active_users)
+
+    # We've calculated the totals so submit them as liquidity_info
+    Thread(
+        target=liquidity_info,
+        kwargs={'app': app, 'totals': totals, 'log': log}
+    ).start()
+
+    # calculate the round rewards based on percentages of target and ratios of side
+    # and rank
+    rewards = calculate_reward(app, totals)
+
+    # credit the orders a chunk at a time
+    for orders in stream_orders(db, watermark, chunk_size):
+        credits = []
+        for order in orders:
+            reward, percentage = calculate_order_reward(order, totals, rewards)
+            credits.append((credit_time, order[1], order[8], order[9], order[2],
+                            order[5], order[0], order[4], (percentage * 100), reward, 0))
+        psycopg2.extras.execute_values(
+            db,
             "INSERT INTO credits (time,key,exchange,unit,rank,side,order_id,provided,"
-            "percentage,reward,paid) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-            (credit_time, order[1], order[8], order[9], order[2], order[5], order[0],
-             order[4], (percentage * 100), reward, 0)
+            "percentage,reward,paid) VALUES %s",
+            credits,
+            page_size=1000
         )
-        # update the original order too to indicate that it has been credited
-        db.execute("UPDATE orders SET credited=%s WHERE id=%s", (1, order[0]))
-
-    # write the stats to the database
-    stats_config = {}
-    for ex in app.config['exchanges']:
-        stats_config[ex] = {}
-        for unit in app.config['{}.units'.format(ex)]:
-            stats_config[ex][unit] = {
-                'target': app.config['{}.{}.target'.format(ex, unit)],
-                'reward': app.config['{}.{}.reward'.format(ex, unit)]
-            }
-            for side in ['ask', 'bid']:
-                stats_config[ex][unit][side] = {
-                    'ratio': app.config['{}.{}.{}.ratio'.format(
-                        ex,
-                        unit,
-                        side
-                    )]
-                }
-                for rank in app.config['{}.{}.{}.ranks'.format(ex, unit, side)]:
-                    stats_config[ex][unit][side][rank] = {
-                        'ratio': app.config['{}.{}.{}.{}.ratio'.format(
-                            ex,
-                            unit,
-                            side,
-                            rank
-                        )]
-                    }
-
-    db.execute("INSERT INTO stats (time,meta,totals,rewards,config) VALUES (%s,%s,%s,"
-               "%s,%s)",
-               (credit_time, json.dumps(meta), json.dumps(totals), json.dumps(rewards),
-                json.dumps(stats_config)))
-    conn.commit()
-    conn.close()
-    if log_output:
-        log.info('End credit')
-    return
+        # update the original orders too to indicate that they have been credited
+        db.execute("UPDATE orders SET credited=1 WHERE id = ANY(%s)",
+                   ([order[0] for order in orders],))
+    return totals, rewards
+
+
+def stream_orders(db, watermark, chunk_size):
+    """
+    Yield the orders waiting to be credited in chunks using a server side cursor
+    :param db:
+    :param watermark: the id of the last order in this round
+    :param chunk_size: the number of orders in each chunk
+    :return:
+    """
+    cursor = db.connection.cursor(name='credit_orders')
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute("SELECT * FROM orders WHERE credited=0 AND id<=%s ORDER BY id",
+                       (watermark,))
+        while True:
+            orders = cursor.fetchmany(chunk_size)
+            if not orders:
+                break
+            yield orders
+    finally:
+        cursor.close()
+
+
+def credit_orders_sql(app, log, db, credit_time, watermark, meta, totals=None):
+    """
+    Calculate the totals in the database and credit the orders without fetching them.
+    Duplicates are always marked in the database in this mode
+    :param app:
+    :param log:
+    :param db:
+    :param credit_time:
+    :param watermark: the id of the last order in this round
+    :param meta: the meta stats object to update
+    :param totals: the running totals if they were kept as the orders were saved.
+    duplicates have already been marked in that case
+    :return: tuple of totals and rewards
+    """
+    if totals is None:
+        meta['number-of-duplicates'] = deduplicate_orders_sql(db, watermark)
+    db.execute("SELECT COUNT(id), COUNT(DISTINCT key) FROM orders WHERE credited=0 "
+               "AND id<=%s", (watermark,))
+    meta['number-of-orders'], meta['number-of-users-active'] = db.fetchone()
+    if meta['number-of-orders'] > 0:
+        log.info('Start credit')
+
+    # calculate the liquidity totals
+    if totals is None:
+        totals = get_total_liquidity_sql(app, db, watermark)
+
+    # We've calculated the totals so submit them as liquidity_info
+    Thread(
+        target=liquidity_info,
+        kwargs={'app': app, 'totals': totals, 'log': log}
+    ).start()
+
+    # calculate the round rewards based on percentages of target and ratios of side
+    # and rank
+    rewards = calculate_reward(app, totals)
+
+    # work out each order's share of its rank and save the credits in one statement
+    ranks = ([], [], [], [], [], [])
+    for exchange in rewards:
+        for unit in rewards[exchange]:
+            for side in rewards[exchange][unit]:
+                for rank in rewards[exchange][unit][side]:
+                    for index, value in enumerate([
+                        exchange, unit, side, rank,
+                        totals[exchange][unit][side][rank],
+                        rewards[exchange][unit][side][rank]
+                    ]):
+                        ranks[index].append(value)
+    db.execute(
+        "WITH credited AS (INSERT INTO credits (time,key,exchange,unit,rank,side,"
+        "order_id,provided,percentage,reward,paid) SELECT %s, o.key, o.exchange, "
+        "o.unit, o.rank, o.side, o.id, o.order_amount, CASE WHEN r.total > 0 THEN "
+        "(o.order_amount / r.total) * 100 ELSE 0 END, CASE WHEN r.total > 0 THEN "
+        "(o.order_amount / r.total) * r.reward ELSE 0 END, 0 FROM orders AS o INNER "
+        "JOIN unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::float8[], "
+        "%s::float8[]) AS r (exchange, unit, side, rank, total, reward) ON o.exchange = "
+        "r.exchange AND o.unit = r.unit AND o.side = r.side AND o.rank = r.rank WHERE "
+        "o.credited=0 AND o.id<=%s RETURNING order_id) UPDATE orders SET credited=1 "
+        "FROM credited WHERE orders.id = credited.order_id::bigint",
+        (credit_time,) + ranks + (watermark,)
+    )
+    return totals, rewards
+
+
+def skip_unknown_ranks(app, db, watermark):
+    """
+    Mark the orders waiting to be credited whose exchange, unit, side or rank is no
+    longer in the pool config with credited=-2 so that no round fetches them again
+    :param app:
+    :param db:
+    :param watermark: the id of the last order in this round
+    :return: the number of orders marked
+    """
+    ranks = ([], [], [], [])
+    for exchange in app.config['pool'].exchanges.itervalues():
+        for unit in exchange.units.itervalues():
+            for side in [unit.ask, unit.bid]:
+                for rank in side.rank_names:
+                    for index, value in enumerate([exchange.name, unit.name, side.name,
+                                                   rank]):
+                        ranks[index].append(value)
+    db.execute("UPDATE orders AS o SET credited=-2 WHERE o.credited=0 AND o.id<=%s AND "
+               "NOT EXISTS (SELECT 1 FROM unnest(%s::text[], %s::text[], %s::text[], "
+               "%s::text[]) AS r (exchange, unit, side, rank) WHERE o.exchange = "
+               "r.exchange AND o.unit = r.unit AND o.side = r.side AND o.rank = r.rank)",
+               (watermark,) + ranks)
+    return db.rowcount
+
+
+def summarise_round(db, credit_time):
+    """
+    Save the liquidity provided and reward earned by each user in the round
+    :param db:
+    :param credit_time:
+    :return:
+    """
+    # a second round in the same second replaces the summary of the first
+    db.execute("INSERT INTO user_rounds (key,time,provided,reward) SELECT c.key, "
+               "c.time, SUM(c.provided), SUM(c.reward) FROM credits AS c WHERE "
+               "c.time=%s GROUP BY c.key, c.time ON CONFLICT (key, time) DO UPDATE SET "
+               "provided=EXCLUDED.provided, reward=EXCLUDED.reward", (credit_time,))
 
 
 def deduplicate_orders(all_orders, db):
@@ -155,25 +409,43 @@ def deduplicate_orders(all_orders, db):
     :return:
     """
     deduped_orders = []
-    known_orders = []
+    known_orders = set()
+    duplicate_orders = []
     for order in all_orders:
-        # hash the order to avoid duplicates
-        # order_id, order_amount, side, exchange, unit
-        order_hash = '{}.{}.{}.{}.{}'.format(order[3], order[4],
-                                             order[5], order[6],
-                                             order[7])
-        # check if the order exists in our known orders list
-        if order_hash in known_orders:
-            # if this is a duplicate order, mark it as such in the database
-            db.execute("UPDATE orders SET credited=%s WHERE id=%s", (-1, order[0]))
+        # key the order on the details which identify it
+        # order_id, order_amount, side, order_price, server_price
+        order_key = (order[3], order[4], order[5], order[6], order[7])
+        # check if the order exists in our known orders
+        if order_key in known_orders:
+            # if this is a duplicate order, remember to mark it as such
+            duplicate_orders.append(order[0])
             continue
-        # add the hash, as it is known
-        known_orders.append(order_hash)
+        # add the key, as it is known
+        known_orders.add(order_key)
         # save the full order in our deduped list
         deduped_orders.append(order)
+    # mark the duplicates in the database
+    if duplicate_orders:
+        db.execute("UPDATE orders SET credited=%s WHERE id = ANY(%s)",
+                   (-1, duplicate_orders))
     return deduped_orders
 
 
+def deduplicate_orders_sql(db, watermark):
+    """
+    Mark the duplicate orders waiting to be credited without fetching them from the
+    database. The first of each set of identical orders is kept
+    :param db:
+    :param watermark: the id of the last order in this round
+    :return: the number of duplicates found
+    """
+    db.execute("UPDATE orders SET credited=-1 WHERE id IN (SELECT id FROM (SELECT id, "
+               "row_number() OVER (PARTITION BY order_id, order_amount, side, "
+               "order_price, server_price ORDER BY id) AS copy FROM orders WHERE "
+               "credited=0 AND id<=%s) AS copies WHERE copy > 1)", (watermark,))
+    return db.rowcount
+
+
 def get_total_liquidity(app, orders):
     """
     Given a list of orders from the database, calculate the liquidity totals for unit
@@ -182,20 +454,19 @@ def get_total_liquidity(app, orders):
     :param orders:
     :return:
     """
-    # build the liquidity object
-    liquidity = {}
-    for exchange in app.config['exchanges']:
-        if exchange not in liquidity:
-            liquidity[exchange] = {}
-        for unit in app.config['{}.units'.format(exchange)]:
-            if unit not in liquidity[exchange]:
-                liquidity[exchange][unit] = {}
-            liquidity[exchange][unit]['total'] = 0.00
-            for side in ['ask', 'bid']:
-                liquidity[exchange][unit][side] = {'total': 0.00}
-                for rank in app.config['{}.{}.{}.ranks'.format(exchange, unit, side)]:
-                    liquidity[exchange][unit][side][rank] = 0.00
+    liquidity = blank_liquidity(app)
+
+    add_liquidity(liquidity, orders)
+    return liquidity
 
+
+def add_liquidity(liquidity, orders):
+    """
+    Add the amounts of a list of orders to the liquidity totals
+    :param liquidity: the liquidity object to update
+    :param orders:
+    :return:
+    """
     # parse the orders and update the liquidity object accordingly
     for order in orders:
         # exchange.unit.total
@@ -205,6 +476,77 @@ def get_total_liquidity(app, orders):
         # exchange.unit.side.rank
         liquidity[order[8]][order[9]][order[5]][order[2]] += float(order[4])
 
+
+def get_total_liquidity_sql(app, db, watermark):
+    """
+    Calculate the liquidity totals for unit, side and rank in the database
+    :param app:
+    :param db:
+    :param watermark: the id of the last order in this round
+    :return:
+    """
+    db.execute("SELECT exchange, unit, side, rank, SUM(order_amount) FROM orders WHERE "
+               "credited=0 AND id<=%s GROUP BY exchange, unit, side, rank", (watermark,))
+    return rollup_liquidity(app, db.fetchall())
+
+
+def get_running_totals(app, db):
+    """
+    Get the liquidity totals of the current round as kept when the orders were saved
+    :param app:
+    :param db: database cursor returning tuples
+    :return:
+    """
+    db.execute("SELECT exchange, unit, side, rank, amount FROM liquidity_totals")
+    return rollup_liquidity(app, db.fetchall())
+
+
+def take_running_totals(app, db):
+    """
+    Get the running liquidity totals and reset them for the next round.
+    The liquidity_totals table must be locked by the caller
+    :param app:
+    :param db:
+    :return:
+    """
+    db.execute("DELETE FROM liquidity_totals RETURNING exchange, unit, side, rank, "
+               "amount")
+    return rollup_liquidity(app, db.fetchall())
+
+
+def rollup_liquidity(app, rows):
+    """
+    Build the liquidity object from rank totals
+    :param app:
+    :param rows: list of (exchange, unit, side, rank, total)
+    :return:
+    """
+    liquidity = blank_liquidity(app)
+    for exchange, unit, side, rank, total in rows:
+        # ignore orders for anything no longer in the config
+        try:
+            liquidity[exchange][unit][side][rank] += float(total)
+        except (KeyError, TypeError):
+            continue
+        liquidity[exchange][unit][side]['total'] += float(total)
+        liquidity[exchange][unit]['total'] += float(total)
+    return liquidity
+
+
+def blank_liquidity(app):
+    """
+    Build the liquidity object with zero totals for every exchange, unit, side and rank
+    :param app:
+    :return:
+    """
+    liquidity = {}
+    for exchange in app.config['pool'].exchanges.itervalues():
+        liquidity[exchange.name] = {}
+        for unit in exchange.units.itervalues():
+            liquidity[exchange.name][unit.name] = {'total': 0.00}
+            for side in [unit.ask, unit.bid]:
+                liquidity[exchange.name][unit.name][side.name] = dict.fromkeys(
+                    side.rank_names + ('total',), 0.00)
     return liquidity
 
 
@@ -218,33 +560,19 @@ def calculate_reward(app, totals):
     """
     # build the blank object
     rewards = {}
-    for exchange in app.config['exchanges']:
-        if exchange not in rewards:
-            rewards[exchange] = {}
-        for unit in app.config['{}.units'.format(exchange)]:
-            if unit not in rewards[exchange]:
-                rewards[exchange][unit] = {}
-            for side in ['ask', 'bid']:
-                rewards[exchange][unit][side] = {}
-                # reward depends on the percentage of the target liquidity being provided
-                total_liq = float(totals[exchange][unit]['total'])
-                target_liq = float(app.config['{}.{}.target'.format(exchange, unit)])
-                target_percentage = total_liq / target_liq
-                if target_percentage > 1.00:
-                    target_percentage = 1.00
-                for rank in app.config['{}.{}.{}.ranks'.format(exchange, unit, side)]:
-                    # reward is split by the rank and side ratios
-                    reward = float(app.config['{}.{}.reward'.format(exchange, unit)])
-                    side_ratio = float(app.config['{}.{}.{}.ratio'.format(exchange,
-                                                                          unit,
-                                                                          side)])
-                    rank_ratio = float(app.config['{}.{}.{}.{}.ratio'.format(exchange,
-                                                                             unit,
-                                                                             side,
-                                                                             rank)])
-                    rewards[exchange][unit][side][rank] = round(((reward * side_ratio) *
-                                                                rank_ratio) *
-                                                                target_percentage, 8)
+    for exchange in app.config['pool'].exchanges.itervalues():
+        rewards[exchange.name] = {}
+        for unit in exchange.units.itervalues():
+            rewards[exchange.name][unit.name] = {}
+            # reward depends on the percentage of the target liquidity being provided
+            total_liq = float(totals[exchange.name][unit.name]['total'])
+            target_percentage = min(total_liq / unit.target, 1.00)
+            for side in [unit.ask, unit.bid]:
+                # reward is split by the rank and side ratios
+                rewards[exchange.name][unit.name][side.name] = dict(
+                    (rank.name, round(rank.share * target_percentage, 8))
+                    for rank in side.ranks
+                )
     return rewards
 
 
@@ -278,9 +606,9 @@ def liquidity_info(app, log, totals):
     rpc = get_rpc(app, log)
     if rpc is None:
         return
-    for exchange in app.config['exchanges']:
-        for unit in app.config['{}.units'.format(exchange)]:
-            for rank in app.config['{}.{}.bid.ranks'.format(exchange, unit)]:
+    for exchange in app.config['pool'].exchanges:
+        for unit in app.config['pool'].exchanges[exchange].units:
+            for rank in app.config['pool'].unit(exchange, unit).bid.rank_names:
                 identifier = "1:{}:{}:{}.{}".format(
                     'NBT{}'.format(unit.upper()),
                     exchange,
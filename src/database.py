@@ -1,9 +1,26 @@
+import time
 import urlparse
+from contextlib import contextmanager
+from threading import Lock, Semaphore
+
 import psycopg2
+import psycopg2.extras
 import os
+from bottle import HTTPError, HTTPResponse
+from psycopg2.pool import ThreadedConnectionPool
+from src import balances, config
 
 __author__ = 'sammoth'
 
+# connection pools keyed by process id and connection details
+pools = {}
+pools_lock = Lock()
+
+# advisory lock id held while migrating the schema
+MIGRATION_LOCK = 1750
+# advisory lock class held while checking a saved order for duplicates
+ORDER_LOCK = 1751
+
 
 def build(app, log, log_output=True):
     """
@@ -38,30 +55,398 @@ def build(app, log, log_output=True):
     c.execute("SELECT value FROM info WHERE key = %s", ('next_payout_time', ))
     if c.fetchone() is None:
         c.execute("INSERT INTO info VALUES (%s, %s)", ('next_payout_time', 0))
+    c.execute("SELECT value FROM info WHERE key = %s", ('schema_version', ))
+    if c.fetchone() is None:
+        c.execute("INSERT INTO info VALUES (%s, %s)", ('schema_version', 0))
     conn.commit()
     conn.close()
+    migrate(app, log, log_output)
     return
 
 
-def get_db(app):
+def primary_key(table, column):
+    """
+    Statements to add a primary key to an existing table.
+    The unique index is built concurrently so that the table can still be written
+    while it builds. Adding the constraint using that index is then quick
+    :param table:
+    :param column:
+    :return:
+    """
+    return [
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {0}_pkey ON {0} ({1})".format(
+            table,
+            column
+        ),
+        "DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = "
+        "'{0}_pkey') THEN ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY USING "
+        "INDEX {0}_pkey; END IF; END $$".format(table)
+    ]
+
+
+def partition_by_time(table, add_time):
+    """
+    Statements to turn an existing table into one partitioned by range of its time column.
+    The existing table is renamed and attached as the first partition, holding everything
+    up to the midnight (UTC) after next. Later partitions are made by the retention job.
+    The primary key of a partitioned table has to include the time so it becomes
+    (id, time).
+    The slow work is done while the table can still be written. A check constraint
+    that every row fits in the first partition is validated and the unique index on
+    (id, time) is built concurrently. The constraint proves that the columns aren't null
+    and that the rows are in range, so making the partitioned table and attaching the
+    existing one only change the catalog and the exclusive lock is held briefly.
+    Indexes can't be built concurrently on a partitioned table, so the conversion is
+    the last statement and the statements shouldn't share a migration with others
+    :param table:
+    :param add_time: add the time column, set to the time each row is saved
+    :return:
+    """
+    bound = "(floor(extract(epoch FROM now()) / 86400) + 2) * 86400"
+    return ([
+        "ALTER TABLE {0} ADD COLUMN IF NOT EXISTS time FLOAT8 NOT NULL DEFAULT "
+        "0".format(table)
+    ] if add_time else []) + [
+        "DO $$ BEGIN "
+        "IF (SELECT relkind FROM pg_class WHERE oid = '{0}'::regclass) = 'p' OR EXISTS "
+        "(SELECT 1 FROM pg_constraint WHERE conrelid = '{0}'::regclass AND conname = "
+        "'{0}_bound') THEN RETURN; END IF; "
+        "EXECUTE format('ALTER TABLE {0} ADD CONSTRAINT {0}_bound CHECK (id IS NOT NULL "
+        "AND time IS NOT NULL AND time < %s) NOT VALID', {1}); "
+        "END $$".format(table, bound),
+        "DO $$ BEGIN "
+        "IF EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = '{0}'::regclass AND "
+        "conname = '{0}_bound' AND NOT convalidated) THEN "
+        "ALTER TABLE {0} VALIDATE CONSTRAINT {0}_bound; END IF; "
+        "END $$".format(table),
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {0}_id_time_idx ON {0} (id, "
+        "time)".format(table),
+        "DO $$ DECLARE r RECORD; "
+        "BEGIN "
+        "IF (SELECT relkind FROM pg_class WHERE oid = '{0}'::regclass) = 'p' THEN "
+        "RETURN; END IF; "
+        "ALTER TABLE {0} RENAME TO {0}_legacy; "
+        "FOR r IN SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() "
+        "AND tablename = '{0}_legacy' LOOP "
+        "EXECUTE format('ALTER INDEX %I RENAME TO %I', r.indexname, "
+        "regexp_replace(r.indexname, '^{0}_', '{0}_legacy_')); END LOOP; "
+        "ALTER TABLE {0}_legacy DROP CONSTRAINT IF EXISTS {0}_legacy_pkey; "
+        "DROP INDEX IF EXISTS {0}_legacy_pkey; "
+        "ALTER TABLE {0}_legacy ALTER COLUMN id SET NOT NULL, ALTER COLUMN time SET NOT "
+        "NULL; "
+        "ALTER TABLE {0}_legacy ADD CONSTRAINT {0}_legacy_pkey PRIMARY KEY USING INDEX "
+        "{0}_legacy_id_time_idx; "
+        "CREATE TABLE {0} (LIKE {0}_legacy INCLUDING DEFAULTS) PARTITION BY RANGE "
+        "(time); "
+        "{2}"
+        "ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id; "
+        "ALTER TABLE {0} ADD PRIMARY KEY (id, time); "
+        "EXECUTE format('ALTER TABLE {0} ATTACH PARTITION {0}_legacy FOR VALUES FROM "
+        "(MINVALUE) TO (%s)', {1}); "
+        "ALTER TABLE {0}_legacy DROP CONSTRAINT {0}_bound; "
+        "END $$".format(
+            table,
+            bound,
+            "ALTER TABLE {} ALTER COLUMN time SET DEFAULT extract(epoch FROM now()); "
+            "".format(table) if add_time else ""
+        )
+    ]
+
+
+# The numbered schema migrations.
+# Each statement is run outside of a transaction so should be safe to run again if a
+# migration fails part way through
+MIGRATIONS = [
+    (1, 'add primary keys',
+     primary_key('users', 'id') +
+     primary_key('orders', 'id') +
+     primary_key('credits', 'id') +
+     primary_key('stats', 'id') +
+     primary_key('prices', 'id') +
+     primary_key('info', 'key')),
+    (2, 'index uncredited orders', [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_uncredited_idx ON orders (id) "
+        "WHERE credited = 0"
+    ]),
+    (3, 'index user lookups', [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_key_idx ON users (key, address, "
+        "exchange, unit)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_key_idx ON orders (key, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS credits_key_idx ON credits (key, time)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS credits_unpaid_idx ON credits (key) "
+        "WHERE paid = 0",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS credits_order_idx ON credits (order_id)"
+    ]),
+    (4, 'index round lookups', [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS credits_time_idx ON credits (time)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS stats_time_idx ON stats (time)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS prices_unit_idx ON prices (unit, id)"
+    ]),
+    (5, 'add running liquidity totals', [
+        "CREATE TABLE IF NOT EXISTS liquidity_totals (exchange TEXT, unit TEXT, "
+        "side TEXT, rank TEXT, amount FLOAT8 NOT NULL DEFAULT 0, PRIMARY KEY (exchange, "
+        "unit, side, rank))",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_uncredited_order_idx ON orders "
+        "(order_id) WHERE credited = 0"
+    ]),
+    (6, 'add per round user summaries', [
+        "CREATE TABLE IF NOT EXISTS user_rounds (key TEXT, time FLOAT8, provided FLOAT8, "
+        "reward FLOAT8, total_reward FLOAT8, PRIMARY KEY (key, time))",
+        "INSERT INTO user_rounds (key, time, provided, reward, total_reward) SELECT key, "
+        "time, SUM(provided), SUM(reward), SUM(SUM(reward)) OVER (PARTITION BY key "
+        "ORDER BY time) FROM credits GROUP BY key, time ON CONFLICT DO NOTHING",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS user_rounds_time_idx ON user_rounds "
+        "(time)"
+    ]),
+    (7, 'add balances ledger', [
+        "CREATE TABLE IF NOT EXISTS balances (key TEXT PRIMARY KEY, address TEXT, "
+        "earned FLOAT8 NOT NULL DEFAULT 0, unpaid FLOAT8 NOT NULL DEFAULT 0, "
+        "paid FLOAT8 NOT NULL DEFAULT 0, last_paid FLOAT8)",
+        "INSERT INTO balances (key,address,earned,unpaid,paid) SELECT key, address, "
+        "earned, unpaid, earned-unpaid FROM ({}) AS derived (key,address,earned,unpaid) "
+        "ON CONFLICT DO NOTHING".format(balances.DERIVE_BALANCES)
+    ]),
+    (8, 'partition orders by time', partition_by_time('orders', True)),
+    (9, 'partition credits by time', partition_by_time('credits', False)),
+    (10, 'partition prices by time', partition_by_time('prices', True)),
+    (11, 'index the partitioned tables', [
+        # indexes made on the partitioned tables are made on each partition too.
+        # the matching indexes of the legacy partitions are used rather than rebuilt
+        "CREATE INDEX IF NOT EXISTS orders_uncredited_idx ON orders (id) WHERE "
+        "credited = 0",
+        "CREATE INDEX IF NOT EXISTS orders_key_idx ON orders (key, id)",
+        "CREATE INDEX IF NOT EXISTS orders_uncredited_order_idx ON orders (order_id) "
+        "WHERE credited = 0",
+        "CREATE INDEX IF NOT EXISTS credits_key_idx ON credits (key, time)",
+        "CREATE INDEX IF NOT EXISTS credits_unpaid_idx ON credits (key) WHERE paid = 0",
+        "CREATE INDEX IF NOT EXISTS credits_order_idx ON credits (order_id)",
+        "CREATE INDEX IF NOT EXISTS credits_time_idx ON credits (time)",
+        "CREATE INDEX IF NOT EXISTS prices_unit_idx ON prices (unit, id)",
+        # rewards of credits dropped by the retention job
+        "ALTER TABLE balances ADD COLUMN IF NOT EXISTS archived FLOAT8 NOT NULL "
+        "DEFAULT 0"
+    ]),
+    (12, 'drop the running total of user rounds', [
+        # the total reward of a user is read from the balances ledger
+        "ALTER TABLE user_rounds DROP COLUMN IF EXISTS total_reward"
+    ]),
+]
+
+
+def migrate(app, log, log_output=True):
     """
-    Determine which database to use based on Environment Variables and return a
-    database cursor object
+    Apply any migrations newer than the schema version recorded in the info table
+    :param app:
+    :param log:
+    :param log_output:
+    :return:
+    """
+    conn = get_db(app)
+    # concurrent index builds can't run inside a transaction
+    conn.autocommit = True
+    c = conn.cursor()
+    # only one server should migrate the database at a time
+    c.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK,))
+    try:
+        c.execute("SELECT value FROM info WHERE key = %s", ('schema_version', ))
+        version = int(c.fetchone()[0])
+        if version >= MIGRATIONS[-1][0]:
+            return
+        # a failed concurrent build leaves an invalid index behind which would stop
+        # 'IF NOT EXISTS' from building it again
+        c.execute("SELECT c.relname FROM pg_index AS i INNER JOIN pg_class AS c ON "
+                  "c.oid = i.indexrelid WHERE NOT i.indisvalid")
+        for index in c.fetchall():
+            log.warn('dropping invalid index %s', index[0])
+            c.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(index[0]))
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            if log_output:
+                log.info('apply database migration %s: %s', number, description)
+            for statement in statements:
+                c.execute(statement)
+            c.execute("UPDATE info SET value=%s WHERE key=%s", (number, 'schema_version'))
+    finally:
+        c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+        conn.close()
+
+
+def connection_args(app):
+    """
+    Determine which database to use based on Environment Variables and return the
+    arguments needed to connect to it
     :param app:
     :return:
     """
     if os.getenv("DATABASE_URL", None) is not None:
         urlparse.uses_netloc.append("postgres")
         url = urlparse.urlparse(os.environ["DATABASE_URL"])
-        conn = psycopg2.connect(database=url.path[1:],
-                                user=url.username,
-                                password=url.password,
-                                host=url.hostname,
-                                port=url.port)
-    else:
-        conn = psycopg2.connect(database=app.config['db.name'],
-                                user=app.config['db.user'],
-                                password=app.config['db.pass'],
-                                host=app.config['db.host'],
-                                port=app.config['db.port'])
-    return conn
+        return {'database': url.path[1:],
+                'user': url.username,
+                'password': url.password,
+                'host': url.hostname,
+                'port': url.port}
+    return {'database': app.config['db.name'],
+            'user': app.config['db.user'],
+            'password': app.config['db.pass'],
+            'host': app.config['db.host'],
+            'port': app.config['db.port']}
+
+
+def get_db(app):
+    """
+    Open a new database connection.
+    Long running work should borrow a pooled connection using 'connection' instead
+    :param app:
+    :return:
+    """
+    return psycopg2.connect(**connection_args(app))
+
+
+class ConnectionPool(object):
+
+    def __init__(self, min_connections, max_connections, **kwargs):
+        """
+        A thread safe pool of database connections.
+        Borrowing a connection waits for one to be free rather than failing when the
+        pool is exhausted. The time spent waiting is recorded
+        :param min_connections:
+        :param max_connections:
+        :param kwargs: arguments passed to psycopg2.connect
+        """
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, **kwargs)
+        self.max_connections = max_connections
+        self.slots = Semaphore(max_connections)
+        self.lock = Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.saturated = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def getconn(self):
+        """
+        Borrow a connection, waiting for one to be returned if they are all in use
+        :return:
+        """
+        start = time.time()
+        if not self.slots.acquire(False):
+            with self.lock:
+                self.saturated += 1
+            self.slots.acquire()
+        try:
+            conn = self.pool.getconn()
+        except psycopg2.Error:
+            self.slots.release()
+            raise
+        wait = time.time() - start
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return a borrowed connection. Anything not committed is rolled back
+        :param conn:
+        :param close: close the connection rather than keeping it in the pool
+        :return:
+        """
+        try:
+            self.pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def stats(self):
+        """
+        Report how busy the pool is
+        :return:
+        """
+        with self.lock:
+            return {'max_connections': self.max_connections,
+                    'in_use': self.in_use,
+                    'checkouts': self.checkouts,
+                    'saturated_checkouts': self.saturated,
+                    'average_wait': (self.total_wait / self.checkouts) if
+                    self.checkouts > 0 else 0.0,
+                    'max_wait': self.max_wait}
+
+
+def get_pool(app):
+    """
+    Get the connection pool for this process, creating it if needed.
+    Pools aren't shared with forked processes as the connections can't be
+    :param app:
+    :return:
+    """
+    args = connection_args(app)
+    key = (os.getpid(),) + tuple(sorted(args.items()))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(config.get_int(app, 'db.min_connections', 1),
+                                        config.get_int(app, 'db.max_connections', 10),
+                                        **args)
+        return pools[key]
+
+
+@contextmanager
+def connection(app):
+    """
+    Borrow a connection from the pool and give it back afterwards
+    :param app:
+    :return:
+    """
+    pool = get_pool(app)
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+
+class PoolPlugin(object):
+    """
+    Bottle plugin which passes a cursor to route callbacks that accept a 'db' keyword
+    argument. The cursor uses a connection borrowed from the pool which is committed
+    when the callback returns and given back afterwards. Rows are returned as
+    dictionaries
+    """
+    name = 'pgsql_pool'
+    api = 2
+
+    def __init__(self, app, keyword='db'):
+        self.app = app
+        self.keyword = keyword
+
+    def apply(self, callback, route):
+        # Ignore routes which don't need a database handle
+        if self.keyword not in route.get_callback_args():
+            return callback
+
+        def wrapper(*args, **kwargs):
+            with connection(self.app) as conn:
+                kwargs[self.keyword] = conn.cursor(
+                    cursor_factory=psycopg2.extras.RealDictCursor
+                )
+                try:
+                    rv = callback(*args, **kwargs)
+                    conn.commit()
+                except psycopg2.ProgrammingError as e:
+                    conn.rollback()
+                    raise HTTPError(500, "Database Error", e)
+                except HTTPError:
+                    raise
+                except HTTPResponse:
+                    conn.commit()
+                    raise
+            return rv
+        return wrapper
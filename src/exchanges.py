@@ -1,20 +1,81 @@
 #! /usr/bin/env python
+import cookielib
 import json
 import random
 import time
+from threading import Lock
 import requests
+from requests.adapters import HTTPAdapter
 
 
-class Bittrex(object):
+class ExchangeSession(requests.Session):
+
+    def __init__(self, pool_size=10):
+        """
+        A requests session which keeps a pool of keep-alive connections to the exchange
+        API so that each submission doesn't pay for a new TCP and TLS handshake
+        :param pool_size: the maximum number of connections kept open per host
+        """
+        super(ExchangeSession, self).__init__()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        # the session is shared by every user so never send one user's cookies on
+        # another user's request
+        self.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+        # only the pools of the 4 most recent hosts are kept. the counts of the others
+        # are kept here when their pools are closed
+        self.stats_lock = Lock()
+        self.closed_requests = 0
+        self.closed_connections = 0
+        self.pools = adapter.poolmanager.pools
+        self.pools.dispose_func = self.pool_closed
+
+    def pool_closed(self, pool):
+        """
+        Keep the counts of a connection pool which is being closed
+        :param pool:
+        :return:
+        """
+        with self.stats_lock:
+            self.closed_requests += pool.num_requests
+            self.closed_connections += pool.num_connections
+        pool.close()
+
+    def connection_stats(self):
+        """
+        Count the requests made and connections opened by the connection pools
+        :return: dict of requests, new connections and reused connections
+        """
+        with self.stats_lock:
+            requests_made = self.closed_requests
+            new_connections = self.closed_connections
+        for key in self.pools.keys():
+            pool = self.pools.get(key)
+            if pool is None:
+                continue
+            requests_made += pool.num_requests
+            new_connections += pool.num_connections
+        return {'requests': requests_made,
+                'new_connections': new_connections,
+                'reused_connections': requests_made - new_connections}
+
+
+class Exchange(object):
+
+    def __init__(self, pool_size=10):
+        self.session = ExchangeSession(pool_size)
+
+    def connection_stats(self):
+        return self.session.connection_stats()
 
-    def __init__(self):
-        pass
+
+class Bittrex(Exchange):
 
     def __repr__(self):
         return "bittrex"
 
-    @staticmethod
-    def validate_request(**kwargs):
+    def validate_request(self, **kwargs):
         """
         validate the orders request for Bittrex
         :param kwargs dict of arguments. should contain user, req and sign
@@ -25,8 +86,8 @@ class Bittrex(object):
         sign = kwargs.get('sign')
         url = 'https://bittrex.com/api/v1.1/market/getopenorders?' \
               'market={}&apikey={}&nonce={}'.format(req['market'], user, req['nonce'])
-        r = requests.post(url=url,
-                          headers={'apisign': sign})
+        r = self.session.post(url=url,
+                              headers={'apisign': sign})
         try:
             data = r.json()
         except ValueError as e:
@@ -54,24 +115,20 @@ class Bittrex(object):
         return valid
 
 
-class Poloniex(object):
-
-    def __init__(self):
-        pass
+class Poloniex(Exchange):
 
     def __repr__(self):
         return "poloniex"
 
-    @staticmethod
-    def validate_request(**kwargs):
+    def validate_request(self, **kwargs):
         user = kwargs.get('user')
         req = kwargs.get('req')
         sign = kwargs.get('sign')
         url = 'https://poloniex.com/tradingApi'
         headers = {'Key': user, 'Sign': sign}
-        r = requests.post(url=url,
-                          headers=headers,
-                          data=req)
+        r = self.session.post(url=url,
+                              headers=headers,
+                              data=req)
         try:
             data = r.json()
         except ValueError as e:
@@ -94,19 +151,19 @@ class Poloniex(object):
         return valid
 
 
-class CCEDK(object):
+class CCEDK(Exchange):
 
-    def __init__(self):
+    def __init__(self, pool_size=10):
+        super(CCEDK, self).__init__(pool_size)
         self.pair_id = self.get_pair_id()
 
     def __repr__(self):
         return "ccedk"
 
-    @staticmethod
-    def get_pair_id():
+    def get_pair_id(self):
         url = 'https://www.ccedk.com/api/v1/stats/marketdepthfull'
         try:
-            r = requests.get(url)
+            r = self.session.get(url)
             data = r.json()
         except (ValueError, requests.exceptions.RequestException):
             return None
@@ -139,9 +196,9 @@ class CCEDK(object):
                    "Key": user,
                    "Sign": sign}
         url = 'https://www.ccedk.com/api/v1/order/list'
-        r = requests.post(url=url,
-                          data=req,
-                          headers=headers)
+        r = self.session.post(url=url,
+                              data=req,
+                              headers=headers)
         try:
             data = r.json()
         except ValueError as e:
@@ -172,16 +229,12 @@ class CCEDK(object):
         return valid
 
 
-class BTER(object):
-
-    def __init__(self):
-        pass
+class BTER(Exchange):
 
     def __repr__(self):
         return "bter"
 
-    @staticmethod
-    def validate_request(**kwargs):
+    def validate_request(self, **kwargs):
         """
         Submit Bter get_orders request and return order list
         :param kwargs dict of params.
@@ -196,9 +249,9 @@ class BTER(object):
                    'Key': user,
                    "Content-type": "application/x-www-form-urlencoded"}
         # Send the data to the APi
-        r = requests.post('https://bter.com/api/1/private/orderlist',
-                          data=req,
-                          headers=headers)
+        r = self.session.post('https://bter.com/api/1/private/orderlist',
+                              data=req,
+                              headers=headers)
         # Catch potential errors
         try:
             data = r.json()
@@ -233,10 +286,7 @@ class BTER(object):
         return valid
 
 
-class TestExchange(object):
-
-    def __init__(self):
-        pass
+class TestExchange(Exchange):
 
     def __repr__(self):
         return 'test_exchange'
@@ -1,12 +1,35 @@
+import Queue
 import json
-from threading import Timer
+import time
+from collections import deque
+from threading import Event, Timer, Lock, Thread
 import uuid
+import psycopg2
 import requests
 import zmq
-from src import database
+from src import config, credit, database
+from src.stats import price_section, status_document
 
 __author__ = 'woolly_sammoth'
 
+# seconds to wait for a price feed to connect or send data
+FEED_TIMEOUT = 5.0
+
+# the units whose rates are fetched together from the feeds which allow it
+FIAT_UNITS = ['btc', 'cny', 'eur', 'hkd', 'jpy', 'php']
+
+
+def median(values):
+    """
+    :param values:
+    :return: the median of a list of numbers
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
 
 class StreamerPriceFetcher(object):
 
@@ -20,18 +43,34 @@ class StreamerPriceFetcher(object):
         # set a context of all sockets
         global_context = zmq.Context()
         self.context = global_context.instance()
-        self.req_socket = self.build_req_socket()
         self.price = None
         self.currency_details = {}
         self.session_id = uuid.uuid4()
 
-    def build_req_socket(self):
-        # create a socket for pings
+    def request(self, port, message, json_reply=True):
+        """
+        Send a request to the streamer and wait for the reply.
+        The price workers fetch at the same time and zmq sockets can't be shared
+        between threads, so each request uses a socket of its own. That also means a
+        socket which has timed out is never used again
+        :param port:
+        :param message:
+        :param json_reply: decode the reply as json
+        :return: the reply or None if there wasn't one
+        """
         req_socket = self.context.socket(zmq.REQ)
+        req_socket.setsockopt(zmq.LINGER, 0)
         # set the timeouts
         req_socket.setsockopt(zmq.SNDTIMEO, 500)
         req_socket.setsockopt(zmq.RCVTIMEO, 500)
-        return req_socket
+        try:
+            req_socket.connect('{}://{}:{}'.format(self.protocol, self.base_url, port))
+            req_socket.send(message)
+            return req_socket.recv_json() if json_reply else req_socket.recv()
+        except (zmq.error.ZMQError, ValueError):
+            return None
+        finally:
+            req_socket.close()
 
     def get_price(self, unit):
         if not self.send_ping():
@@ -42,35 +81,13 @@ class StreamerPriceFetcher(object):
                 return None
             self.currency_details[unit] = {'port': port, 'token': token}
         return self.request_price(
-            self.currency_details['port'],
-            self.currency_details['token']
+            self.currency_details[unit]['port'],
+            self.currency_details[unit]['token']
         )
 
     def send_ping(self):
-        # use the default ping port
-        self.req_socket.connect(
-            '{}://{}:{}'.format(
-                self.protocol,
-                self.base_url,
-                self.ping_port
-            )
-        )
-
-        ping = False
-        # send the ping? request
-        self.req_socket.send('ping?')
-        # if the server is down, we will get a zmq timeout error.
-        # catch that here and handle
-        try:
-            response = self.req_socket.recv()
-        except zmq.error.Again as e:
-            self.req_socket.close(0)
-            self.req_socket = self.build_req_socket()
-            response = e
-        # set True if we get the correct response
-        if response == 'pong!':
-            ping = True
-        return ping
+        # use the default ping port. if the server is down there is no response
+        return self.request(self.ping_port, 'ping?', json_reply=False) == 'pong!'
 
     def request_init(self, unit):
         """
@@ -79,16 +96,9 @@ class StreamerPriceFetcher(object):
         :param currency:
         :return:
         """
-        # use the main port
-        self.req_socket.connect(
-            '{}://{}:{}'.format(
-                self.protocol,
-                self.base_url,
-                self.main_port
-            )
-        )
-        # send the necessary information
-        self.req_socket.send(
+        # send the necessary information to the main port
+        response = self.request(
+            self.main_port,
             '{} {}:{} {}'.format(
                 self.session_id,
                 self.base_url,
@@ -96,10 +106,8 @@ class StreamerPriceFetcher(object):
                 unit
             )
         )
-        # get the response as json
-        response = self.req_socket.recv_json()
         # in case we get a different response to the one expected
-        if 'args' not in response:
+        if not isinstance(response, dict) or 'args' not in response:
             return None, None
         # otherwise parse out the args for later use
         args = list(response['args'])
@@ -114,142 +122,386 @@ class StreamerPriceFetcher(object):
         :return:
         """
         # currency manage port is currency_port + 100
-        self.req_socket.connect(
-            '{}://{}:{}'.format(
-                self.protocol,
-                self.base_url,
-                int(port) + 100
-            )
-        )
         # send the token and our session id
-        self.req_socket.send(
+        response = self.request(
+            int(port) + 100,
             '{} {} start'.format(
                 token,
                 self.session_id
             )
         )
-        try:
-            response = self.req_socket.recv_json()
-        except ValueError:
-            self.req_socket.close(0)
-            self.req_socket = self.build_req_socket()
-            return None
         # if we got a different response to the one we were expecting
-        if 'args' not in response:
+        if not isinstance(response, dict) or 'args' not in response:
             return None
         # otherwise set the price
         return float(response['args'][1])
 
 
+def fetch_url(url):
+    """
+    Get the body of a price feed url
+    :param url:
+    :return:
+    """
+    return requests.get(url, timeout=FEED_TIMEOUT).text
+
+
+class ResponseCache(object):
+
+    def __init__(self, ttl=30, fetch=fetch_url):
+        """
+        Responses from the price feeds, kept for a short time.
+        Several feeds and units use the same url so each url is only requested once
+        while its response is fresh. Asking for a url which is already being fetched
+        waits for that response rather than requesting it again
+        :param ttl: the number of seconds a response is kept
+        :param fetch: function returning the body of a url
+        """
+        self.ttl = ttl
+        self.fetch = fetch
+        self.lock = Lock()
+        self.responses = {}
+        self.pending = {}
+        self.requests = 0
+        self.hits = 0
+
+    def get(self, url):
+        """
+        Get the body of a url
+        :param url:
+        :return: the body or None if it couldn't be fetched
+        """
+        with self.lock:
+            cached = self.responses.get(url)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                self.hits += 1
+                return cached[1]
+            fetching = url in self.pending
+            if fetching:
+                self.hits += 1
+            else:
+                self.pending[url] = {'done': Event(), 'body': None}
+            pending = self.pending[url]
+        if fetching:
+            pending['done'].wait()
+            return pending['body']
+        body = None
+        try:
+            body = self.fetch(url)
+        except requests.exceptions.RequestException:
+            pass
+        finally:
+            now = time.time()
+            with self.lock:
+                for cached_url in self.responses.keys():
+                    if now - self.responses[cached_url][0] >= self.ttl:
+                        del self.responses[cached_url]
+                # failures aren't kept so the next round tries again
+                if body is not None:
+                    self.responses[url] = (now, body)
+                self.requests += 1
+                del self.pending[url]
+            pending['body'] = body
+            pending['done'].set()
+        return body
+
+    def stats(self):
+        """
+        Report how many responses were fetched and how many were shared
+        :return:
+        """
+        with self.lock:
+            return {'requests': self.requests, 'hits': self.hits}
+
+
+# the price feed responses shared by the whole process
+response_cache = ResponseCache()
+
+
+class FeedStats(object):
+
+    def __init__(self, window=100, latency_scale=10.0):
+        """
+        Count the requests made to each price feed and how long they took.
+        The latency, failures and distance from the consensus price of the most recent
+        requests are kept to give each feed a health score
+        :param window: the number of recent requests kept for each feed
+        :param latency_scale: seconds of latency which halve a feed's score
+        """
+        self.window = window
+        self.latency_scale = latency_scale
+        self.lock = Lock()
+        self.feeds = {}
+
+    def new_feed(self, feed):
+        """
+        Start the counters of a feed. Must be called with the lock held
+        :param feed:
+        :return:
+        """
+        if feed not in self.feeds:
+            self.feeds[feed] = {'requests': 0, 'failures': 0, 'late': 0,
+                                'total_latency': 0.0, 'max_latency': 0.0,
+                                'last_latency': None,
+                                'recent': deque(maxlen=self.window),
+                                'deviations': deque(maxlen=self.window)}
+        return self.feeds[feed]
+
+    def record(self, feed, latency, success, late):
+        """
+        Record a request to a feed
+        :param feed:
+        :param latency: seconds taken to get an answer
+        :param success: whether a price was found
+        :param late: whether the answer came after the deadline
+        :return:
+        """
+        with self.lock:
+            stats = self.new_feed(feed)
+            stats['requests'] += 1
+            if not success:
+                stats['failures'] += 1
+            if late:
+                stats['late'] += 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['last_latency'] = latency
+            stats['recent'].append((latency, success))
+
+    def record_deviation(self, feed, deviation):
+        """
+        Record how far a feed's price was from the consensus price
+        :param feed:
+        :param deviation: the fraction of the consensus price
+        :return:
+        """
+        with self.lock:
+            self.new_feed(feed)['deviations'].append(deviation)
+
+    def health(self, feed):
+        """
+        Work out the health of a feed from its recent requests.
+        The score is 1 for a feed which always answers quickly with the consensus price.
+        It falls with the error rate, to 0 for a feed whose prices are on average as far
+        from the consensus as the 5% allowed for the main price, and halves for each
+        latency_scale seconds of 95th percentile latency.
+        A feed with no recent requests scores 1
+        :param feed:
+        :return: dict of p50_latency, p95_latency, error_rate, deviation and score
+        """
+        with self.lock:
+            stats = self.feeds.get(feed)
+            recent = list(stats['recent']) if stats is not None else []
+            deviations = list(stats['deviations']) if stats is not None else []
+        if not recent:
+            return {'p50_latency': None, 'p95_latency': None, 'error_rate': None,
+                    'deviation': None, 'score': 1.0}
+        latencies = sorted(latency for latency, success in recent)
+        p50 = latencies[int(round(0.5 * (len(latencies) - 1)))]
+        p95 = latencies[int(round(0.95 * (len(latencies) - 1)))]
+        error_rate = float(len([x for x in recent if not x[1]])) / len(recent)
+        deviation = (sum(deviations) / len(deviations)) if deviations else 0.0
+        score = (1 - error_rate) * max(0.0, 1 - (deviation / 0.05)) / \
+            (1 + (p95 / self.latency_scale))
+        return {'p50_latency': p50, 'p95_latency': p95, 'error_rate': error_rate,
+                'deviation': deviation, 'score': score}
+
+    def stats(self):
+        """
+        Report the counters and health of each feed
+        :return:
+        """
+        with self.lock:
+            report = {}
+            for feed, stats in self.feeds.items():
+                report[feed] = {'requests': stats['requests'],
+                                'failures': stats['failures'],
+                                'late': stats['late'],
+                                'average_latency': (stats['total_latency'] /
+                                                    stats['requests']) if
+                                stats['requests'] > 0 else None,
+                                'max_latency': stats['max_latency'],
+                                'last_latency': stats['last_latency']}
+        for feed in report:
+            report[feed].update(self.health(feed))
+        return report
+
+
+# the price feed counters shared by the whole process
+feed_stats = FeedStats()
+
+# the feeds of each unit, most trusted first.
+# the hierarchy matches that set for NuBot
+FEED_HIERARCHY = {
+    # many fiat currencies share a hierarchy
+    'cny': ['yahoo', 'google_official'],
+    'hkd': ['yahoo', 'google_official'],
+    'php': ['yahoo', 'google_official'],
+    'jpy': ['yahoo', 'google_official'],
+    # Eur is the same but with bitstamp as higher
+    'eur': ['bitstamp_eur', 'yahoo', 'google_official'],
+    # Bitcoin
+    'btc': ['bitfinex', 'blockchain', 'bitcoin_average', 'coinbase', 'bitstamp', 'yahoo',
+            'google_official'],
+    # Peercoin
+    'ppc': ['btce', 'coinmarketcap_ne', 'coinmarketcap_no'],
+    # Etherium
+    'eth': ['coinmarketcap_ne', 'coinmarketcap_no'],
+    # Ripple
+    'xrp': ['coinmarketcap_ne', 'coinmarketcap_no'],
+    # Litecoin
+    'ltc': ['btce', 'coinmarketcap_ne', 'coinmarketcap_no', 'bitfinex'],
+}
+
+# every feed the price fetcher knows
+FEEDS = set(feed for feeds in FEED_HIERARCHY.values() for feed in feeds)
+
+
 class StandardPriceFetcher(object):
 
+    def __init__(self, deadline=10.0, hierarchy=None, quorum=2, min_score=0.5):
+        """
+        :param deadline: the number of seconds to wait for the feeds of a unit
+        :param hierarchy: dict of lists of feeds keyed by unit, replacing those of the
+        FEED_HIERARCHY
+        :param quorum: the most fallback prices to wait for before using the main price
+        :param min_score: feeds with a lower health score are demoted
+        """
+        self.deadline = deadline
+        self.hierarchy = dict(FEED_HIERARCHY)
+        if hierarchy is not None:
+            self.hierarchy.update(hierarchy)
+        self.quorum = quorum
+        self.min_score = min_score
+
     def get_price(self, unit):
         """
         If connection to the price streamer fails for whatever reason we fall back to
         standard price feeds.
-        The hierarchy of the feeds matches that set for NuBot
         :return:
         """
-        # many fiat currencies share a hierarchy
-        if unit in ['cny', 'hkd', 'php', 'jpy']:
-            return self.fetch_price(
-                'yahoo', [
-                   'google_official'
-                ],
-                unit
-            )
-        # Eur is the same but with bitstamp as higher
-        if unit == 'eur':
-            return self.fetch_price(
-                'bitstamp_eur', [
-                    'yahoo',
-                    'google_official'
-                ],
-                unit
-            )
-        # Bitcoin
-        if unit == 'btc':
-            return self.fetch_price(
-                'bitfinex', [
-                    'blockchain',
-                    'bitcoin_average',
-                    'coinbase',
-                    'bitstamp',
-                    'yahoo',
-                    'google_official'
-                ],
-                unit
-            )
-        # Peercoin
-        if unit == 'ppc':
-            return self.fetch_price(
-                'btce', [
-                    'coinmarketcap_ne',
-                    'coinmarketcap_no'
-                ],
-                unit
-            )
-        # Etherium
-        if unit == 'eth':
-            return self.fetch_price(
-                'coinmarketcap_ne', [
-                    'coinmarketcap_no'
-                ],
-                unit
-            )
-        # Ripple
-        if unit == 'xrp':
-            return self.fetch_price(
-                'coinmarketcap_ne', [
-                    'coinmarketcap_no'
-                ],
-                unit
-            )
-        # Litecoin
-        if unit == 'ltc':
-            return self.fetch_price(
-                'btce', [
-                    'coinmarketcap_ne',
-                    'coinmarketcap_no',
-                    'bitfinex'
-                ],
-                unit
-            )
+        if unit not in self.hierarchy:
+            return None
+        ranking = self.ranking(unit)
+        return self.fetch_price(ranking['main'], ranking['fallbacks'], unit,
+                                ranking['quorum'])
+
+    def ranking(self, unit):
+        """
+        Choose the main feed of a unit and the number of fallback prices to wait for.
+        The main feed is the first in the hierarchy which hasn't been demoted because
+        of a low health score, or the healthiest if they all have. Demoted feeds are
+        still asked for their price but aren't waited for
+        :param unit:
+        :return: dict with the hierarchy, main, fallbacks, quorum and demoted feeds
+        """
+        feeds = self.hierarchy.get(unit, [])
+        scores = dict((feed, feed_stats.health(feed)['score']) for feed in feeds)
+        healthy = [feed for feed in feeds if scores[feed] >= self.min_score]
+        if healthy:
+            main_feed = healthy[0]
+        else:
+            main_feed = max(feeds, key=lambda feed: scores[feed]) if feeds else None
+        fallbacks = [feed for feed in feeds if feed != main_feed]
+        return {'hierarchy': feeds,
+                'main': main_feed,
+                'fallbacks': fallbacks,
+                'quorum': min(self.quorum, len([feed for feed in fallbacks if feed in
+                                                healthy])),
+                'demoted': [feed for feed in feeds if feed not in healthy],
+                'scores': scores}
 
-    def fetch_price(self, main_feed, feeds, unit):
+    def fetch_price(self, main_feed, feeds, unit, quorum=None):
         """
-        Loop through the supplied feeds and return the first price found
+        Ask the main feed and the fallback feeds for the price at the same time.
+        The main price is used unless it is more than 5% from the average of the
+        fallback prices. Only the prices which arrive before the deadline are used, the
+        feeds which are still busy are left behind.
+        Once the main feed has answered and the quorum of fallback prices has arrived
+        the other feeds aren't waited for
         :param unit:
         :param main_feed:
         :param self:
         :param feeds:
+        :param quorum: the number of fallback prices to wait for. All of them if None
         :return:
         """
-        main_price = float(getattr(self, '{}'.format(main_feed))(unit))
-        prices = []
-        for feed in feeds:
-            fetch_price = getattr(self, '{}'.format(feed))(unit)
-            if fetch_price is not None:
-                prices.append(float(fetch_price))
-        average = float(sum(prices)) / float(len(prices))
-        if (main_price < (0.95 * average)) or (main_price > (1.05 * average)):
+        if quorum is None:
+            quorum = len(feeds)
+        deadline = time.time() + self.deadline
+        results = Queue.Queue()
+        for feed in [main_feed] + feeds:
+            fetcher = Thread(target=self.call_feed, args=(feed, unit, deadline, results))
+            fetcher.name = 'price_feed_{}_{}'.format(feed, unit)
+            fetcher.daemon = True
+            fetcher.start()
+        prices = {}
+        answered = set()
+        for x in xrange(len(feeds) + 1):
+            try:
+                feed, price = results.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            answered.add(feed)
+            if price is not None:
+                prices[feed] = price
+            fallback_count = len([f for f in feeds if f in prices])
+            # without a main price at least one fallback price is needed
+            if main_feed in answered and \
+                    fallback_count >= max(quorum, 0 if main_feed in prices else 1):
+                break
+        # score each feed by how far it is from the consensus
+        if len(prices) > 1:
+            consensus = median(prices.values())
+            for feed, price in prices.items():
+                feed_stats.record_deviation(feed, abs(price - consensus) / consensus)
+        main_price = prices.get(main_feed)
+        fallback_prices = [prices[feed] for feed in feeds if feed in prices]
+        if not fallback_prices:
+            return main_price
+        average = float(sum(fallback_prices)) / float(len(fallback_prices))
+        if main_price is None or (main_price < (0.95 * average)) or \
+                (main_price > (1.05 * average)):
             return average
         return main_price
 
+    def call_feed(self, feed, unit, deadline, results):
+        """
+        Get the price from a feed and put it on the results queue
+        :param feed:
+        :param unit:
+        :param deadline: the time after which the price is no longer wanted
+        :param results:
+        :return:
+        """
+        start = time.time()
+        try:
+            price = getattr(self, feed)(unit)
+            if price is not None:
+                price = float(price)
+        except Exception:
+            # the feed sent something which isn't a price
+            price = None
+        finished = time.time()
+        feed_stats.record(feed, finished - start, price is not None, finished > deadline)
+        results.put((feed, price))
+
     @staticmethod
     def yahoo(unit):
         """
-        Yahoo Finance feed
+        Yahoo Finance feed.
+        The rates of all the fiat units are fetched at once
         :return:
         """
+        pairs = '%2C'.join('%22USD{}%22'.format(fiat.upper()) for fiat in
+                           sorted(set(FIAT_UNITS + [unit])))
         url = 'https://query.yahooapis.com/v1/public/yql?q=select%20*%20from%20yahoo.' \
-              'finance.xchange%20where%20pair%20in%20(%22USD{}%22)&format=json&' \
+              'finance.xchange%20where%20pair%20in%20({})&format=json&' \
               'diagnostics=false&env=store%3A%2F%2Fdatatables.org%2' \
-              'Falltableswithkeys&callback='.format(unit.upper())
+              'Falltableswithkeys&callback='.format(pairs)
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'query' not in data:
             return None
@@ -257,9 +509,16 @@ class StandardPriceFetcher(object):
             return None
         if 'rate' not in data['query']['results']:
             return None
-        if 'Rate' not in data['query']['results']['rate']:
+        rates = data['query']['results']['rate']
+        # a single rate isn't returned as a list
+        if isinstance(rates, dict):
+            rates = [rates]
+        price = None
+        for rate in rates:
+            if rate.get('id') == 'USD{}'.format(unit.upper()) and 'Rate' in rate:
+                price = float(rate['Rate'])
+        if price is None:
             return None
-        price = float(data['query']['results']['rate']['Rate'])
         if unit == 'btc':
             return float(1/price)
         return price
@@ -267,21 +526,26 @@ class StandardPriceFetcher(object):
     @staticmethod
     def google_official(unit):
         """
-        Google Price feed
+        Google Price feed.
+        The rates of all the fiat units are fetched at once
         :return:
         """
-        url = 'http://www.google.com/finance/info?q=CURRENCY%3aUSD{}'.format(
-            unit.upper())
+        url = 'http://www.google.com/finance/info?q={}'.format(
+            ','.join('CURRENCY%3aUSD{}'.format(fiat.upper()) for fiat in
+                     sorted(set(FIAT_UNITS + [unit]))))
         try:
-            r = requests.get(url)
             # some odd characters to remove before we get json
-            data = r.text.replace("//", "").replace("[", "").replace("]", "")
-            data = json.loads(data)
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url).replace("//", ""))
+        except (ValueError, TypeError, AttributeError):
             return None
-        if 'l' not in data:
+        if isinstance(data, dict):
+            data = [data]
+        price = None
+        for rate in data:
+            if rate.get('t') == 'USD{}'.format(unit.upper()) and 'l' in rate:
+                price = float(rate['l'])
+        if price is None:
             return None
-        price = float(data['l'])
         if unit == 'btc':
             return float(1/price)
         return price
@@ -294,9 +558,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://www.bitstamp.net/api/eur_usd/'
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'sell' not in data:
             return None
@@ -315,9 +578,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://api.bitfinex.com/v1/pubticker/{}usd'.format(unit.lower())
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'last_price' not in data:
             return None
@@ -331,9 +593,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://blockchain.info/ticker'
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'USD' not in data:
             return None
@@ -349,9 +610,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://api.bitcoinaverage.com/ticker/global/USD'
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'last' not in data:
             return None
@@ -365,9 +625,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://coinbase.com/api/v1/prices/spot_rate?currency=USD'
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'amount' not in data:
             return None
@@ -381,9 +640,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://www.bitstamp.net/api/ticker/'
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'last' not in data:
             return None
@@ -397,9 +655,8 @@ class StandardPriceFetcher(object):
         """
         url = 'https://btc-e.com/api/2/{}_usd/ticker/'.format(unit.lower())
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'ticker' not in data:
             return None
@@ -415,9 +672,8 @@ class StandardPriceFetcher(object):
         """
         url = 'http://coinmarketcap-nexuist.rhcloud.com/api/{}'.format(unit.lower())
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'price' not in data:
             return None
@@ -433,49 +689,534 @@ class StandardPriceFetcher(object):
         """
         url = 'http://coinmarketcap.northpole.ro/api/{}.json'.format(unit.lower())
         try:
-            r = requests.get(url)
-            data = r.json()
-        except (ValueError, requests.exceptions.RequestException, TypeError):
+            data = json.loads(response_cache.get(url))
+        except (ValueError, TypeError):
             return None
         if 'price' not in data:
             return None
         return float(data['price'])
 
 
+class PriceCache(object):
+
+    def __init__(self):
+        """
+        Process wide store of the latest price for each unit.
+        The price fetcher publishes prices here so that request handlers don't need to
+        query the database for them.
+        The price threads only run in the process that started them. A forked server
+        process never sees their prices so any price older than 'prices.cache_max_age'
+        is checked against the last price in the database
+        """
+        self.lock = Lock()
+        self.prices = {}
+        self.checked = {}
+
+    def set(self, unit, price, updated=None):
+        """
+        Publish a new price for a unit along with its inverse for 'reverse' units
+        :param unit:
+        :param price:
+        :param updated: time the price was fetched. None if it isn't known
+        :return:
+        """
+        with self.lock:
+            self.prices[unit] = (float(price), 1/float(price), updated)
+            self.checked[unit] = time.time()
+
+    def get(self, app, unit):
+        """
+        Get the latest price for the unit.
+        If no price has been published recently fall back to the last price in the
+        database
+        :param app:
+        :param unit:
+        :return: tuple of price, inverse and time fetched, or None if there is no price
+        """
+        cached = self.prices.get(unit)
+        if cached is not None and time.time() - self.checked.get(unit, 0) < \
+                config.get_int(app, 'prices.cache_max_age', 60):
+            return cached
+        with database.connection(app) as conn:
+            db = conn.cursor()
+            db.execute("SELECT price, time FROM prices WHERE unit=%s ORDER BY id DESC "
+                       "LIMIT 1", (unit,))
+            db_price = db.fetchone()
+        if db_price is None or db_price[0] is None:
+            return cached
+        with self.lock:
+            # the price fetcher may have published a newer price than the one saved
+            cached = self.prices.get(unit)
+            if cached is None or cached[2] is None or cached[2] < db_price[1]:
+                self.prices[unit] = (float(db_price[0]), 1/float(db_price[0]),
+                                     db_price[1])
+            self.checked[unit] = time.time()
+            return self.prices[unit]
+
+    def age(self, unit):
+        """
+        How many seconds ago the price for the unit was fetched
+        :param unit:
+        :return: seconds or None if the age isn't known
+        """
+        cached = self.prices.get(unit)
+        if cached is None or cached[2] is None:
+            return None
+        return time.time() - cached[2]
+
+
+# the price cache shared by the whole process
+price_cache = PriceCache()
+
+
+class StreamerSubscriber(object):
+
+    def __init__(self, app, log, units, base_url='stream.tradingbot.nu', ping_port=5555,
+                 main_port=5556, secondary_port=8889, heartbeat=30, stale=120,
+                 store_interval=60, max_backoff=60):
+        """
+        Keep a subscription to the price streamer open for each unit.
+        A background thread receives the prices as they are pushed and publishes them
+        to the price cache. They are saved to the database at most once every
+        store_interval seconds.
+        A subscription which has sent nothing, not even a heartbeat, for the heartbeat
+        period is dropped and made again, waiting longer after each failed attempt
+        :param app:
+        :param log:
+        :param units: the units to subscribe to
+        :param base_url: the host of the streamer
+        :param ping_port:
+        :param main_port:
+        :param secondary_port:
+        :param heartbeat: seconds of silence after which a subscription is made again
+        :param stale: seconds without a price after which a unit is reported stale
+        :param store_interval: seconds between saving the price of a unit
+        :param max_backoff: the longest wait in seconds between subscription attempts
+        """
+        self.app = app
+        self.log = log
+        self.units = list(units)
+        self.protocol = 'tcp'
+        self.base_url = base_url
+        self.ping_port = ping_port
+        self.main_port = main_port
+        self.secondary_port = secondary_port
+        self.heartbeat = heartbeat
+        self.stale = stale
+        self.store_interval = store_interval
+        self.max_backoff = max_backoff
+        self.context = zmq.Context.instance()
+        self.session_id = uuid.uuid4()
+        # the sockets are only used by the subscriber thread
+        self.subscriptions = {}
+        self.retries = {}
+        self.last_price = {}
+        self.last_stored = {}
+        self.alarms = set()
+        self.reconnects = 0
+        self.started = time.time()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the subscriber thread
+        :return:
+        """
+        self.running = True
+        self.started = time.time()
+        self.thread = Thread(target=self.run)
+        self.thread.name = 'price_streamer'
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the subscriber thread and close the subscriptions
+        :return:
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def url(self, port):
+        return '{}://{}:{}'.format(self.protocol, self.base_url, port)
+
+    def request(self, port, message, json_reply=True):
+        """
+        Send a request to the streamer and wait a second for the reply.
+        A new socket is used for each request as a REQ socket which has timed out can't
+        be used again
+        :param port:
+        :param message:
+        :param json_reply: decode the reply as json
+        :return: the reply or None if there wasn't one
+        """
+        req_socket = self.context.socket(zmq.REQ)
+        req_socket.setsockopt(zmq.LINGER, 0)
+        req_socket.setsockopt(zmq.SNDTIMEO, 1000)
+        req_socket.setsockopt(zmq.RCVTIMEO, 1000)
+        try:
+            req_socket.connect(self.url(port))
+            req_socket.send(message)
+            return req_socket.recv_json() if json_reply else req_socket.recv()
+        except (zmq.error.ZMQError, ValueError):
+            return None
+        finally:
+            req_socket.close()
+
+    def subscribe(self, unit):
+        """
+        Ask the streamer for the port and token of a unit and start the stream
+        :param unit:
+        :return: bool
+        """
+        if self.request(self.ping_port, 'ping?', json_reply=False) != 'pong!':
+            return False
+        response = self.request(self.main_port, '{} {}:{} {}'.format(
+            self.session_id, self.base_url, self.secondary_port, unit))
+        if not isinstance(response, dict) or 'args' not in response:
+            return False
+        port, token = list(response['args'])[:2]
+        sub_socket = self.context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.LINGER, 0)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, '')
+        sub_socket.connect(self.url(port))
+        # the currency manage port is the currency port + 100
+        response = self.request(int(port) + 100, '{} {} start'.format(token,
+                                                                      self.session_id))
+        if not isinstance(response, dict) or 'args' not in response:
+            sub_socket.close()
+            return False
+        self.subscriptions[unit] = {'socket': sub_socket, 'last_message': time.time()}
+        self.publish(unit, response['args'][1])
+        return True
+
+    def run(self):
+        """
+        Subscriber thread loop
+        :return:
+        """
+        while self.running:
+            now = time.time()
+            for unit in self.units:
+                if unit in self.subscriptions:
+                    continue
+                next_attempt, backoff = self.retries.get(unit, (0, 0))
+                if now < next_attempt:
+                    continue
+                if self.subscribe(unit):
+                    self.log.info('subscribed to the streamed %s price', unit)
+                    self.retries.pop(unit, None)
+                    continue
+                backoff = min(max(backoff * 2, 1), self.max_backoff)
+                self.retries[unit] = (now + backoff, backoff)
+                self.log.warn('unable to subscribe to the streamed %s price. trying '
+                              'again in %s seconds', unit, backoff)
+            self.receive(0.5)
+            now = time.time()
+            for unit in self.subscriptions.keys():
+                if now - self.subscriptions[unit]['last_message'] > self.heartbeat:
+                    self.log.warn('price streamer silent for %s. subscribing again', unit)
+                    self.subscriptions.pop(unit)['socket'].close()
+                    self.reconnects += 1
+            self.check_stale(now)
+        for unit in self.subscriptions.keys():
+            self.subscriptions.pop(unit)['socket'].close()
+
+    def receive(self, timeout):
+        """
+        Wait for messages on the subscriptions.
+        Messages without a price are heartbeats
+        :param timeout: seconds to wait
+        :return:
+        """
+        if not self.subscriptions:
+            time.sleep(timeout)
+            return
+        poller = zmq.Poller()
+        units = {}
+        for unit, subscription in self.subscriptions.items():
+            poller.register(subscription['socket'], zmq.POLLIN)
+            units[subscription['socket']] = unit
+        for sub_socket, event in poller.poll(timeout * 1000):
+            unit = units[sub_socket]
+            message = sub_socket.recv()
+            self.subscriptions[unit]['last_message'] = time.time()
+            try:
+                data = json.loads(message)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and 'args' in data:
+                self.publish(unit, data['args'][1])
+
+    def publish(self, unit, price):
+        """
+        Put a streamed price in the price cache and the status document and save it if
+        it is time to
+        :param unit:
+        :param price:
+        :return:
+        """
+        try:
+            price = float(price)
+        except (ValueError, TypeError):
+            return
+        now = time.time()
+        price_cache.set(unit, price, now)
+        self.last_price[unit] = now
+        status_document.update(prices=price_section(self.app.config['pool'].units,
+                                                    price_cache.prices))
+        if unit in self.alarms:
+            self.log.info('streamed %s price received again', unit)
+            self.alarms.discard(unit)
+        if now - self.last_stored.get(unit, 0) < self.store_interval:
+            return
+        try:
+            with database.connection(self.app) as conn:
+                db = conn.cursor()
+                db.execute("INSERT INTO prices (unit, price) VALUES (%s,%s)", (unit,
+                                                                             price))
+                conn.commit()
+            self.last_stored[unit] = now
+        except psycopg2.Error as e:
+            self.log.error('unable to save the streamed %s price: %s', unit, e)
+
+    def check_stale(self, now):
+        """
+        Raise an alarm for each unit which hasn't had a price for too long
+        :param now:
+        :return:
+        """
+        for unit in self.units:
+            if unit in self.alarms or \
+                    now - self.last_price.get(unit, self.started) <= self.stale:
+                continue
+            self.log.error('no streamed %s price for %s seconds', unit, self.stale)
+            self.alarms.add(unit)
+
+    def fresh(self, unit):
+        """
+        Whether a streamed price has been received recently
+        :param unit:
+        :return: bool
+        """
+        return unit in self.last_price and time.time() - self.last_price[unit] <= \
+            self.stale
+
+    def stats(self):
+        """
+        Report the state of each subscription
+        :return:
+        """
+        now = time.time()
+        report = {'reconnects': self.reconnects, 'units': {}}
+        for unit in self.units:
+            report['units'][unit] = {
+                'subscribed': unit in self.subscriptions,
+                'price_age': (now - self.last_price[unit]) if unit in self.last_price
+                else None,
+                'stale': unit in self.alarms
+            }
+        return report
+
+
 class PriceFetcher(object):
 
-    def __init__(self, app, log):
+    def __init__(self, app, log, wait=True):
         self.log = log
         self.streamer = StreamerPriceFetcher()
-        self.standard = StandardPriceFetcher()
-        self.update_prices(app)
-
-    def update_prices(self, app):
-        price_timer = Timer(
-            60.0,
-            self.update_prices,
-            kwargs={'app': app}
-        )
-        price_timer.name = 'price_timer'
+        # the operator can change the feeds of a unit with '<unit>_feeds'
+        hierarchy = {}
+        for unit in app.config['units']:
+            feeds = app.config.get('prices.{}_feeds'.format(unit))
+            if feeds is None:
+                continue
+            feeds = [feed.strip() for feed in str(feeds).split(',') if feed.strip()]
+            unknown = [feed for feed in feeds if feed not in FEEDS]
+            if unknown or not feeds:
+                log.error('unknown price feeds {} for {}'.format(unknown, unit))
+                continue
+            hierarchy[unit] = feeds
+        self.standard = StandardPriceFetcher(
+            deadline=config.get_int(app, 'prices.deadline', 10), hierarchy=hierarchy,
+            quorum=config.get_int(app, 'prices.quorum', 2),
+            min_score=float(app.config.get('prices.min_score', 0.5)))
+        feed_stats.latency_scale = self.standard.deadline
+        response_cache.ttl = config.get_int(app, 'prices.cache_ttl', 30)
+        # with a subscription the streamed prices are published as they arrive and the
+        # standard feeds are only used when they go stale
+        self.subscriber = None
+        if app.config.get('prices.streamer', 'poll') == 'subscribe':
+            self.subscriber = StreamerSubscriber(
+                app, log, app.config['units'],
+                heartbeat=config.get_int(app, 'prices.heartbeat', 30),
+                stale=config.get_int(app, 'prices.stale', 120),
+                store_interval=config.get_int(app, 'prices.store_interval', 60))
+            self.subscriber.start()
+        # each unit is updated on its own schedule by a small pool of workers
+        self.app = app
+        self.lock = Lock()
+        self.queue = Queue.Queue()
+        self.timers = {}
+        self.busy = set()
+        self.updates = {}
+        self.running = True
+        for x in xrange(config.get_int(app, 'prices.workers', 4)):
+            worker = Thread(target=self.work)
+            worker.name = 'price_worker_{}'.format(x)
+            worker.daemon = True
+            worker.start()
+        self.update_prices(wait=wait)
+
+    def interval(self, unit):
+        """
+        The number of seconds between price updates for a unit.
+        Set with '<unit>_interval' in the prices section of the pool config, otherwise
+        'interval'
+        :param unit:
+        :return:
+        """
+        return float(self.app.config.get('prices.{}_interval'.format(unit),
+                                         self.app.config.get('prices.interval', 60)))
+
+    def update_prices(self, wait=True):
+        """
+        Update the price of every unit at once and wait for them all.
+        Each unit is then updated again on its own schedule.
+        Don't wait while a module is being imported. The workers can't import anything
+        until the import lock is released so they would never finish
+        :param wait:
+        :return:
+        """
+        for unit in self.app.config['units']:
+            self.submit(unit)
+        if wait:
+            self.queue.join()
+
+    def schedule(self, unit):
+        """
+        Set the timer for the next update of a unit
+        :param unit:
+        :return:
+        """
+        if not self.running:
+            return
+        price_timer = Timer(self.interval(unit), self.submit, args=(unit,))
+        price_timer.name = 'price_timer_{}'.format(unit)
         price_timer.daemon = True
         price_timer.start()
-        conn = database.get_db(app)
-        db = conn.cursor()
-        for unit in app.config['units']:
+        self.timers[unit] = price_timer
+
+    def submit(self, unit):
+        """
+        Queue an update of a unit's price unless the last one hasn't finished
+        :param unit:
+        :return:
+        """
+        self.schedule(unit)
+        with self.lock:
+            updates = self.updates.setdefault(unit, {'updated': None, 'duration': None,
+                                                     'skipped': 0})
+            if unit in self.busy:
+                updates['skipped'] += 1
+                self.log.warn('the last {} price update is still running'.format(unit))
+                return
+            self.busy.add(unit)
+        self.queue.put(unit)
+
+    def stop(self):
+        """
+        Stop scheduling price updates
+        :return:
+        """
+        self.running = False
+        for price_timer in self.timers.values():
+            price_timer.cancel()
+
+    def work(self):
+        """
+        Worker thread loop. Take units from the queue and update their prices
+        :return:
+        """
+        while True:
+            unit = self.queue.get()
+            start = time.time()
+            try:
+                self.update_price(unit)
+            except Exception as e:
+                self.log.error('price update for {} failed: {}'.format(unit, e))
+            with self.lock:
+                self.busy.discard(unit)
+                self.updates[unit]['updated'] = time.time()
+                self.updates[unit]['duration'] = time.time() - start
+            self.queue.task_done()
+
+    def fetch_price(self, unit):
+        """
+        Get the price of a unit from the streamer or, failing that, the price feeds
+        :param unit:
+        :return: the price or None
+        """
+        if self.subscriber is not None:
+            streamer_price = None
+        else:
             self.log.info('fetching price for {}'.format(unit))
             streamer_price = self.streamer.get_price(unit)
-            if streamer_price is None:
-                price = self.standard.get_price(unit)
-                self.log.warn('price streamer offline!')
-            else:
-                price = streamer_price
+        if streamer_price is not None:
+            return streamer_price
+        # a subscribed unit whose price has gone stale is reported by the subscriber
+        if self.subscriber is None or unit not in self.subscriber.subscriptions:
+            self.log.warn('price streamer offline!')
+        return self.standard.get_price(unit)
+
+    def update_price(self, unit):
+        """
+        Fetch, save and publish the price of a unit
+        :param unit:
+        :return:
+        """
+        app = self.app
+        # a fresh streamed price has already been published
+        if self.subscriber is not None and self.subscriber.fresh(unit):
+            return
+        price = self.fetch_price(unit)
+        if price is None:
+            self.log.error('unable to fetch a price for {}'.format(unit))
+            return
+        with database.connection(app) as conn:
+            db = conn.cursor()
             db.execute(
                 "INSERT INTO prices (unit, price) VALUES (%s,%s)", (
                     unit,
                     price
                 )
             )
+            conn.commit()
+            price_cache.set(unit, price, time.time())
             self.log.info('{} price set to {}'.format(unit, price))
-        conn.commit()
-        conn.close()
+            sections = {}
+            if config.get_bool(app, 'credit.running_totals'):
+                sections['current'] = {'totals': credit.get_running_totals(app, db)}
+        # rebuild the status document with the new price. only the published prices are
+        # used as asking the database for the others would need a second connection
+        sections['prices'] = price_section(app.config['pool'].units, price_cache.prices)
+        status_document.update(**sections)
 
+    def stats(self):
+        """
+        Report how fresh each unit's price is and how long its last update took
+        :return:
+        """
+        now = time.time()
+        report = {}
+        with self.lock:
+            for unit, updates in self.updates.items():
+                report[unit] = {'interval': self.interval(unit),
+                                'price_age': price_cache.age(unit),
+                                'since_update': (now - updates['updated']) if
+                                updates['updated'] is not None else None,
+                                'duration': updates['duration'],
+                                'skipped': updates['skipped'],
+                                'running': unit in self.busy}
+        return report
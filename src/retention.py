@@ -0,0 +1,190 @@
+import re
+import time
+from threading import Timer
+
+import psycopg2
+import psycopg2.errors
+from src import balances, config, database
+
+__author__ = 'sammoth'
+
+"""
+The orders, credits and prices tables are partitioned by range of their time column.
+The retention job runs every hour. It makes sure that there are partitions ready for the
+coming days and drops the partitions which are older than the retention period set in
+the 'retention' section of the pool config. Dropping a partition is much cheaper than
+deleting its rows and leaves nothing behind to vacuum.
+Adding and removing partitions has to wait for any transaction using the table, such as
+an export, and every insert queues behind it while it waits. So it only waits for
+'lock_timeout' seconds and otherwise tries again on the next run.
+A retention period of 0 keeps everything.
+"""
+
+# the partitioned tables and the config key of their retention period
+PARTITIONED = [('orders', 'retention.orders_days'),
+               ('credits', 'retention.credits_days'),
+               ('prices', 'retention.prices_days')]
+
+DAY = 86400
+
+
+def maintain(app, log, now=None):
+    """
+    Create the partitions needed soon and remove those past their retention period
+    :param app:
+    :param log:
+    :param now: the time to work from, defaults to the current time
+    :return:
+    """
+    # Set the timer going again
+    retention_timer = Timer(
+        3600.0,
+        maintain,
+        kwargs={'app': app, 'log': log}
+    )
+    retention_timer.name = 'retention_timer'
+    retention_timer.daemon = True
+    retention_timer.start()
+
+    if now is None:
+        now = time.time()
+    span = config.get_int(app, 'retention.partition_days', 1) * DAY
+    ahead = config.get_int(app, 'retention.premake_days', 7) * DAY
+    detach = config.get_bool(app, 'retention.detach')
+    lock_timeout = int(float(app.config.get('retention.lock_timeout', 5)) * 1000)
+    with database.connection(app) as conn:
+        db = conn.cursor()
+        # each table is done in its own transaction so that the locks taken on it by
+        # adding and dropping partitions are held as briefly as possible
+        for table, key in PARTITIONED:
+            try:
+                db.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+                for name in create_partitions(db, table, now, now + ahead, span):
+                    log.info('created partition %s', name)
+                days = config.get_int(app, key, 0)
+                if days > 0:
+                    for name in expire_partitions(log, db, table, now - (days * DAY),
+                                                  detach):
+                        log.info('%s partition %s', 'detached' if detach else 'dropped',
+                                 name)
+                conn.commit()
+            except psycopg2.errors.LockNotAvailable:
+                conn.rollback()
+                log.warn('retention of %s is waiting for a lock, trying again next '
+                         'hour', table)
+            except psycopg2.Error as e:
+                conn.rollback()
+                log.error('retention of %s failed: %s', table, e)
+        # the stats and round summaries are small enough to delete from
+        days = config.get_int(app, 'retention.stats_days', 0)
+        if days > 0:
+            db.execute("DELETE FROM stats WHERE time<%s", (now - (days * DAY),))
+            db.execute("DELETE FROM user_rounds WHERE time<%s", (now - (days * DAY),))
+            conn.commit()
+
+
+def partitions(db, table):
+    """
+    Get the partitions of a table
+    :param db:
+    :param table:
+    :return: list of (name, lower bound, upper bound). A bound of None is unlimited
+    """
+    db.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits "
+               "AS i INNER JOIN pg_class AS c ON c.oid = i.inhrelid WHERE i.inhparent = "
+               "%s::regclass ORDER BY c.relname", (table,))
+    found = []
+    for name, bound in db.fetchall():
+        values = re.search(r"FROM \((.+)\) TO \((.+)\)", bound)
+        if values is None:
+            continue
+        lower, upper = [None if value in ['MINVALUE', 'MAXVALUE'] else
+                        float(value.strip("'")) for value in values.groups()]
+        found.append((name, lower, upper))
+    return found
+
+
+def uncovered(ranges, start, end):
+    """
+    Find the parts of a time range which aren't covered by any partition
+    :param ranges: list of (lower, upper) bounds of the partitions
+    :param start:
+    :param end:
+    :return: list of (start, end) gaps
+    """
+    gaps = []
+    position = start
+    for lower, upper in sorted(ranges, key=lambda r: r[0] if r[0] is not None else
+                               float('-inf')):
+        if upper is not None and upper <= position:
+            continue
+        if lower is not None and lower >= end:
+            break
+        if lower is not None and lower > position:
+            gaps.append((position, lower))
+        if upper is None:
+            return gaps
+        position = upper
+    if position < end:
+        gaps.append((position, end))
+    return gaps
+
+
+def create_partitions(db, table, start, end, span):
+    """
+    Make sure that a partition exists for every row which could be saved between the
+    start and end times. New partitions start and end at multiples of the span unless
+    they fill a gap between existing partitions
+    :param db:
+    :param table:
+    :param start:
+    :param end:
+    :param span: the number of seconds each partition covers
+    :return: list of the names of the partitions created
+    """
+    db.execute("SELECT relkind FROM pg_class WHERE oid=%s::regclass", (table,))
+    if db.fetchone()[0] != 'p':
+        return []
+    ranges = [(lower, upper) for name, lower, upper in partitions(db, table)]
+    created = []
+    for gap_start, gap_end in uncovered(ranges, (start // span) * span,
+                                        -(-end // span) * span):
+        lower = gap_start
+        while lower < gap_end:
+            upper = min(((lower // span) + 1) * span, gap_end)
+            name = '{}_p{}'.format(table, time.strftime('%Y%m%d', time.gmtime(lower)))
+            db.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO "
+                       "(%s)".format(name, table), (lower, upper))
+            created.append(name)
+            lower = upper
+    return created
+
+
+def expire_partitions(log, db, table, cutoff, detach=False):
+    """
+    Drop the partitions of a table which only hold rows older than the cutoff.
+    Partitions of the credits table are only dropped once all of their credits have
+    been paid and their rewards have been archived in the balances ledger
+    :param log:
+    :param db:
+    :param table:
+    :param cutoff:
+    :param detach: detach the partitions rather than dropping them
+    :return: list of the names of the partitions removed
+    """
+    expired = []
+    for name, lower, upper in partitions(db, table):
+        if upper is None or upper > cutoff:
+            continue
+        if table == 'credits':
+            db.execute("SELECT 1 FROM {} WHERE paid=0 LIMIT 1".format(name))
+            if db.fetchone() is not None:
+                log.warn('keeping partition %s as it has unpaid credits', name)
+                continue
+            balances.archive(db, name)
+        if detach:
+            db.execute("ALTER TABLE {} DETACH PARTITION {}".format(table, name))
+        else:
+            db.execute("DROP TABLE {}".format(name))
+        expired.append(name)
+    return expired
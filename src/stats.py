@@ -0,0 +1,158 @@
+import json
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+__author__ = 'sammoth'
+
+"""
+The /status end point shows the totals, rewards and meta data of the last credit round
+along with the current prices. That data only changes when a round is credited or the
+prices are updated so the document is serialised then and served from memory.
+Only the server time and up time are added for each request.
+"""
+
+
+class Document(object):
+    """
+    A serialised status document.
+    The body is split around the values which change with each request
+    """
+    __slots__ = ('head', 'tail', 'gzip_head', 'compressor', 'etag', 'last_modified')
+
+    def __init__(self, message):
+        """
+        :param message: the message section of the status response
+        """
+        # json.dumps with sort_keys puts the message first and the status last
+        self.head = '{{"message": {}, "server_time": '.format(
+            json.dumps(message, sort_keys=True)
+        )
+        self.tail = ', "status": true}'
+        # compress the head once and keep the compressor state so each request only
+        # compresses the few bytes added to the end
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.gzip_head = self.compressor.compress(self.head)
+        self.etag = 'W/"{}"'.format(sha1(self.head).hexdigest())
+        self.last_modified = int(time.time())
+
+    def render(self, server_time, server_up_time, gzip=False):
+        """
+        Build the response body
+        :param server_time:
+        :param server_up_time:
+        :param gzip: return the body gzip compressed
+        :return: str
+        """
+        end = '{}, "server_up_time": {}{}'.format(server_time, server_up_time,
+                                                  self.tail)
+        if not gzip:
+            return self.head + end
+        compressor = self.compressor.copy()
+        return self.gzip_head + compressor.compress(end) + compressor.flush()
+
+
+class StatusDocument(object):
+
+    def __init__(self):
+        """
+        Hold the sections of the status message and the document built from them.
+        The credit round and the price threads only run in the process that started
+        them, so a forked server process builds the document again from the database
+        once it is too old
+        """
+        self.lock = Lock()
+        self.sections = {'prices': {}}
+        self.document = None
+        self.built = 0
+
+    def update(self, **sections):
+        """
+        Replace some sections of the message and build the document again.
+        Nothing is built until the stats of a credit round are known
+        :param sections: meta, totals, rewards, prices or current
+        :return: the new Document or None
+        """
+        with self.lock:
+            self.sections.update(sections)
+            if 'meta' in self.sections:
+                document = Document(self.sections)
+                # an unchanged document keeps its modified time
+                if self.document is None or self.document.etag != document.etag:
+                    self.document = document
+                self.built = time.time()
+            return self.document
+
+    def get(self, max_age=None):
+        """
+        Get the current document
+        :param max_age: seconds after being built that the document is no longer used
+        :return: Document or None if there are no stats yet or the document is too old
+        """
+        if max_age is not None and time.time() - self.built >= max_age:
+            return None
+        return self.document
+
+
+class RoundStats(object):
+
+    def __init__(self, size=500):
+        """
+        Cache of the stats written by each credit round keyed by the credit time.
+        A round's stats don't change once they are written so they are kept until the
+        cache is full, when the least recently used are dropped
+        :param size: the number of rounds to keep
+        """
+        self.size = size
+        self.lock = Lock()
+        self.rounds = OrderedDict()
+
+    def get(self, db, times):
+        """
+        Get the totals, rewards and config of the given rounds.
+        Any rounds not already cached are fetched in one query
+        :param db: database cursor returning dictionary rows
+        :param times: list of credit times
+        :return: dict of stats keyed by credit time
+        """
+        found = {}
+        with self.lock:
+            for round_time in set(times):
+                if round_time in self.rounds:
+                    found[round_time] = self.rounds.pop(round_time)
+                    self.rounds[round_time] = found[round_time]
+        missing = [round_time for round_time in set(times) if round_time not in found]
+        if not missing:
+            return found
+        db.execute("SELECT time, totals, rewards, config FROM stats WHERE time = ANY(%s)",
+                   (missing,))
+        with self.lock:
+            for row in db.fetchall():
+                found[row['time']] = {'totals': row['totals'],
+                                      'rewards': row['rewards'],
+                                      'config': row['config']}
+                self.rounds[row['time']] = found[row['time']]
+            while len(self.rounds) > self.size:
+                self.rounds.popitem(last=False)
+        return found
+
+
+def price_section(units, prices):
+    """
+    Format the prices as shown on the status document
+    :param units: the units supported by the pool
+    :param prices: dict of (price, inverse price) tuples keyed by unit
+    :return:
+    """
+    section = {}
+    for unit in units:
+        if prices.get(unit) is None:
+            continue
+        section[unit] = [round(prices[unit][0], 8), round(prices[unit][1], 8)]
+    return section
+
+
+status_document = StatusDocument()
+round_stats = RoundStats()
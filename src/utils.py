@@ -52,6 +52,27 @@ def supported_exchanges():
     return ['bittrex', 'poloniex', 'ccedk', 'bter', 'cryptsy', 'test_exchange']
 
 
+def exchange_options():
+    """
+    Keys in an exchange config which set options for the exchange rather than a unit
+    """
+    return ['pool_size']
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check whether the ETag the client already has is the current one
+    :param if_none_match: the If-None-Match request header
+    :param etag: the current quoted ETag
+    :return: bool
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # weak tags still mean the client has the same body
+    return '*' in tags or etag in tags or 'W/{}'.format(etag) in tags
+
+
 class AddressCheck(object):
     def __init__(self):
         self.b58_digits = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
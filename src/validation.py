@@ -0,0 +1,229 @@
+import Queue
+import os
+import time
+import uuid
+from threading import Thread, Lock
+
+import psycopg2.extras
+from src import config, database
+from src.price_fetcher import price_cache
+
+__author__ = 'sammoth'
+
+"""
+LPCs submit their signed 'open_orders' query through the 'liquidity' end point.
+Validating it means a round trip to the exchange, so the server can optionally accept
+the submission, queue it and let a pool of worker threads do the validation.
+The LPC is given a submission id which can be polled for the result.
+"""
+
+
+def save_orders(app, log, db, user, exchange, unit, orders):
+    """
+    Rank the validated orders against the current price and save them to the database
+    :param app:
+    :param log:
+    :param db: database cursor returning dictionary rows
+    :param user:
+    :param exchange:
+    :param unit:
+    :param orders: list of orders as returned by the exchange wrapper
+    :return: dict with success and message
+    """
+    # get the price from the price feed
+    cached_price = price_cache.get(app, unit)
+    if cached_price is None:
+        log.error('unable to fetch current price for %s -> %s', unit, user)
+        return {'success': False, 'message': 'unable to fetch current price for {}'.
+                format(unit)}
+    price, inverse_price = cached_price[:2]
+
+    # the rank details for each side, compiled when the config was loaded
+    unit_config = app.config['pool'].unit(exchange, unit)
+
+    # make sure the price is based in the correct units
+    # price from price feed is in nbt/btc we potentially need btc/nbt
+    # base this on the 'revers' parameter set in the exchange config
+    if unit_config.reverse:
+        price = inverse_price
+
+    # with running totals the round totals are kept up to date as the orders are saved
+    running_totals = config.get_bool(app, 'credit.running_totals')
+    if running_totals:
+        # wait here if a credit round is reading the totals
+        db.execute("LOCK TABLE liquidity_totals IN ROW EXCLUSIVE MODE")
+    totals = {}
+
+    # Loop through the orders
+    for order in orders:
+        # Calculate how far the order price is from the known good price
+        order_deviation = 1.00 - (min(float(order['price']), float(price)) /
+                                  max(float(order['price']), float(price)))
+        # Use the rank tolerances to determine the rank of the order
+        order_rank, tolerance = unit_config.sides[order['side']].rank(order_deviation)
+        credited = 0
+        if running_totals:
+            if is_duplicate(db, order, price):
+                # mark it now so that it isn't counted or credited
+                credited = -1
+            else:
+                key = (exchange, unit, str(order['side']), order_rank)
+                totals[key] = totals.get(key, 0.00) + float(order['amount'])
+        # save the order details
+        db.execute("INSERT INTO orders (key,rank,order_id,order_amount,side,order_price,"
+                   "server_price,exchange,unit,deviation,tolerance,credited) VALUES "
+                   "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                   (user, order_rank, str(order['id']), float(order['amount']),
+                    str(order['side']), float(order['price']), float(price), exchange,
+                    unit, float(order_deviation), tolerance, credited))
+    for key in sorted(totals):
+        db.execute("INSERT INTO liquidity_totals (exchange,unit,side,rank,amount) VALUES "
+                   "(%s,%s,%s,%s,%s) ON CONFLICT (exchange,unit,side,rank) DO UPDATE SET "
+                   "amount = liquidity_totals.amount + EXCLUDED.amount",
+                   key + (totals[key],))
+    log.info('user %s orders saved for validation', user)
+    return {'success': True, 'message': 'orders saved for validation'}
+
+
+def is_duplicate(db, order, price):
+    """
+    Check whether an order has already been saved in the current round.
+    A lock on the order details is held until the transaction ends so that the same
+    order submitted twice at once is still only counted once
+    :param db:
+    :param order: order as returned by the exchange wrapper
+    :param price: the server price the order is saved with
+    :return: bool
+    """
+    details = (str(order['id']), float(order['amount']), str(order['side']),
+               float(order['price']), float(price))
+    db.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+               (database.ORDER_LOCK, str(order['id'])))
+    db.execute("SELECT id FROM orders WHERE credited=0 AND order_id=%s AND "
+               "order_amount=%s AND side=%s AND order_price=%s AND server_price=%s "
+               "LIMIT 1", details)
+    return db.fetchone() is not None
+
+
+class ValidationQueue(object):
+
+    def __init__(self, app, log, wrappers, workers=4, size=1000, keep=600):
+        """
+        A bounded queue of liquidity submissions drained by a pool of worker threads.
+        The workers are started by the first submission. Threads aren't copied when
+        the server forks, as gunicorn does with --preload, so they are started again
+        in any process which didn't start them
+        :param app:
+        :param log:
+        :param wrappers: dict of exchange wrapper objects keyed by exchange name
+        :param workers: number of validation worker threads
+        :param size: maximum number of submissions waiting for validation
+        :param keep: number of seconds a result is kept for polling
+        """
+        self.app = app
+        self.log = log
+        self.wrappers = wrappers
+        self.keep = keep
+        self.queue = Queue.Queue(maxsize=size)
+        self.results = {}
+        self.lock = Lock()
+        self.workers = workers
+        self.pid = None
+
+    def start(self):
+        """
+        Start the worker threads if this process hasn't started them yet
+        :return:
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            for x in xrange(self.workers):
+                worker = Thread(target=self.work)
+                worker.name = 'validation_worker_{}'.format(x)
+                worker.daemon = True
+                worker.start()
+
+    def submit(self, user, exchange, unit, req, sign):
+        """
+        Queue a signed request for validation
+        :return: the submission id or None if the queue is full
+        """
+        self.start()
+        submission_id = uuid.uuid4().hex
+        with self.lock:
+            self.prune()
+            self.results[submission_id] = {'status': 'pending',
+                                           'submitted': time.time()}
+        try:
+            self.queue.put_nowait((submission_id, user, exchange, unit, req, sign))
+        except Queue.Full:
+            with self.lock:
+                del self.results[submission_id]
+            return None
+        return submission_id
+
+    def result(self, submission_id):
+        """
+        Get the state of a submission
+        :param submission_id:
+        :return: dict with the status and, once complete, the success and message
+        """
+        with self.lock:
+            if submission_id not in self.results:
+                return None
+            return self.results[submission_id].copy()
+
+    def depth(self):
+        """
+        The number of submissions waiting for a worker
+        :return:
+        """
+        return self.queue.qsize()
+
+    def prune(self):
+        """
+        Remove results which have been kept longer than allowed.
+        Must be called with the lock held
+        :return:
+        """
+        expired = time.time() - self.keep
+        for submission_id in self.results.keys():
+            if self.results[submission_id]['submitted'] < expired:
+                del self.results[submission_id]
+
+    def work(self):
+        """
+        Worker thread loop. Take submissions from the queue and validate them
+        :return:
+        """
+        while True:
+            submission = self.queue.get()
+            try:
+                result = self.validate(*submission[1:])
+            except Exception as e:
+                self.log.error('validation of %s failed: %s', submission[0], e)
+                result = {'success': False, 'message': 'validation failed'}
+            with self.lock:
+                if submission[0] in self.results:
+                    self.results[submission[0]].update(result)
+                    self.results[submission[0]]['status'] = 'complete'
+            self.queue.task_done()
+
+    def validate(self, user, exchange, unit, req, sign):
+        """
+        Use the submitted data to request the users orders and save them
+        :return: dict with success and message
+        """
+        valid = self.wrappers[exchange].validate_request(user=user, unit=unit, req=req,
+                                                         sign=sign)
+        if valid['message'] != 'success':
+            self.log.error('%s: %s -> %s', exchange, valid['message'], user)
+            return {'success': valid['success'], 'message': valid['message']}
+        with database.connection(self.app) as conn:
+            db = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            result = save_orders(self.app, self.log, db, user, exchange, unit,
+                                 valid['orders'])
+            conn.commit()
+        return result
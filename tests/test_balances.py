@@ -0,0 +1,114 @@
+import logging
+import unittest
+from os.path import join
+import bottle
+from src import balances, config, credit, database
+
+
+class TestBalances(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up the database with some registered users and orders ready for a credit
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        # set us up a bottle application with correct config
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        database.build(self.app, self.log, log_output=False)
+        self.conn = database.get_db(self.app)
+        self.db = self.conn.cursor()
+        for table in ['users', 'orders', 'credits', 'balances']:
+            self.db.execute("DELETE FROM {}".format(table))
+        # 2 registered users each with 100 NBT on each side and rank of btc
+        for i in xrange(2):
+            self.db.execute("INSERT INTO users (key,address,exchange,unit) VALUES "
+                            "(%s,%s,%s,%s)", ('TEST_USER_{}'.format(i + 1),
+                                              'ADDRESS_{}'.format(i + 1),
+                                              'test_exchange', 'btc'))
+            for side in ['ask', 'bid']:
+                for rank in ['rank_1', 'rank_2']:
+                    self.db.execute("INSERT INTO orders (key,rank,order_id,order_amount,"
+                                    "side,exchange,unit,credited) VALUES "
+                                    "(%s,%s,%s,%s,%s,%s,%s,%s)",
+                                    ('TEST_USER_{}'.format(i + 1), rank,
+                                     '{}.{}.{}'.format(i, side, rank), 100, side,
+                                     'test_exchange', 'btc', 0))
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.db.execute("DELETE FROM users")
+        self.conn.commit()
+        self.conn.close()
+
+    def fetch_balances(self):
+        self.db.execute("SELECT key, address, earned, unpaid, paid FROM balances ORDER "
+                        "BY key")
+        return self.db.fetchall()
+
+    def test_credit_updates_balances(self):
+        credit.credit(self.app, self.log)
+        credit.credit(self.app, self.log)
+        # target for btc is 2500 and 800 is provided so the reward is 0.32 of 0.025.
+        # each side gets half of that and the users provide half of each rank 1.
+        # the second round has nothing to credit
+        reward = 2 * (0.025 * 0.32 * 0.5 * 0.5)
+        found = self.fetch_balances()
+        self.assertEqual([row[:2] for row in found], [('TEST_USER_1', 'ADDRESS_1'),
+                                                      ('TEST_USER_2', 'ADDRESS_2')])
+        for row in found:
+            self.assertAlmostEqual(row[2], reward)
+            self.assertAlmostEqual(row[3], reward)
+            self.assertEqual(row[4], 0)
+        self.assertListEqual(balances.check(self.db), [])
+
+    def test_key_with_several_addresses(self):
+        """
+        A key registered more than once is paid its reward once, to the address it was
+        registered with first
+        :return:
+        """
+        self.db.execute("INSERT INTO users (key,address,exchange,unit) VALUES "
+                        "(%s,%s,%s,%s)", ('TEST_USER_1', 'ADDRESS_3', 'test_exchange',
+                                          'ppc'))
+        self.conn.commit()
+        credit.credit(self.app, self.log)
+        reward = 2 * (0.025 * 0.32 * 0.5 * 0.5)
+        due = balances.unpaid(self.db)
+        self.assertEqual([row[:2] for row in due], [('TEST_USER_1', 'ADDRESS_1'),
+                                                    ('TEST_USER_2', 'ADDRESS_2')])
+        self.assertAlmostEqual(due[0][2], reward)
+        self.assertListEqual(balances.check(self.db), [])
+
+    def test_settle(self):
+        credit.credit(self.app, self.log)
+        self.assertEqual([row[:2] for row in balances.unpaid(self.db)],
+                         [('TEST_USER_1', 'ADDRESS_1'), ('TEST_USER_2', 'ADDRESS_2')])
+        balances.settle(self.db, ['TEST_USER_1'], 1000)
+        self.conn.commit()
+        found = self.fetch_balances()
+        self.assertEqual(found[0][3], 0)
+        self.assertEqual(found[0][4], found[0][2])
+        self.assertEqual(found[1][3], found[1][2])
+        self.db.execute("SELECT key, paid, COUNT(id) FROM credits GROUP BY key, paid "
+                        "ORDER BY key")
+        self.assertEqual(self.db.fetchall(), [('TEST_USER_1', 1, 4),
+                                              ('TEST_USER_2', 0, 4)])
+        self.assertListEqual(balances.check(self.db), [])
+
+    def test_check_and_rebuild(self):
+        credit.credit(self.app, self.log)
+        self.db.execute("UPDATE balances SET unpaid=unpaid+1 WHERE key=%s",
+                        ('TEST_USER_2',))
+        wrong = balances.check(self.db)
+        self.assertEqual(len(wrong), 1)
+        self.assertEqual(wrong[0][0], 'TEST_USER_2')
+        balances.rebuild(self.db)
+        self.assertListEqual(balances.check(self.db), [])
@@ -1,7 +1,9 @@
 import json
 import logging
+import shutil
+import tempfile
 import unittest
-from os import remove
+from os import remove, utime
 from os.path import join, isfile
 import bottle
 from src import config
@@ -29,6 +31,35 @@ class TestConfig(unittest.TestCase):
         if isfile('test_exchange_config'):
             remove('test_exchange_config')
 
+    def test_pool_side_sorted_by_tolerance(self):
+        unit = self.app.config['pool'].unit('test_exchange', 'ppc')
+        self.assertEqual(unit.reward, 0.0250)
+        self.assertEqual(unit.target, 1500)
+        self.assertFalse(unit.reverse)
+        side = unit.bid
+        self.assertEqual(side.ratio, 0.4)
+        self.assertEqual(side.rank_names, ('rank_1', 'rank_2'))
+        self.assertEqual(side.tolerances, (0.0105, 1.00))
+        self.assertEqual(side.rank_ratios, (0.8, 0.2))
+        self.assertAlmostEqual(side.ranks[0].share, 0.008)
+
+    def test_pool_side_rank(self):
+        side = self.app.config['pool'].unit('test_exchange', 'btc').ask
+        self.assertEqual(side.rank(0.0), ('rank_1', 0.0105))
+        self.assertEqual(side.rank(0.0105), ('rank_1', 0.0105))
+        self.assertEqual(side.rank(0.0106), ('rank_2', 1.00))
+        self.assertEqual(side.rank(1.5), ('', 1.00))
+
+    def test_pool_exchanges(self):
+        pool = self.app.config['pool']
+        self.assertListEqual(pool.exchanges.keys(), ['test_exchange'])
+        self.assertListEqual(pool.exchanges['test_exchange'].units.keys(),
+                             [u'ppc', u'btc'])
+        self.assertEqual(pool.exchanges['test_exchange'].pool_size, 10)
+        self.assertEqual(pool.units, (u'ppc', u'btc'))
+        self.assertIsNone(pool.unit('test_exchange', 'usd'))
+        self.assertIsNone(pool.unit('not_an_exchange', 'btc'))
+
     def test_json_config_btc_reward(self):
         self.assertEqual(self.app.config['test_exchange.btc.reward'], 0.0250)
 
@@ -432,6 +463,29 @@ class TestConfig(unittest.TestCase):
         self.assertFalse(check[0])
         self.assertEqual(check[1], "The ask and bid ratios don't add up to 1.0")
 
+    def test_exchange_config_zero_pool_size(self):
+        bad_config = self.exchange_test_data()
+        bad_config['test_exchange']['pool_size'] = 0
+        self.build_exchange_config_file(json.dumps(bad_config))
+        check = config.check_exchange_config('test_exchange_config')
+        self.assertFalse(check[0])
+        self.assertEqual(check[1], 'The pool_size set for test_exchange is incorrect')
+
+    def test_exchange_config_bool_pool_size(self):
+        bad_config = self.exchange_test_data()
+        bad_config['test_exchange']['pool_size'] = True
+        self.build_exchange_config_file(json.dumps(bad_config))
+        check = config.check_exchange_config('test_exchange_config')
+        self.assertFalse(check[0])
+        self.assertEqual(check[1], 'The pool_size set for test_exchange is incorrect')
+
+    def test_exchange_config_pool_size(self):
+        pool_config = self.exchange_test_data()
+        pool_config['test_exchange']['pool_size'] = 20
+        self.build_exchange_config_file(json.dumps(pool_config))
+        check = config.check_exchange_config('test_exchange_config')
+        self.assertTrue(check[0])
+
     def test_exchange_config_full(self):
         full_config = self.exchange_test_data()
         self.build_exchange_config_file(json.dumps(full_config))
@@ -439,3 +493,68 @@ class TestConfig(unittest.TestCase):
         print check
         self.assertTrue(check[0])
 
+    def copy_config(self):
+        """
+        Load the app from a copy of the test config which can be changed
+        :return: path of the exchange config in the copy
+        """
+        config_dir = join(tempfile.mkdtemp(), 'config')
+        self.addCleanup(shutil.rmtree, config_dir.rsplit('/', 1)[0])
+        shutil.copytree(join('tests', 'config'), config_dir)
+        config.load(self.app, self.log, config_dir, log_output=False)
+        return join(config_dir, 'exchanges', 'test_exchange.json')
+
+    def test_reload_unchanged(self):
+        self.copy_config()
+        pool = self.app.config['pool']
+        self.assertFalse(config.reload(self.app, self.log))
+        self.assertIs(self.app.config['pool'], pool)
+
+    def test_reload_changed(self):
+        exchange_file = self.copy_config()
+        self.app.config['start_time'] = 1234
+        conf = self.app.config
+        pool = conf['pool']
+        changed = []
+        # the hook is given the key and value last
+        self.app.add_hook('config', lambda *args: changed.append(args[-2]))
+        with open(exchange_file) as exchange:
+            exchange_config = json.load(exchange)
+        exchange_config['test_exchange']['btc']['reward'] = 0.05
+        with open(exchange_file, 'w') as exchange:
+            json.dump(exchange_config, exchange)
+        utime(exchange_file, (1, 1))
+        self.assertTrue(config.reload(self.app, self.log))
+        # the app keeps its config and its hooks hear about the change
+        self.assertIs(self.app.config, conf)
+        self.assertIn('test_exchange.btc.reward', changed)
+        self.assertNotIn('test_exchange.ppc.reward', changed)
+        # the old pool is left as it was
+        self.assertEqual(pool.unit('test_exchange', 'btc').reward, 0.0250)
+        self.assertEqual(self.app.config['test_exchange.btc.reward'], 0.05)
+        self.assertEqual(
+            self.app.config['pool'].unit('test_exchange', 'btc').reward, 0.05
+        )
+        self.assertEqual(self.app.config['start_time'], 1234)
+        # the /exchanges response is rebuilt with the config
+        self.assertNotEqual(self.app.config['pool'].exchanges_etag, pool.exchanges_etag)
+        self.assertEqual(json.loads(self.app.config['pool'].exchanges_body)
+                         ['test_exchange']['btc']['reward'], 0.05)
+        self.assertFalse(config.reload(self.app, self.log))
+
+    def test_install_removes_stale_keys(self):
+        self.copy_config()
+        self.app.config['start_time'] = 1234
+        snapshot = config.build(self.log, self.app.config['config_dir'], False)
+        del snapshot['test_exchange.btc.reward']
+        config.install(self.app, snapshot)
+        self.assertNotIn('test_exchange.btc.reward', self.app.config)
+        self.assertEqual(self.app.config['start_time'], 1234)
+
+    def test_reload_invalid(self):
+        exchange_file = self.copy_config()
+        pool = self.app.config['pool']
+        with open(exchange_file, 'w') as exchange:
+            exchange.write('not json')
+        self.assertFalse(config.reload(self.app, self.log))
+        self.assertIs(self.app.config['pool'], pool)
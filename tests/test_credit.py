@@ -1,9 +1,11 @@
+import json
 import logging
 import unittest
 import time
 from os.path import join
 import bottle
-from src import credit, database, config
+import psycopg2.extras
+from src import credit, database, config, stats
 
 
 class TestCredits(unittest.TestCase):
@@ -29,6 +31,7 @@ class TestCredits(unittest.TestCase):
         c = conn.cursor()
         c.execute("DELETE FROM orders")
         c.execute("DELETE FROM credits")
+        c.execute("DELETE FROM user_rounds")
         conn.commit()
         # create test data
         # 5 test users each with 100 NBT on each exchange/pair/side/rank
@@ -100,6 +103,18 @@ class TestCredits(unittest.TestCase):
                                                                 'rank_2': 500.0},
                                                         'total': 2000.0}}})
 
+    def test_get_total_liquidity_sql(self):
+        """
+        The totals calculated in the database should match those calculated in memory
+        :return:
+        """
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SELECT MAX(id) FROM orders")
+        self.assertDictEqual(credit.get_total_liquidity_sql(self.app, c, c.fetchone()[0]),
+                             self.total_liquidity)
+        conn.close()
+
     def test_calculate_reward(self):
         """
         Test the calculate_reward function
@@ -165,3 +180,235 @@ class TestCredits(unittest.TestCase):
                              float(self.rewards[cred[3]][cred[4]][cred[6]][cred[5]]) *
                              0.2)
             self.assertEqual(cred[11], 0)
+
+    def test_crediting_builds_status(self):
+        """
+        The credit round should build the status document from its stats
+        :return:
+        """
+        credit.credit(self.app, self.log)
+        body = json.loads(stats.status_document.get().render(1000, 10))
+        self.assertEqual(body['message']['meta']['number-of-orders'], 40)
+        self.assertDictEqual(body['message']['rewards'], self.rewards)
+        self.assertDictEqual(body['message']['totals'], self.total_liquidity)
+
+    def test_old_status_is_not_used(self):
+        """
+        A status document which is too old shouldn't be used but rebuilding it without
+        changes should keep its modified time
+        :return:
+        """
+        credit.credit(self.app, self.log)
+        document = stats.status_document.get(60)
+        self.assertIsNotNone(document)
+        self.assertIsNone(stats.status_document.get(0))
+        sections = stats.status_document.sections
+        self.assertIs(stats.status_document.update(meta=sections['meta']), document)
+        self.assertIs(stats.status_document.get(60), document)
+
+    def test_round_stats(self):
+        """
+        The stats of a round should only be fetched from the database once
+        :return:
+        """
+        credit.credit(self.app, self.log)
+        conn = database.get_db(self.app)
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute("SELECT time FROM stats ORDER BY id DESC LIMIT 1")
+        round_time = c.fetchone()['time']
+        round_stats = stats.RoundStats(size=1)
+        rounds = round_stats.get(c, [round_time, round_time])
+        self.assertDictEqual(rounds[round_time]['totals'], self.total_liquidity)
+        self.assertDictEqual(rounds[round_time]['rewards'], self.rewards)
+        # the cached round is used without touching the database
+        c.close()
+        self.assertIs(round_stats.get(c, [round_time])[round_time], rounds[round_time])
+        conn.close()
+
+    def test_user_rounds(self):
+        """
+        Each round should be summarised for each user
+        :return:
+        """
+        credit.credit(self.app, self.log)
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        # move the first round back in time and credit the orders again
+        c.execute("UPDATE credits SET time=time-60")
+        c.execute("UPDATE user_rounds SET time=time-60")
+        c.execute("UPDATE orders SET credited=0")
+        conn.commit()
+        credit.credit(self.app, self.log)
+        c.execute("SELECT provided, reward FROM user_rounds WHERE key=%s ORDER BY time",
+                  ('TEST_USER_1',))
+        rounds = c.fetchall()
+        self.assertEqual(len(rounds), 2)
+        # 8 orders of 100 earning 20% of each rank reward
+        reward = 0.2 * sum(self.rewards['test_exchange'][unit][side][rank]
+                           for unit in ['btc', 'ppc'] for side in ['ask', 'bid']
+                           for rank in ['rank_1', 'rank_2'])
+        for provided, round_reward in rounds:
+            self.assertEqual(provided, 800)
+            self.assertAlmostEqual(round_reward, reward)
+        conn.close()
+
+    def test_crediting_marks_orders(self):
+        """
+        Test that credited orders and duplicates are marked as such
+        :return:
+        """
+        self.check_crediting_marks_orders()
+
+    def test_crediting_marks_orders_sql_dedup(self):
+        """
+        Test that duplicates found in the database are marked in the same way
+        :return:
+        """
+        self.app.config['credit.dedup'] = 'sql'
+        self.check_crediting_marks_orders()
+
+    def check_crediting_marks_orders(self):
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        # resubmit an order which is already waiting to be credited
+        c.execute("INSERT INTO orders (key,rank,order_id,order_amount,side,exchange,unit,"
+                  "credited) SELECT key,rank,order_id,order_amount,side,exchange,unit,"
+                  "credited FROM orders ORDER BY id LIMIT 1")
+        conn.commit()
+        credit.credit(self.app, self.log)
+        c.execute("SELECT credited, COUNT(id) FROM orders GROUP BY credited")
+        self.assertDictEqual(dict(c.fetchall()), {1: 40, -1: 1})
+        c.execute("SELECT COUNT(id) FROM credits")
+        self.assertEqual(c.fetchone()[0], 40)
+        c.execute("SELECT meta->'number-of-duplicates' FROM stats ORDER BY id DESC "
+                  "LIMIT 1")
+        self.assertEqual(c.fetchone()[0], 1)
+        conn.close()
+
+    def test_crediting_sql(self):
+        """
+        Crediting in the database should give the same credits as crediting in memory
+        :return:
+        """
+        self.check_crediting_mode('credit.aggregation', 'sql')
+
+    def test_crediting_stream(self):
+        """
+        Streaming the orders in chunks should give the same credits as crediting in
+        memory
+        :return:
+        """
+        self.app.config['credit.chunk_size'] = '7'
+        self.check_crediting_mode('credit.stream', 'true')
+
+    def test_crediting_sql_leaves_late_orders(self):
+        """
+        An order committed while a round runs should be left for the next round even if
+        its id is below the round's watermark
+        :return:
+        """
+        self.app.config['credit.aggregation'] = 'sql'
+        self.check_late_order_is_left()
+
+    def test_unknown_ranks_are_skipped(self):
+        """
+        Orders of a rank with no reward shouldn't be credited or counted, in this round
+        or the next
+        :return:
+        """
+        self.check_unknown_ranks_are_skipped()
+
+    def test_unknown_ranks_are_skipped_sql(self):
+        self.app.config['credit.aggregation'] = 'sql'
+        self.check_unknown_ranks_are_skipped()
+
+    def check_unknown_ranks_are_skipped(self):
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("INSERT INTO orders (key,rank,order_id,order_amount,side,exchange,unit,"
+                  "credited) VALUES (%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id",
+                  ('TEST_USER_1', 'rank_9', 999, 100, 'ask', 'test_exchange', 'btc', 0))
+        unknown_id = c.fetchone()[0]
+        conn.commit()
+        credit.credit(self.app, self.log)
+        c.execute("SELECT credited FROM orders WHERE id=%s", (unknown_id,))
+        self.assertEqual(c.fetchone()[0], -2)
+        c.execute("SELECT COUNT(id) FROM orders WHERE credited=1")
+        self.assertEqual(c.fetchone()[0], 40)
+        c.execute("SELECT COUNT(id) FROM credits WHERE order_id=%s", (unknown_id,))
+        self.assertEqual(c.fetchone()[0], 0)
+        # the next round has nothing left to credit
+        credit.credit(self.app, self.log)
+        c.execute("SELECT meta->'number-of-orders' FROM stats ORDER BY id DESC LIMIT 1")
+        self.assertEqual(c.fetchone()[0], 0)
+        c.execute("SELECT credited FROM orders WHERE id=%s", (unknown_id,))
+        self.assertEqual(c.fetchone()[0], -2)
+        conn.close()
+
+    def test_crediting_stream_leaves_late_orders(self):
+        """
+        Both passes over the streamed orders should see the same orders
+        :return:
+        """
+        self.app.config['credit.chunk_size'] = '7'
+        self.app.config['credit.stream'] = 'true'
+        self.check_late_order_is_left()
+
+    def check_late_order_is_left(self):
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        # take out an order to commit again once the round has its snapshot
+        c.execute("DELETE FROM orders WHERE id=(SELECT MIN(id) FROM orders) RETURNING "
+                  "id,key,rank,order_id,order_amount,side,exchange,unit")
+        late_order = c.fetchone()
+        conn.commit()
+        calculate_reward = credit.calculate_reward
+
+        def commit_late_order(app, totals):
+            c.execute("INSERT INTO orders (id,key,rank,order_id,order_amount,side,"
+                      "exchange,unit,credited) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,0)",
+                      late_order)
+            conn.commit()
+            return calculate_reward(app, totals)
+
+        credit.calculate_reward = commit_late_order
+        try:
+            credit.credit(self.app, self.log)
+        finally:
+            credit.calculate_reward = calculate_reward
+        c.execute("SELECT credited FROM orders WHERE id=%s", (late_order[0],))
+        self.assertEqual(c.fetchone()[0], 0)
+        c.execute("SELECT COUNT(id) FROM credits WHERE order_id=%s", (late_order[0],))
+        self.assertEqual(c.fetchone()[0], 0)
+        # the shares of each rank are of the orders which were credited
+        c.execute("SELECT SUM(percentage) FROM credits GROUP BY exchange, unit, side, "
+                  "rank")
+        for total, in c.fetchall():
+            self.assertAlmostEqual(total, 100)
+        conn.close()
+
+    def check_crediting_mode(self, key, value):
+        credit.credit(self.app, self.log)
+        python_credits = self.fetch_credits()
+        # put the orders back to be credited again
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("DELETE FROM credits")
+        c.execute("UPDATE orders SET credited=0")
+        conn.commit()
+        conn.close()
+        self.app.config[key] = value
+        credit.credit(self.app, self.log)
+        self.assertEqual(self.fetch_credits(), python_credits)
+
+    def fetch_credits(self):
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SELECT key,exchange,unit,rank,side,order_id,provided,percentage,"
+                  "reward,paid FROM credits ORDER BY order_id")
+        credits = c.fetchall()
+        c.execute("SELECT meta->'number-of-orders', meta->'number-of-users-active' FROM "
+                  "stats ORDER BY id DESC LIMIT 1")
+        credits.append(c.fetchone())
+        conn.close()
+        return credits
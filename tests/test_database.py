@@ -0,0 +1,72 @@
+import logging
+import time
+import unittest
+from threading import Thread
+from os.path import join
+import bottle
+from src import config, database
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Build the database twice to show that migrations can be re-run
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        database.build(self.app, self.log, log_output=False)
+        database.build(self.app, self.log, log_output=False)
+
+    def test_schema_version(self):
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SELECT value FROM info WHERE key=%s", ('schema_version',))
+        self.assertEqual(int(c.fetchone()[0]), database.MIGRATIONS[-1][0])
+        conn.close()
+
+    def test_uncredited_orders_index(self):
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SELECT indexdef FROM pg_indexes WHERE indexname=%s",
+                  ('orders_uncredited_idx',))
+        self.assertIn('WHERE (credited = 0)', c.fetchone()[0])
+        conn.close()
+
+    def test_pool_waits_for_connection(self):
+        """
+        Borrowing from an exhausted pool should wait for a connection to be returned
+        :return:
+        """
+        pool = database.ConnectionPool(1, 1, **database.connection_args(self.app))
+        conn = pool.getconn()
+        returned = Thread(target=lambda: (time.sleep(0.2), pool.putconn(conn)))
+        returned.start()
+        second = pool.getconn()
+        pool.putconn(second)
+        returned.join()
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['saturated_checkouts'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertGreaterEqual(stats['max_wait'], 0.1)
+
+    def test_connection_is_rolled_back(self):
+        """
+        Anything not committed should be rolled back when a connection is returned
+        :return:
+        """
+        with database.connection(self.app) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE info SET value=%s WHERE key=%s", (-1, 'schema_version'))
+        with database.connection(self.app) as conn:
+            c = conn.cursor()
+            c.execute("SELECT value FROM info WHERE key=%s", ('schema_version',))
+            self.assertEqual(int(c.fetchone()[0]), database.MIGRATIONS[-1][0])
@@ -0,0 +1,65 @@
+import BaseHTTPServer
+import SocketServer
+import unittest
+from threading import Thread
+from src.exchanges import ExchangeSession
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer every request with a short keep-alive response
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestExchangeSession(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Start a local server which can be reached as several hosts
+        :return:
+        """
+        self.server = Server(('0.0.0.0', 0), Handler)
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.session = ExchangeSession(2)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_stats(self):
+        for x in xrange(3):
+            self.session.get('http://127.0.0.1:{}/'.format(self.server.server_port))
+        self.assertDictEqual(self.session.connection_stats(),
+                             {'requests': 3, 'new_connections': 1,
+                              'reused_connections': 2})
+
+    def test_closed_pools_are_counted(self):
+        """
+        The requests to hosts whose pools have been closed to make room for others
+        should still be counted
+        :return:
+        """
+        for host in xrange(1, 7):
+            for x in xrange(2):
+                self.session.get('http://127.0.0.{}:{}/'.format(host,
+                                                                self.server.server_port))
+        self.assertDictEqual(self.session.connection_stats(),
+                             {'requests': 12, 'new_connections': 6,
+                              'reused_connections': 6})
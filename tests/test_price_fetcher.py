@@ -0,0 +1,377 @@
+import json
+import logging
+import time
+import unittest
+from threading import Event, Lock, Thread
+from os.path import join
+import bottle
+from src import config, database, price_fetcher, stats
+from src.price_fetcher import FeedStats, PriceCache, PriceFetcher, ResponseCache, \
+    StandardPriceFetcher, feed_stats, price_cache
+
+
+def wait_for(check, timeout=10):
+    """
+    Wait until the check passes
+    :param check: function returning bool
+    :param timeout:
+    :return: whether the check passed
+    """
+    end = time.time() + timeout
+    while time.time() < end:
+        if check():
+            return True
+        time.sleep(0.01)
+    return check()
+
+
+class TestPriceCache(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Put a known price in the database
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        database.build(self.app, self.log, log_output=False)
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("INSERT INTO prices (unit, price) VALUES (%s, %s)", ('ppc', 4.0))
+        conn.commit()
+        conn.close()
+        self.cache = PriceCache()
+
+    def test_cold_cache_uses_database(self):
+        self.assertEqual(self.cache.get(self.app, 'ppc')[:2], (4.0, 0.25))
+        self.assertLess(self.cache.age('ppc'), 30)
+
+    def test_old_price_is_read_again(self):
+        """
+        A process which doesn't fetch the prices itself should pick up the prices
+        saved by the one that does
+        :return:
+        """
+        self.assertEqual(self.cache.get(self.app, 'ppc')[0], 4.0)
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("INSERT INTO prices (unit, price) VALUES (%s, %s)", ('ppc', 5.0))
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.cache.get(self.app, 'ppc')[0], 4.0)
+        self.app.config['prices.cache_max_age'] = '0'
+        self.assertEqual(self.cache.get(self.app, 'ppc')[0], 5.0)
+
+    def test_newer_published_price_is_kept(self):
+        self.cache.set('ppc', 2.0, time.time() + 60)
+        self.app.config['prices.cache_max_age'] = '0'
+        self.assertEqual(self.cache.get(self.app, 'ppc')[0], 2.0)
+
+    def test_published_price(self):
+        self.cache.set('ppc', 2.0, time.time() - 30)
+        self.assertEqual(self.cache.get(self.app, 'ppc')[:2], (2.0, 0.5))
+        self.assertAlmostEqual(self.cache.age('ppc'), 30, delta=5)
+
+
+class SlowFeeds(StandardPriceFetcher):
+    """
+    Price feeds which answer after a delay
+    """
+    # the slow feed answers once this is set
+    release = Event()
+
+    @staticmethod
+    def quick_main(unit):
+        return 100.0
+
+    @staticmethod
+    def quick_fallback(unit):
+        return 101.0
+
+    @staticmethod
+    def far_fallback(unit):
+        return 120.0
+
+    @staticmethod
+    def broken_feed(unit):
+        return {'error': 'not a price'}
+
+    @staticmethod
+    def failing_feed(unit):
+        return None
+
+    @staticmethod
+    def slow_feed(unit):
+        SlowFeeds.release.wait(10)
+        return 200.0
+
+
+class TestStandardPriceFetcher(unittest.TestCase):
+
+    def setUp(self):
+        SlowFeeds.release = Event()
+        self.fetcher = SlowFeeds(deadline=0.2)
+
+    def tearDown(self):
+        SlowFeeds.release.set()
+
+    def test_slow_feed_is_left_behind(self):
+        """
+        The price should be found from the feeds which answer before the deadline
+        :return:
+        """
+        late = feed_stats.stats().get('slow_feed', {}).get('late', 0)
+        self.assertEqual(self.fetcher.fetch_price('quick_main', ['quick_fallback',
+                                                                 'slow_feed'], 'btc'),
+                         100.0)
+        # the slow feed hasn't answered yet. let it answer once the deadline has passed
+        self.assertFalse(SlowFeeds.release.is_set())
+        time.sleep(0.3)
+        SlowFeeds.release.set()
+        self.assertTrue(wait_for(lambda: feed_stats.stats()['slow_feed']['late'] > late))
+        self.assertEqual(feed_stats.stats()['quick_main']['failures'], 0)
+
+    def test_main_feed_deviates(self):
+        self.assertEqual(self.fetcher.fetch_price('quick_main', ['quick_fallback',
+                                                                 'far_fallback'], 'btc'),
+                         110.5)
+
+    def test_main_feed_missing(self):
+        self.assertEqual(self.fetcher.fetch_price('slow_feed', ['quick_fallback',
+                                                                'broken_feed'], 'btc'),
+                         101.0)
+        self.assertGreaterEqual(feed_stats.stats()['broken_feed']['failures'], 1)
+
+    def test_no_price(self):
+        self.assertIsNone(self.fetcher.fetch_price('slow_feed', ['broken_feed'], 'btc'))
+
+    def test_failing_feed_is_demoted(self):
+        """
+        A feed which keeps failing should stop being the main feed and the price should
+        be used once the quorum has answered
+        :return:
+        """
+        # the deadline is long enough that the slow feed answers first if it is waited
+        # for
+        fetcher = SlowFeeds(deadline=30, quorum=1, hierarchy={
+            'tst': ['failing_feed', 'quick_main', 'quick_fallback', 'slow_feed']})
+        slow_requests = lambda: feed_stats.stats().get('slow_feed', {}).get('requests', 0)
+        requests = slow_requests()
+        self.assertEqual(fetcher.get_price('tst'), 100.0)
+        ranking = fetcher.ranking('tst')
+        self.assertEqual(ranking['main'], 'quick_main')
+        self.assertListEqual(ranking['demoted'], ['failing_feed'])
+        self.assertEqual(ranking['quorum'], 1)
+        self.assertEqual(fetcher.get_price('tst'), 100.0)
+        # neither price waited for the slow feed to answer
+        self.assertEqual(slow_requests(), requests)
+        SlowFeeds.release.set()
+        self.assertTrue(wait_for(lambda: slow_requests() == requests + 2))
+
+
+class TestFeedStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = FeedStats(window=10, latency_scale=1.0)
+
+    def test_health(self):
+        for x in xrange(10):
+            self.stats.record('feed', 0.1 * (x + 1), x < 8, False)
+            self.stats.record_deviation('feed', 0.01)
+        health = self.stats.health('feed')
+        self.assertAlmostEqual(health['p50_latency'], 0.6)
+        self.assertAlmostEqual(health['p95_latency'], 1.0)
+        self.assertAlmostEqual(health['error_rate'], 0.2)
+        self.assertAlmostEqual(health['deviation'], 0.01)
+        # 0.8 answered, 0.8 of the way to the consensus and half speed
+        self.assertAlmostEqual(health['score'], 0.32)
+        self.assertEqual(self.stats.stats()['feed']['requests'], 10)
+
+    def test_window(self):
+        """
+        Only recent requests should count towards the health of a feed
+        :return:
+        """
+        for x in xrange(20):
+            self.stats.record('feed', 0, x >= 10, False)
+        self.assertEqual(self.stats.health('feed')['error_rate'], 0)
+        self.stats.record_deviation('feed', 0.1)
+        self.assertEqual(self.stats.health('feed')['score'], 0)
+
+    def test_unknown_feed(self):
+        self.assertEqual(self.stats.health('feed')['score'], 1.0)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.fetched = []
+        # fetches wait for this to be set
+        self.release = Event()
+        self.release.set()
+        self.cache = ResponseCache(ttl=30, fetch=self.fetch)
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        self.release.wait(10)
+        return '{{"url": "{}"}}'.format(url)
+
+    def test_concurrent_requests_are_shared(self):
+        """
+        Many requests for the same url at once should only fetch it once
+        :return:
+        """
+        bodies = []
+        self.release.clear()
+        threads = [Thread(target=lambda: bodies.append(self.cache.get('a')))
+                   for x in xrange(5)]
+        for thread in threads:
+            thread.start()
+        # finish the fetch once the other requests are waiting for it
+        self.assertTrue(wait_for(lambda: self.cache.stats()['hits'] == 4))
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual(bodies, ['{"url": "a"}'] * 5)
+        self.assertListEqual(self.fetched, ['a'])
+        self.assertDictEqual(self.cache.stats(), {'requests': 1, 'hits': 4})
+
+    def test_responses_expire(self):
+        self.cache.get('a')
+        self.cache.get('a')
+        self.assertListEqual(self.fetched, ['a'])
+        self.cache.ttl = 0
+        self.cache.get('a')
+        self.assertListEqual(self.fetched, ['a', 'a'])
+
+    def test_batched_fiat_rates(self):
+        """
+        The yahoo rates of all the fiat units should come from one request
+        :return:
+        """
+        rates = {'query': {'results': {'rate': [
+            {'id': 'USD{}'.format(unit.upper()), 'Rate': str(i + 2)} for i, unit in
+            enumerate(price_fetcher.FIAT_UNITS)]}}}
+        fetched = []
+        shared_cache = price_fetcher.response_cache
+        price_fetcher.response_cache = ResponseCache(
+            fetch=lambda url: fetched.append(url) or json.dumps(rates))
+        try:
+            self.assertEqual(StandardPriceFetcher.yahoo('btc'), 0.5)
+            self.assertEqual(StandardPriceFetcher.yahoo('cny'), 3.0)
+            self.assertEqual(StandardPriceFetcher.yahoo('php'), 7.0)
+        finally:
+            price_fetcher.response_cache = shared_cache
+        self.assertEqual(len(fetched), 1)
+
+
+class SlowPriceFetcher(PriceFetcher):
+    """
+    Price fetcher whose prices are held back until the test lets them through
+    """
+
+    def __init__(self, app, log, meet=False):
+        """
+        :param meet: each fetch waits until another is running at the same time
+        """
+        self.fetched = []
+        self.meet = meet
+        self.fetching = 0
+        self.together = Event()
+        self.fetch_lock = Lock()
+        # fetches of the held units wait for release to be set
+        self.held = set()
+        self.release = Event()
+        super(SlowPriceFetcher, self).__init__(app, log)
+
+    def fetch_price(self, unit):
+        with self.fetch_lock:
+            self.fetching += 1
+            if self.fetching > 1:
+                self.together.set()
+        if self.meet:
+            self.together.wait(10)
+        if unit in self.held:
+            self.release.wait(10)
+        with self.fetch_lock:
+            self.fetching -= 1
+        self.fetched.append(unit)
+        return 2.0
+
+
+class TestPriceFetcher(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Update the prices of two made up units
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        database.build(self.app, self.log, log_output=False)
+        self.app.config['units'] = ['tsa', 'tsb']
+        self.app.config['prices.workers'] = '2'
+        self.fetcher = None
+
+    def tearDown(self):
+        if self.fetcher is not None:
+            self.fetcher.stop()
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("DELETE FROM prices WHERE unit IN ('tsa', 'tsb')")
+        conn.commit()
+        conn.close()
+
+    def test_units_are_updated_together(self):
+        self.fetcher = SlowPriceFetcher(self.app, self.log, meet=True)
+        self.assertTrue(self.fetcher.together.is_set())
+        self.assertListEqual(sorted(self.fetcher.fetched), ['tsa', 'tsb'])
+        self.assertEqual(price_cache.get(self.app, 'tsa')[0], 2.0)
+        stats = self.fetcher.stats()
+        self.assertEqual(stats['tsb']['interval'], 60)
+        self.assertLess(stats['tsb']['price_age'], 10)
+
+    def test_status_uses_published_prices(self):
+        """
+        The status document should be rebuilt from the published prices without
+        borrowing another connection to look up the others
+        :return:
+        """
+        price_cache.prices.pop('ppc', None)
+        price_cache.set('btc', 0.5, time.time())
+        self.fetcher = SlowPriceFetcher(self.app, self.log)
+        self.assertDictEqual(stats.status_document.sections['prices'],
+                             {'btc': [0.5, 2.0]})
+
+    def test_slow_unit_is_skipped(self):
+        """
+        A unit whose update is still running should be skipped without holding up the
+        other units
+        :return:
+        """
+        self.app.config['prices.interval'] = '0.1'
+        self.app.config['prices.tsb_interval'] = '0.05'
+        self.fetcher = SlowPriceFetcher(self.app, self.log)
+        # hold up the next tsa update
+        self.fetcher.held.add('tsa')
+        tsa_count = self.fetcher.fetched.count('tsa')
+        tsb_count = self.fetcher.fetched.count('tsb')
+        try:
+            self.assertTrue(wait_for(lambda: self.fetcher.stats()['tsa']['skipped'] > 0))
+            self.assertTrue(wait_for(lambda: self.fetcher.fetched.count('tsb') >=
+                                     tsb_count + 3))
+            self.assertEqual(self.fetcher.fetched.count('tsa'), tsa_count)
+        finally:
+            self.fetcher.release.set()
@@ -0,0 +1,200 @@
+import logging
+import os
+import time
+import unittest
+from os.path import join
+import bottle
+from src import balances, config, database, retention
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Build the database in a schema of its own so that partitions can be dropped
+        without upsetting the other tests
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        # set us up a bottle application with correct config
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        conn = database.get_db(self.app)
+        conn.cursor().execute("DROP SCHEMA IF EXISTS retention_test CASCADE")
+        conn.cursor().execute("CREATE SCHEMA retention_test")
+        conn.commit()
+        conn.close()
+        os.environ['PGOPTIONS'] = '-c search_path=retention_test'
+        database.build(self.app, self.log, log_output=False)
+        self.conn = database.get_db(self.app)
+        self.db = self.conn.cursor()
+        self.now = time.time()
+
+    def tearDown(self):
+        self.conn.close()
+        del os.environ['PGOPTIONS']
+        conn = database.get_db(self.app)
+        conn.cursor().execute("DROP SCHEMA retention_test CASCADE")
+        conn.commit()
+        conn.close()
+
+    def test_tables_are_partitioned(self):
+        for table, key in retention.PARTITIONED:
+            self.db.execute("SELECT relkind FROM pg_class WHERE oid=%s::regclass",
+                            (table,))
+            self.assertEqual(self.db.fetchone()[0], 'p')
+            # the existing rows keep their index as the first partition's primary key
+            # and the constraint used to attach it is gone
+            self.db.execute("SELECT conname, contype FROM pg_constraint WHERE conrelid="
+                            "%s::regclass", ('{}_legacy'.format(table),))
+            self.assertListEqual(self.db.fetchall(),
+                                 [('{}_legacy_pkey'.format(table), 'p')])
+        self.db.execute("INSERT INTO orders (key, credited) VALUES (%s, %s) RETURNING "
+                        "time", ('TEST_USER_1', 0))
+        self.assertAlmostEqual(self.db.fetchone()[0], self.now, delta=60)
+
+    def test_uncovered(self):
+        ranges = [(None, 100.0), (200.0, 300.0)]
+        self.assertListEqual(retention.uncovered(ranges, 50.0, 400.0),
+                             [(100.0, 200.0), (300.0, 400.0)])
+        self.assertListEqual(retention.uncovered(ranges, 200.0, 300.0), [])
+        self.assertListEqual(retention.uncovered([(None, None)], 0.0, 100.0), [])
+
+    def test_create_partitions(self):
+        """
+        Partitions should be made for each day up to the end time and only once
+        :return:
+        """
+        # the legacy partition covers the rest of today and tomorrow
+        created = retention.create_partitions(self.db, 'prices', self.now,
+                                              self.now + (4 * retention.DAY),
+                                              retention.DAY)
+        self.assertEqual(len(created), 3)
+        self.assertListEqual(retention.create_partitions(
+            self.db, 'prices', self.now, self.now + (4 * retention.DAY), retention.DAY
+        ), [])
+        found = retention.partitions(self.db, 'prices')
+        self.assertEqual(found[0][0], 'prices_legacy')
+        self.assertIsNone(found[0][1])
+        for name, lower, upper in found[1:]:
+            self.assertEqual(upper - lower, retention.DAY)
+            self.assertEqual(lower % retention.DAY, 0)
+        # rows for the coming days can be saved
+        self.db.execute("INSERT INTO prices (unit, price, time) VALUES (%s, %s, %s)",
+                        ('btc', 1.0, self.now + (3 * retention.DAY)))
+
+    def test_expired_partitions_are_replaced(self):
+        """
+        Dropping every partition up to the current time should leave the table ready to
+        save new rows once the partitions are made again
+        :return:
+        """
+        self.db.execute("INSERT INTO orders (key, credited) VALUES (%s, %s)",
+                        ('TEST_USER_1', 0))
+        expired = retention.expire_partitions(self.log, self.db, 'orders',
+                                              self.now + (2 * retention.DAY))
+        self.assertIn('orders_legacy', expired)
+        self.db.execute("SELECT COUNT(*) FROM orders")
+        self.assertEqual(self.db.fetchone()[0], 0)
+        retention.create_partitions(self.db, 'orders', self.now, self.now,
+                                    retention.DAY)
+        self.db.execute("INSERT INTO orders (key, credited) VALUES (%s, %s)",
+                        ('TEST_USER_1', 0))
+
+    def test_credits_are_kept_until_paid(self):
+        """
+        Credits shouldn't be dropped until they are paid and the balances ledger should
+        still agree with the credits once they are
+        :return:
+        """
+        self.db.execute("INSERT INTO users (key,address,exchange,unit) VALUES "
+                        "(%s,%s,%s,%s)", ('TEST_USER_1', 'ADDRESS_1', 'test_exchange',
+                                          'btc'))
+        for reward in [0.5, 0.25]:
+            self.db.execute("INSERT INTO credits (time,key,exchange,unit,rank,side,"
+                            "order_id,provided,percentage,reward,paid) VALUES "
+                            "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                            (self.now - (10 * retention.DAY), 'TEST_USER_1',
+                             'test_exchange', 'btc', 'rank_1', 'ask', 1, 100, 50, reward,
+                             0))
+        balances.update(self.db, 0)
+        cutoff = self.now + (2 * retention.DAY)
+        self.assertNotIn('credits_legacy', retention.expire_partitions(
+            self.log, self.db, 'credits', cutoff
+        ))
+        balances.settle(self.db, ['TEST_USER_1'], self.now)
+        self.assertIn('credits_legacy', retention.expire_partitions(
+            self.log, self.db, 'credits', cutoff
+        ))
+        self.db.execute("SELECT earned, unpaid, paid, archived FROM balances WHERE "
+                        "key=%s", ('TEST_USER_1',))
+        self.assertTupleEqual(self.db.fetchone(), (0.75, 0.0, 0.75, 0.75))
+        self.assertListEqual(balances.check(self.db), [])
+        # rebuilding the ledger keeps the archived rewards
+        balances.rebuild(self.db)
+        self.db.execute("SELECT earned, unpaid, paid FROM balances WHERE key=%s",
+                        ('TEST_USER_1',))
+        self.assertTupleEqual(self.db.fetchone(), (0.75, 0.0, 0.75))
+
+    def test_maintain(self):
+        """
+        The retention job should make partitions for the coming week
+        :return:
+        """
+        # maintain uses pooled connections so work on the default schema too, where
+        # the orders are kept
+        del os.environ['PGOPTIONS']
+        try:
+            retention.maintain(self.app, self.log, now=self.now)
+        finally:
+            os.environ['PGOPTIONS'] = '-c search_path=retention_test'
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SET search_path TO public")
+        for table, key in retention.PARTITIONED:
+            self.assertGreaterEqual(
+                max(upper for name, lower, upper in retention.partitions(c, table)),
+                self.now + (7 * retention.DAY)
+            )
+        conn.close()
+
+    def test_maintain_gives_up_waiting_for_locks(self):
+        """
+        The retention job shouldn't queue behind a long transaction on a table but
+        should try again on the next run
+        :return:
+        """
+        self.app.config['retention.lock_timeout'] = '0.2'
+        later = self.now + (30 * retention.DAY)
+        del os.environ['PGOPTIONS']
+        holder = database.get_db(self.app)
+        try:
+            holder.cursor().execute("SELECT COUNT(*) FROM orders")
+            retention.maintain(self.app, self.log, now=later)
+            conn = database.get_db(self.app)
+            c = conn.cursor()
+            uppers = dict((table, max(upper for name, lower, upper in
+                                      retention.partitions(c, table)))
+                          for table, key in retention.PARTITIONED)
+            self.assertLess(uppers['orders'], later)
+            self.assertGreaterEqual(uppers['prices'], later + (7 * retention.DAY))
+            holder.rollback()
+            retention.maintain(self.app, self.log, now=later)
+            self.assertGreaterEqual(max(upper for name, lower, upper in
+                                        retention.partitions(c, 'orders')),
+                                    later + (7 * retention.DAY))
+            # don't leave the partitions of next month behind
+            for table, key in retention.PARTITIONED:
+                for name, lower, upper in retention.partitions(c, table):
+                    if lower is not None and lower >= later - retention.DAY:
+                        c.execute("DROP TABLE {}".format(name))
+            conn.commit()
+            conn.close()
+        finally:
+            holder.close()
+            os.environ['PGOPTIONS'] = '-c search_path=retention_test'
@@ -0,0 +1,49 @@
+import json
+import unittest
+import zlib
+from src.stats import StatusDocument, price_section
+
+
+class TestStatusDocument(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Build a status document from some round stats
+        :return:
+        """
+        self.status = StatusDocument()
+        self.message = {'meta': {'number-of-orders': 40},
+                        'totals': {'test_exchange': {'btc': {'total': 2000.0}}},
+                        'rewards': {'test_exchange': {'btc': {'ask': {'rank_1': 0.01}}}},
+                        'prices': {'btc': [0.0025, 400.0]}}
+        self.status.update(**self.message)
+
+    def test_no_document_before_stats(self):
+        status = StatusDocument()
+        self.assertIsNone(status.update(prices={'btc': [0.0025, 400.0]}))
+        self.assertIsNone(status.get())
+
+    def test_render(self):
+        body = self.status.get().render(1000, 10)
+        self.assertEqual(body, json.dumps({'status': True, 'message': self.message,
+                                           'server_time': 1000,
+                                           'server_up_time': 10}, sort_keys=True))
+
+    def test_render_gzip(self):
+        document = self.status.get()
+        for server_time in [1000, 1001]:
+            body = document.render(server_time, 10, gzip=True)
+            self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                             document.render(server_time, 10))
+
+    def test_etag(self):
+        etag = self.status.get().etag
+        self.assertEqual(self.status.update(prices=self.message['prices']).etag, etag)
+        self.assertNotEqual(self.status.update(prices={'btc': [0.002, 500.0]}).etag,
+                            etag)
+
+    def test_price_section(self):
+        self.assertDictEqual(price_section(['btc', 'ppc'],
+                                           {'btc': (0.002500001, 399.99984, 1),
+                                            'ppc': None}),
+                             {'btc': [0.0025, 399.99984]})
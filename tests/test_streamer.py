@@ -0,0 +1,238 @@
+import logging
+import time
+import unittest
+import uuid
+from os.path import join
+from threading import Thread
+import bottle
+import zmq
+from src import config, database, stats
+from src.price_fetcher import PriceFetcher, StreamerSubscriber, price_cache
+
+
+class FakeStreamer(object):
+
+    def __init__(self, prices, interval=0.05):
+        """
+        A local stand in for the price streamer.
+        It answers pings, gives out a port and token for each unit and publishes the
+        prices on that port once a client has sent 'start'
+        :param prices: dict of prices keyed by unit
+        :param interval: seconds between published messages
+        """
+        self.prices = prices
+        self.interval = interval
+        # 'prices', 'heartbeat' or 'silent'
+        self.mode = 'prices'
+        self.context = zmq.Context.instance()
+        self.ping = self.context.socket(zmq.REP)
+        self.ping_port = self.ping.bind_to_random_port('tcp://127.0.0.1')
+        self.main = self.context.socket(zmq.REP)
+        self.main_port = self.main.bind_to_random_port('tcp://127.0.0.1')
+        self.streams = {}
+        for unit in prices:
+            self.streams[unit] = self.bind_stream()
+        self.started = set()
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def bind_stream(self):
+        """
+        Bind a publishing socket and its manage socket on the port 100 above
+        :return:
+        """
+        while True:
+            pub_socket = self.context.socket(zmq.PUB)
+            port = pub_socket.bind_to_random_port('tcp://127.0.0.1', min_port=20000,
+                                                  max_port=40000)
+            manage_socket = self.context.socket(zmq.REP)
+            try:
+                manage_socket.bind('tcp://127.0.0.1:{}'.format(port + 100))
+            except zmq.error.ZMQError:
+                pub_socket.close(0)
+                manage_socket.close(0)
+                continue
+            return {'port': port, 'token': uuid.uuid4().hex, 'pub': pub_socket,
+                    'manage': manage_socket}
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.ping, zmq.POLLIN)
+        poller.register(self.main, zmq.POLLIN)
+        manage = {}
+        for unit, stream in self.streams.items():
+            poller.register(stream['manage'], zmq.POLLIN)
+            manage[stream['manage']] = unit
+        last_sent = 0
+        while self.running:
+            for rep_socket, event in poller.poll(10):
+                message = rep_socket.recv()
+                if rep_socket is self.ping:
+                    rep_socket.send('pong!')
+                elif rep_socket is self.main:
+                    unit = message.split()[-1]
+                    if unit in self.streams:
+                        rep_socket.send_json({'args': [self.streams[unit]['port'],
+                                                       self.streams[unit]['token']]})
+                    else:
+                        rep_socket.send_json({'error': 'unknown unit'})
+                else:
+                    unit = manage[rep_socket]
+                    self.started.add(unit)
+                    rep_socket.send_json({'args': [unit, self.prices[unit]]})
+            if time.time() - last_sent < self.interval or self.mode == 'silent':
+                continue
+            last_sent = time.time()
+            for unit in self.started:
+                if self.mode == 'heartbeat':
+                    self.streams[unit]['pub'].send_json({'heartbeat': last_sent})
+                else:
+                    self.streams[unit]['pub'].send_json({'args': [unit,
+                                                                  self.prices[unit]]})
+        for stream in self.streams.values():
+            stream['pub'].close(0)
+            stream['manage'].close(0)
+        self.ping.close(0)
+        self.main.close(0)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+class TestStreamerSubscriber(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Start a local streamer with prices for two made up units
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        database.build(self.app, self.log, log_output=False)
+        self.streamer = FakeStreamer({'tsa': 2.0, 'tsb': 4.0})
+        self.subscriber = StreamerSubscriber(self.app, self.log, ['tsa', 'tsb'],
+                                             base_url='127.0.0.1',
+                                             ping_port=self.streamer.ping_port,
+                                             main_port=self.streamer.main_port,
+                                             heartbeat=0.5, stale=1, max_backoff=1)
+
+    def tearDown(self):
+        self.subscriber.stop()
+        self.streamer.stop()
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("DELETE FROM prices WHERE unit IN ('tsa', 'tsb')")
+        conn.commit()
+        conn.close()
+
+    def wait_for(self, check, timeout=3):
+        """
+        Wait until the check passes
+        :param check: function returning bool
+        :param timeout:
+        :return:
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            if check():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_streamed_prices(self):
+        """
+        Streamed prices should be published as they arrive and saved once
+        :return:
+        """
+        self.subscriber.start()
+        self.assertTrue(self.wait_for(lambda: self.subscriber.fresh('tsa') and
+                                      self.subscriber.fresh('tsb')))
+        self.assertEqual(price_cache.get(self.app, 'tsb')[:2], (4.0, 0.25))
+        self.streamer.prices['tsa'] = 3.0
+        self.assertTrue(self.wait_for(lambda: price_cache.get(self.app,
+                                                              'tsa')[0] == 3.0))
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM prices WHERE unit=%s", ('tsa',))
+        self.assertEqual(c.fetchone()[0], 1)
+        conn.close()
+        self.assertEqual(self.subscriber.reconnects, 0)
+
+    def test_streamed_prices_are_shown(self):
+        """
+        The status document should show a streamed price as soon as it is published
+        :return:
+        """
+        # don't save the price
+        self.subscriber.last_stored['btc'] = time.time()
+        self.subscriber.publish('btc', 0.5)
+        self.assertListEqual(stats.status_document.sections['prices']['btc'], [0.5, 2.0])
+
+    def test_heartbeats_keep_the_subscription(self):
+        """
+        Heartbeats should keep a subscription open but the price should go stale
+        :return:
+        """
+        self.subscriber.start()
+        self.assertTrue(self.wait_for(lambda: self.subscriber.fresh('tsa')))
+        self.streamer.mode = 'heartbeat'
+        self.assertTrue(self.wait_for(lambda: self.subscriber.stats()['units']['tsa']
+                                      ['stale']))
+        self.assertFalse(self.subscriber.fresh('tsa'))
+        self.assertEqual(self.subscriber.reconnects, 0)
+        self.streamer.mode = 'prices'
+        self.assertTrue(self.wait_for(lambda: self.subscriber.fresh('tsa')))
+        self.assertFalse(self.subscriber.stats()['units']['tsa']['stale'])
+
+    def test_silent_streamer_is_resubscribed(self):
+        self.subscriber.start()
+        self.assertTrue(self.wait_for(lambda: self.subscriber.fresh('tsa')))
+        self.streamer.mode = 'silent'
+        self.assertTrue(self.wait_for(lambda: self.subscriber.reconnects > 0))
+        self.streamer.mode = 'prices'
+        self.assertTrue(self.wait_for(lambda: self.subscriber.stats()['units']['tsa']
+                                      ['subscribed']))
+
+    def test_streamer_offline(self):
+        """
+        Subscribing should back off while the streamer is offline and the units should
+        be reported stale
+        :return:
+        """
+        self.streamer.stop()
+        self.subscriber.start()
+        self.assertTrue(self.wait_for(lambda: self.subscriber.stats()['units']['tsb']
+                                      ['stale']))
+        self.assertFalse(self.subscriber.stats()['units']['tsb']['subscribed'])
+        self.assertGreaterEqual(self.subscriber.retries['tsb'][1], 1)
+
+    def test_workers_share_the_streamer(self):
+        """
+        The price workers should be able to ask the streamer for prices at the same
+        time
+        :return:
+        """
+        self.app.config['units'] = []
+        self.app.config['prices.workers'] = '4'
+        fetcher = PriceFetcher(self.app, self.log)
+        try:
+            fetcher.streamer.base_url = '127.0.0.1'
+            fetcher.streamer.ping_port = self.streamer.ping_port
+            fetcher.streamer.main_port = self.streamer.main_port
+            self.app.config['units'] = ['tsa', 'tsb']
+            for x in xrange(3):
+                self.streamer.prices['tsa'] = 2.0 + x
+                fetcher.update_prices()
+                self.assertEqual(price_cache.get(self.app, 'tsa')[0], 2.0 + x)
+                self.assertEqual(price_cache.get(self.app, 'tsb')[0], 4.0)
+        finally:
+            fetcher.stop()
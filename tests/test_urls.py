@@ -6,6 +6,7 @@ import time
 
 import os
 from os.path import join
+from threading import BoundedSemaphore
 from src import database
 from webtest import TestApp
 
@@ -311,3 +312,113 @@ class TestUrls(unittest.TestCase):
                 }
             }
         })
+
+    def test_exchanges_not_modified(self):
+        """
+        Exchanges shouldn't be sent again to a client which has the current version
+        :return:
+        """
+        resp = self.app.get('/exchanges')
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+        resp = self.app.get('/exchanges', headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(resp.body, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.app.get('/exchanges', headers={'If-None-Match': '"old"'}, status=200)
+
+    def test_feeds(self):
+        """
+        The price feeds of each unit should be shown with their health
+        :return:
+        """
+        resp = self.app.get('/feeds').json
+        self.assertTrue(resp['success'])
+        ranking = resp['message']['units']['ppc']
+        self.assertListEqual(ranking['hierarchy'], ['btce', 'coinmarketcap_ne',
+                                                    'coinmarketcap_no'])
+        self.assertIn(ranking['main'], ranking['hierarchy'])
+        self.assertEqual(len(ranking['fallbacks']), 2)
+        for feed in ranking['hierarchy']:
+            self.assertIn(feed, ranking['scores'])
+
+    def register_with_orders(self, number):
+        """
+        Register TEST_USER_1 and give them some orders
+        :param number: the number of orders
+        :return: the order ids, newest first
+        """
+        reg_data = {'user': 'TEST_USER_1',
+                    'address': 'BMJ2PJ1TNMwnTYUopQVxBrAPmmJjJjhd96',
+                    'exchange': 'test_exchange', 'unit': 'btc'}
+        self.app.post('/register', headers=self.headers, params=json.dumps(reg_data))
+        conn = database.get_db(self.app.app)
+        c = conn.cursor()
+        c.execute("DELETE FROM orders WHERE key='TEST_USER_1'")
+        ids = []
+        for x in xrange(number):
+            c.execute("INSERT INTO orders (key,rank,order_id,order_amount,side,exchange,"
+                      "unit,credited) VALUES (%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id",
+                      ('TEST_USER_1', 'rank_1', x, 100, 'ask', 'test_exchange', 'btc',
+                       0))
+            ids.insert(0, c.fetchone()[0])
+        conn.commit()
+        conn.close()
+        return ids
+
+    def test_user_orders_pages(self):
+        ids = self.register_with_orders(5)
+        page = self.app.get('/TEST_USER_1/orders?limit=2').json
+        self.assertEqual([order['id'] for order in page['message']], ids[:2])
+        self.assertDictEqual(page['next'], {'before_id': ids[1]})
+        page = self.app.get('/TEST_USER_1/orders?limit=2&before_id={}'.format(
+            ids[1])).json
+        self.assertEqual([order['id'] for order in page['message']], ids[2:4])
+        page = self.app.get('/TEST_USER_1/orders?limit=10&after_id={}'.format(
+            ids[2])).json
+        self.assertEqual([order['id'] for order in page['message']], ids[1::-1])
+        self.assertNotIn('next', page)
+        self.assertDictEqual(self.app.get('/TEST_USER_1/orders?limit=none').json,
+                             {'success': False, 'message': 'limit must be a number'})
+
+    def test_user_orders_export(self):
+        ids = self.register_with_orders(5)
+        resp = self.app.get('/TEST_USER_1/orders?format=csv')
+        self.assertEqual(resp.headers['Content-Type'], 'text/csv')
+        lines = resp.body.splitlines()
+        self.assertTrue(lines[0].startswith('id,order_id,exchange'))
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], ids)
+        resp = self.app.get('/TEST_USER_1/orders?format=jsonl&after_id={}'.format(
+            ids[2]))
+        self.assertEqual([json.loads(line)['id'] for line in resp.body.splitlines()],
+                         ids[1::-1])
+
+    def test_user_orders_export_is_capped(self):
+        ids = self.register_with_orders(5)
+        self.app.app.config['orders.max_export'] = '3'
+        try:
+            resp = self.app.get('/TEST_USER_1/orders?format=jsonl')
+            self.assertEqual([json.loads(line)['id'] for line in
+                              resp.body.splitlines()], ids[:3])
+            resp = self.app.get('/TEST_USER_1/orders?format=jsonl&limit=10&'
+                                'before_id={}'.format(ids[2]))
+            self.assertEqual([json.loads(line)['id'] for line in
+                              resp.body.splitlines()], ids[3:])
+        finally:
+            del self.app.app.config['orders.max_export']
+
+    def test_user_orders_exports_are_limited(self):
+        import pool_server
+        self.register_with_orders(1)
+        slots = pool_server.export_slots
+        pool_server.export_slots = BoundedSemaphore(1)
+        try:
+            pool_server.export_slots.acquire()
+            resp = self.app.get('/TEST_USER_1/orders?format=csv', status=503)
+            self.assertFalse(json.loads(resp.body)['success'])
+            pool_server.export_slots.release()
+            resp = self.app.get('/TEST_USER_1/orders?format=csv')
+            self.assertEqual(len(resp.body.splitlines()), 2)
+            # the slot is given back once the export has been read
+            self.assertTrue(pool_server.export_slots.acquire(False))
+        finally:
+            pool_server.export_slots = slots
@@ -0,0 +1,101 @@
+import logging
+import os
+import unittest
+from os.path import join
+import bottle
+from src import config, credit, database
+from src.exchanges import TestExchange
+from src.validation import ValidationQueue, save_orders
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up a validation queue with the test exchange and a known price
+        :return:
+        """
+        # Build the tests Logger
+        self.log = logging.Logger('Tests')
+        stream = logging.StreamHandler()
+        formatter = logging.Formatter(fmt='%(message)s')
+        stream.setFormatter(formatter)
+        self.log.addHandler(stream)
+        # set us up a bottle application with correct config
+        self.app = bottle.Bottle()
+        config.load(self.app, self.log, join('tests', 'config'), log_output=False)
+        database.build(self.app, self.log, log_output=False)
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("DELETE FROM orders")
+        c.execute("DELETE FROM liquidity_totals")
+        c.execute("INSERT INTO prices (unit, price) VALUES (%s, %s)", ('btc', 1.0))
+        conn.commit()
+        conn.close()
+        self.queue = ValidationQueue(self.app, self.log,
+                                     {'test_exchange': TestExchange()},
+                                     workers=2, size=2)
+
+    def test_submission_is_validated(self):
+        """
+        A queued submission should be validated and its orders saved
+        :return:
+        """
+        submission_id = self.queue.submit('TEST_USER_1', 'test_exchange', 'btc',
+                                          {'test': True}, 'this_is_signed')
+        self.assertIsNotNone(submission_id)
+        self.queue.queue.join()
+        self.assertDictContainsSubset({'status': 'complete', 'success': True,
+                                       'message': 'orders saved for validation'},
+                                      self.queue.result(submission_id))
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        c.execute("SELECT COUNT(id) FROM orders WHERE key=%s", ('TEST_USER_1',))
+        self.assertEqual(c.fetchone()[0], 10)
+        conn.close()
+
+    def test_workers_start_with_the_first_submission(self):
+        """
+        The workers should be started in the process which submits, not the one which
+        built the queue
+        :return:
+        """
+        self.assertIsNone(self.queue.pid)
+        # pretend the queue was built before the server forked
+        self.queue.pid = -1
+        submission_id = self.queue.submit('TEST_USER_1', 'test_exchange', 'btc',
+                                          {'test': True}, 'this_is_signed')
+        self.queue.queue.join()
+        self.assertEqual(self.queue.pid, os.getpid())
+        self.assertEqual(self.queue.result(submission_id)['status'], 'complete')
+
+    def test_unknown_submission(self):
+        self.assertIsNone(self.queue.result('not_a_submission'))
+
+    def test_running_totals(self):
+        """
+        Totals kept as orders are saved should match the totals calculated from the
+        orders and be reset by the credit round
+        :return:
+        """
+        self.app.config['credit.running_totals'] = 'true'
+        orders = TestExchange.validate_request()['orders']
+        conn = database.get_db(self.app)
+        c = conn.cursor()
+        save_orders(self.app, self.log, c, 'TEST_USER_1', 'test_exchange', 'btc', orders)
+        conn.commit()
+        # the same orders submitted again by another user are duplicates
+        save_orders(self.app, self.log, c, 'TEST_USER_2', 'test_exchange', 'btc', orders)
+        conn.commit()
+        c.execute("SELECT COUNT(id) FROM orders WHERE key=%s AND credited=-1",
+                  ('TEST_USER_2',))
+        self.assertEqual(c.fetchone()[0], 10)
+        c.execute("SELECT MAX(id) FROM orders")
+        totals = credit.get_total_liquidity_sql(self.app, c, c.fetchone()[0])
+        self.assertDictEqual(credit.get_running_totals(self.app, c), totals)
+        credit.credit(self.app, self.log)
+        c.execute("SELECT totals FROM stats ORDER BY id DESC LIMIT 1")
+        self.assertDictEqual(c.fetchone()[0], totals)
+        c.execute("SELECT COUNT(*) FROM liquidity_totals")
+        self.assertEqual(c.fetchone()[0], 0)
+        conn.close()